@@ -0,0 +1,46 @@
+import argparse
+import json
+import sys
+
+"""
+Compares two benchmark result files written by run.py, e.g.
+python ./bench/compare.py ./bench/results/abc1234-100000.json ./bench/results/def5678-100000.json
+
+Exits with status 1 when a route's latency percentile regressed by more than the threshold
+"""
+
+def load(path: str) -> dict:
+    with open(path) as results_file:
+        return json.load(results_file)
+
+""" Returns (name, baseline, candidate, ratio) rows for every measurement present in both results """
+def compare(baseline: dict, candidate: dict, percentile: str) -> list:
+    rows = []
+    before = baseline.get("populate", {}).get("rowsPerSecond")
+    after = candidate.get("populate", {}).get("rowsPerSecond")
+    if before and after:
+        # Throughput improves as it grows, so the ratio is inverted to match latencies
+        rows.append(("populate rowsPerSecond", before, after, before / after))
+    for route, before in baseline.get("routes", {}).items():
+        after = candidate.get("routes", {}).get(route)
+        if after != None and before[percentile] > 0:
+            rows.append((route, before[percentile], after[percentile], after[percentile] / before[percentile]))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument('baseline', help="results of the reference commit")
+    parser.add_argument('candidate', help="results of the commit under test")
+    parser.add_argument('--percentile', default='p99', choices=['p50', 'p90', 'p99', 'mean', 'max'])
+    parser.add_argument('--threshold', type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    baseline = load(args.baseline)
+    candidate = load(args.candidate)
+    print("{} -> {} ({})".format(baseline.get("commit"), candidate.get("commit"), args.percentile))
+    regressions = 0
+    for name, before, after, ratio in compare(baseline, candidate, args.percentile):
+        regressed = ratio > args.threshold
+        regressions += 1 if regressed else 0
+        print("{:<60} {:>12} {:>12} {:>7.2f}x{}".format(name, before, after, ratio, "  REGRESSION" if regressed else ""))
+    sys.exit(1 if regressions > 0 else 0)
@@ -0,0 +1,139 @@
+import argparse
+import bisect
+import csv
+import itertools
+import json
+import os
+import random
+
+"""
+Generates synthetic company catalogs shaped like wanted-temp-data.csv, e.g.
+python ./bench/generate.py --companies 1000000 --output ./bench/data/catalog-1m.csv
+
+Rows are written as they are generated, so memory use does not grow with the catalog size,
+and the same seed always produces the same catalog
+"""
+
+# Share of companies with a name in each language, measured on wanted-temp-data.csv
+# Every company has at least one name
+LANGUAGE_SHARE = { "ko": 0.85, "en": 0.22, "ja": 0.03 }
+
+# Relative frequency of the number of tags on a company, measured on wanted-temp-data.csv
+TAG_COUNT_WEIGHTS = { 1: 24, 2: 24, 3: 23, 4: 29 }
+
+KO_SYLLABLES = "가나다라마바사아자차카타파하고노도로모보소오조코토포호구누두루무부수우주쿠투푸후기니디리미비시이지키티피히"
+JA_SYLLABLES = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+EN_SYLLABLES = ["ka", "lo", "mi", "ra", "te", "no", "vi", "so", "da", "ze", "po", "lu", "ne", "ti", "ga", "ro"]
+KO_SUFFIXES = ["", "", "랩", "소프트", "테크", "코리아", "네트웍스", "컴퍼니"]
+EN_SUFFIXES = ["", "", "lab", " Inc.", " Corp.", " Technologies", ".com", " Networks"]
+JA_PREFIXES = ["", "株式会社"]
+
+"""
+Encodes a company ordinal as a fixed number of syllables, making every generated name unique
+within its language whatever random syllables precede it
+"""
+def encode(ordinal: int, syllables, width: int) -> str:
+    digits = []
+    for _ in range(width):
+        ordinal, digit = divmod(ordinal, len(syllables))
+        digits.append(syllables[digit])
+    return "".join(reversed(digits))
+
+"""
+Scrambles company ordinals so consecutive companies do not share name prefixes, a bijection
+on the range of every encoding width as the multiplier is a prime not dividing any syllable count
+"""
+def scramble(ordinal: int, syllables, width: int) -> int:
+    return (ordinal * 2654435761) % (len(syllables) ** width)
+
+def width_for(companies: int, syllables) -> int:
+    width = 1
+    while len(syllables) ** width < companies:
+        width += 1
+    return width
+
+class CatalogGenerator:
+    def __init__(self, companies: int, tags: int, seed=0, tag_skew=1.0):
+        self.companies = companies
+        self.tags = tags
+        self.random = random.Random(seed)
+        # Tag popularity follows a Zipf distribution, a few tags are on most companies
+        self.tag_weights = list(itertools.accumulate(1 / (rank ** tag_skew) for rank in range(1, tags + 1)))
+        self.tag_counts = list(TAG_COUNT_WEIGHTS.keys())
+        self.tag_count_weights = list(itertools.accumulate(TAG_COUNT_WEIGHTS.values()))
+        self.widths = {
+            "ko": width_for(companies, KO_SYLLABLES),
+            "en": width_for(companies, EN_SYLLABLES),
+            "ja": width_for(companies, JA_SYLLABLES)
+        }
+
+    """ Yields every row of the catalog, including the header row """
+    def rows(self):
+        yield ["company_ko", "company_en", "company_ja", "tag_ko", "tag_en", "tag_ja"]
+        for ordinal in range(self.companies):
+            names = self._names(ordinal)
+            tags = self._tags()
+            yield names + [
+                "|".join("태그_%d"%tag for tag in tags),
+                "|".join("tag_%d"%tag for tag in tags),
+                "|".join("タグ_%d"%tag for tag in tags)
+            ]
+
+    def _names(self, ordinal: int) -> list:
+        languages = [language for language, share in LANGUAGE_SHARE.items() if self.random.random() < share]
+        if len(languages) == 0:
+            languages = ["ko"]
+        names = []
+        for language in ["ko", "en", "ja"]:
+            if language not in languages:
+                names.append("")
+            elif language == "ko":
+                names.append(self._syllables(KO_SYLLABLES) + self._encode(ordinal, KO_SYLLABLES, "ko")
+                    + self.random.choice(KO_SUFFIXES))
+            elif language == "en":
+                name = self._syllables(EN_SYLLABLES) + self._encode(ordinal, EN_SYLLABLES, "en")
+                names.append(name.capitalize() + self.random.choice(EN_SUFFIXES))
+            else:
+                names.append(self.random.choice(JA_PREFIXES) + self._syllables(JA_SYLLABLES)
+                    + self._encode(ordinal, JA_SYLLABLES, "ja"))
+        return names
+
+    def _encode(self, ordinal: int, syllables, language: str) -> str:
+        width = self.widths[language]
+        return encode(scramble(ordinal, syllables, width), syllables, width)
+
+    def _syllables(self, syllables) -> str:
+        return "".join(self.random.choice(syllables) for _ in range(self.random.randint(0, 2)))
+
+    def _tags(self) -> list:
+        count = min(self.tags, self.tag_counts[self._weighted(self.tag_count_weights)])
+        tags = []
+        while len(tags) < count:
+            tag = self._weighted(self.tag_weights) + 1
+            if tag not in tags:
+                tags.append(tag)
+        return tags
+
+    def _weighted(self, cumulative_weights: list) -> int:
+        return bisect.bisect_right(cumulative_weights, self.random.random() * cumulative_weights[-1])
+
+""" Writes a generated catalog to path, returning a description of the catalog """
+def generate(path: str, companies: int, tags=None, seed=0, tag_skew=1.0) -> dict:
+    if tags == None:
+        tags = max(30, companies // 1000)
+    generator = CatalogGenerator(companies, tags, seed=seed, tag_skew=tag_skew)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        csv.writer(csv_file).writerows(generator.rows())
+    return { "path": path, "companies": companies, "tags": tags, "seed": seed, "tagSkew": tag_skew }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic company catalog CSV document")
+    parser.add_argument('--companies', type=int, default=10000, help="number of companies in the catalog")
+    parser.add_argument('--tags', type=int, default=None, help="number of distinct tags, defaults to one per thousand companies (at least 30)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed, the same seed produces the same catalog")
+    parser.add_argument('--tag-skew', type=float, default=1.0, help="Zipf exponent of tag popularity, 0 for uniform")
+    parser.add_argument('--output', default='./bench/data/catalog.csv', help="path of the generated CSV document")
+    args = parser.parse_args()
+
+    print(json.dumps(generate(args.output, args.companies, tags=args.tags, seed=args.seed, tag_skew=args.tag_skew), indent=4))
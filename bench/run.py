@@ -0,0 +1,247 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+Benchmark harness measuring catalog population throughput and the latency of every route,
+against the database configured by DB_URL, e.g.
+DB_URL=postgresql://... python ./bench/run.py --companies 100000 --requests 200
+
+The database is dropped and repopulated. Requests are served in process through the Flask test
+client, so latencies include routing, service logic, database round trips and serialization
+but not the network. Results are written as JSON to compare between commits with compare.py
+"""
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+
+""" Summarizes a list of latencies in seconds as milliseconds """
+def summarize(latencies: list, errors: int) -> dict:
+    ordered = sorted(latencies)
+    def percentile(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "mean": round(statistics.mean(ordered) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3)
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+"""
+Runs the benchmark requests against the application
+Each route is requested the configured number of times with parameters sampled from the
+populated catalog. Changes made by the routes which modify data are undone by the routes
+measured after them, so every route is measured against the same catalog
+"""
+class RouteBenchmark:
+    def __init__(self, client, db, requests: int, seed=0, warmup=5):
+        self.client = client
+        self.db = db
+        self.requests = requests
+        self.warmup = warmup
+        self.random = random.Random(seed)
+        self.results = {}
+
+    def load_samples(self, sample_size=1000):
+        from sqlalchemy import select
+        from models.models import CompanyName, TagLocalization
+        with self.db.engine.connect() as connection:
+            names = connection.execute(select(CompanyName.company_id, CompanyName.name).limit(sample_size)).all()
+            tags = connection.execute(select(TagLocalization.name).where(TagLocalization.language == "en")
+                .limit(sample_size)).all()
+        self.company_ids = [str(row.company_id) for row in names]
+        self.company_names = [row.name for row in names]
+        self.tag_names = [row.name for row in tags]
+
+    """
+        Times request(), which returns a response, over the configured number of iterations, or
+        over requests iterations after a single warm-up one when provided
+    """
+    def measure(self, route: str, request, expected=(200,), requests=None):
+        latencies = []
+        errors = 0
+        warmup = self.warmup if requests == None else 1
+        for iteration in range(warmup + (requests or self.requests)):
+            started = time.perf_counter()
+            response = request()
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            if iteration < warmup:
+                continue
+            latencies.append(elapsed)
+            if response.status_code not in expected:
+                errors += 1
+        self.results[route] = summarize(latencies, errors)
+        print("{:<60} p50 {:>9.3f}ms p99 {:>9.3f}ms".format(route, self.results[route]["p50"], self.results[route]["p99"]),
+            file=sys.stderr)
+
+    def run(self) -> dict:
+        choice = self.random.choice
+        self.load_samples()
+
+        self.measure("GET /companies/name/auto/<name>",
+            lambda: self.client.get("/companies/name/auto/%s?limit=20"%self._fragment()))
+        self.measure("GET /companies/name/auto/<name> unpaginated",
+            lambda: self.client.get("/companies/name/auto/%s"%self._fragment(4)))
+        self.measure("GET /companies/name/auto/<name> streamed",
+            lambda: self.client.get("/companies/name/auto/%s?stream=true"%self._fragment(4)))
+        self.measure("GET /companies/name/auto/<name> ranked",
+            lambda: self.client.get("/companies/name/auto/%s?ranked=true&limit=10"%self._fragment()))
+        self.measure("GET /companies",
+            lambda: self.client.get("/companies?ids=%s"%",".join(self.random.sample(self.company_ids, min(100, len(self.company_ids))))))
+        self.measure("GET /companies/<id>", lambda: self.client.get("/companies/%s"%choice(self.company_ids)))
+        self.measure("GET /companies/name/<name>", lambda: self.client.get("/companies/name/%s"%choice(self.company_names)))
+        self.measure("GET /companies/tags/<tag>", lambda: self.client.get("/companies/tags/%s?limit=100"%choice(self.tag_names)))
+        self.measure("GET /companies/tags/<tag> streamed",
+            lambda: self.client.get("/companies/tags/%s?stream=true&limit=1000"%choice(self.tag_names)))
+        self.measure("GET /companies/tags?q=",
+            lambda: self.client.get("/companies/tags", query_string={ "q": self._tag_query(), "limit": 100 }))
+        self.measure("GET /companies/tags?q= streamed",
+            lambda: self.client.get("/companies/tags", query_string={ "q": self._tag_query(), "stream": "true" }))
+        self.measure("GET /tags/facets", lambda: self.client.get("/tags/facets?limit=20"))
+        self.measure("GET /tags/facets?q=",
+            lambda: self.client.get("/tags/facets", query_string={ "q": self._tag_query(), "limit": 20 }))
+        # Each export reads the whole catalog, so it is measured over fewer requests
+        self.measure("GET /export/companies",
+            lambda: self.client.get("/export/companies"), requests=max(1, self.requests // 40))
+        self.measure("GET /export/companies csv",
+            lambda: self.client.get("/export/companies?format=csv"), requests=max(1, self.requests // 40))
+
+        # Tags created here are the ones assigned and removed by the tag routes
+        created = []
+        def create_tag():
+            name = "bench_%d_%d"%(os.getpid(), len(created))
+            response = self.client.post("/tags", json={ "ko": name, "en": name, "ja": name })
+            created.append(response.get_json()["id"])
+            return response
+        self.measure("POST /tags", create_tag, expected=(201,))
+        bench_tag_ids = created[-self.requests:]
+        bench_tag_names = ["bench_%d_%d"%(os.getpid(), index) for index in range(len(created))]
+
+        # Every tag is assigned once, so that no iteration collides with another
+        pairs = [(choice(self.company_names), name) for name in bench_tag_names]
+        self.measure_pairs("/companies/name/<name>/tag/name/<tag>", pairs,
+            lambda pair: "/companies/name/%s/tag/name/%s?language=en"%pair)
+        pairs = [(choice(self.company_ids), tag_id) for tag_id in created]
+        self.measure_pairs("/companies/<company_uuid>/tag/<tag_uuid>", pairs, lambda pair: "/companies/%s/tag/%s"%pair)
+
+        # Alternates between assigning and removing the same 100 tags
+        operations = [{ "company": company_id, "tag": tag_id } for company_id, tag_id in zip(self.company_ids[:100], bench_tag_ids)]
+        actions = ["add", "remove"]
+        def toggle_batch():
+            action = actions[0]
+            actions.reverse()
+            return self.client.post("/companies/tag/batch",
+                json={ "operations": [dict(operation, action=action) for operation in operations] })
+        self.measure("POST /companies/tag/batch", toggle_batch)
+
+        self.measure("GET /healthz", lambda: self.client.get("/healthz"))
+        self.measure("GET /readyz", lambda: self.client.get("/readyz"))
+        self.measure("GET /internal/caches", lambda: self.client.get("/internal/caches"))
+        self.measure("GET /internal/pool", lambda: self.client.get("/internal/pool"))
+        self.measure("GET /metrics", lambda: self.client.get("/metrics"))
+        return self.results
+
+    """ Measures assigning then removing tags on the (company, tag) pairs """
+    def measure_pairs(self, rule: str, pairs: list, path):
+        remaining = list(pairs)
+        self.measure("POST " + rule, lambda: self.client.post(path(remaining.pop())), expected=(201,))
+        remaining = list(pairs)
+        self.measure("DELETE " + rule, lambda: self.client.delete(path(remaining.pop())), expected=(204,))
+
+    """ A boolean query on sampled tags, as accepted by GET /companies/tags?q= """
+    def _tag_query(self) -> str:
+        first, second, third = (self.random.choice(self.tag_names) for _ in range(3))
+        return '"{}" AND ("{}" OR NOT "{}")'.format(first, second, third)
+
+    """ A short fragment of a sampled company name, as typed into an autocomplete field """
+    def _fragment(self, length=None) -> str:
+        name = self.random.choice(self.company_names)
+        length = length or self.random.randint(1, 3)
+        start = self.random.randint(0, max(0, len(name) - length))
+        return name[start:start + length].strip() or name[0]
+
+def run_benchmark(args) -> dict:
+    # Responses are not cached unless requested, so that latencies measure the work of each route
+    os.environ.setdefault('RESPONSE_CACHE_SIZE', '0' if not args.response_cache else '1024')
+    os.environ['DROP_TABLES_AT_START'] = 'false'
+    os.environ['POPULATE_DATABASE'] = 'false'
+    os.environ.setdefault('CONSOLE_LOG_LEVEL', 'WARNING')
+    # The indexes are rebuilt below once the catalog is repopulated, rather than by the sync thread
+    os.environ.setdefault('TAG_INDEX_SYNC_INTERVAL', '0')
+    sys.path.insert(0, SRC_DIR)
+
+    dataset = None
+    csv_path = args.csv
+    if csv_path == None:
+        import generate
+        csv_path = os.path.join(BENCH_DIR, 'data', 'catalog-%d-%d.csv'%(args.companies, args.seed))
+        if not os.path.exists(csv_path):
+            print("Generating catalog of %d companies"%args.companies, file=sys.stderr)
+        dataset = generate.generate(csv_path, args.companies, seed=args.seed) if not os.path.exists(csv_path) \
+            else { "path": csv_path, "companies": args.companies, "seed": args.seed }
+
+    from app import app
+    from models.models import db
+    from populate import populate_db
+    from services.name_index import name_index
+    from services.tag_index import tag_index
+
+    # Importing app builds the indexes from the previous catalog. Population resets them, so that their
+    # maintenance does not weigh on the measured throughput, and they are built again from the new catalog
+    print("Populating database from %s"%csv_path, file=sys.stderr)
+    populate = populate_db(db, csv_path=csv_path, workers=args.workers)
+    started = time.perf_counter()
+    name_index.build()
+    index_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    tag_index.build()
+    tag_index_seconds = time.perf_counter() - started
+
+    routes = RouteBenchmark(app.test_client(), db, args.requests, seed=args.seed).run()
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "dataset": dataset or { "path": csv_path },
+        "requestsPerRoute": args.requests,
+        "responseCache": args.response_cache,
+        "populate": populate,
+        "nameIndexBuildSeconds": round(index_seconds, 3),
+        "tagIndexBuildSeconds": round(tag_index_seconds, 3),
+        "routes": routes
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark catalog population and route latency")
+    parser.add_argument('--companies', type=int, default=10000, help="size of the generated catalog")
+    parser.add_argument('--csv', default=None, help="benchmark an existing catalog CSV document instead of a generated one")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated catalog and sampled request parameters")
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per route")
+    parser.add_argument('--workers', type=int, default=1, help="ingestion workers used by population")
+    parser.add_argument('--response-cache', action='store_true', help="serve reads through the response cache")
+    parser.add_argument('--output', default=None, help="path of the JSON results, defaults to bench/results/<commit>-<companies>.json")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    output = args.output or os.path.join(BENCH_DIR, 'results', '%s-%s.json'%(results["commit"],
+        args.companies if args.csv == None else os.path.splitext(os.path.basename(args.csv))[0]))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=4)
+    print("Results written to %s"%output, file=sys.stderr)
@@ -2,9 +2,14 @@ import os
 from util import logger
 from models.models import db, initialize_sql
 from flask import Flask
-from populate import purge_db, populate_db
+from populate import purge_db, populate_db, sync_db
+from services import company_documents, index_snapshot, migrations
+from services.name_index import name_index
+from services.tag_index import start_sync, tag_index
 from werkzeug.serving import run_simple
 from router.routes import initialize_routes
+from util.metrics import initialize_metrics
+from util.startup import startup
 
 """
     Core application startup script
@@ -17,13 +22,53 @@ app = Flask(__name__)
 
 initialize_sql(db, app)
 
-if os.environ.get('DROP_TABLES_AT_START').upper() == "TRUE":
-    purge_db(db)
+""" Reports the rows read by population to the start-up status """
+def report_rows(rows: int):
+    startup.update(rows=rows)
 
-if os.environ.get('POPULATE_DATABASE').upper() == "TRUE":
-    populate_db(db)
+steps = []
+if os.environ.get('DROP_TABLES_AT_START', '').upper() == "TRUE":
+    steps.append(("purge", lambda: purge_db(db)))
+
+# POPULATE_DATABASE=true reloads the catalog in full, sync only applies the rows that changed
+if os.environ.get('POPULATE_DATABASE', '').upper() == "TRUE":
+    steps.append(("populate", lambda: populate_db(db, progress=report_rows)))
+elif os.environ.get('POPULATE_DATABASE', '').upper() == "SYNC":
+    steps.append(("sync", lambda: sync_db(db, progress=report_rows)))
+
+steps.append(("migrate", lambda: migrations.migrate(db)))
+steps.append(("documents", lambda: company_documents.ensure_built(db)))
+# With INDEX_SNAPSHOT_DIR set, the indexes are loaded from their snapshots while the database has not
+# changed since they were written, and written after being built otherwise
+steps.append(("name_index", lambda: index_snapshot.load_or_build(name_index, "name_index")))
+steps.append(("tag_index", lambda: index_snapshot.load_or_build(tag_index, "tag_index")))
 
 log.info("Configuring routing")
+initialize_metrics(app)
+initialize_routes(app)
+
+# STARTUP_MODE=background accepts connections right away and runs the start-up steps in a background
+# thread, answering requests with 503 until they are done (see /readyz). The production server answers
+# from its master process until then, and forks the workers once the steps are done so that they share
+# the indexes (see server.run_production)
+background = os.environ.get('STARTUP_MODE', '').lower() == "background"
+
+if background:
+    log.info("Starting up in the background")
+    startup.start(steps)
+else:
+    startup.run(steps)
+
+# Each serving process applies the tag changes committed by the other processes to its tag index. The
+# production workers start syncing once forked (see server.post_fork), as threads do not survive a fork
+if os.environ.get('SERVER_MODE', '').lower() != "production":
+    start_sync()
+
+# SERVER_MODE=production serves through a multi-process, multi-threaded server
+# Otherwise the single process development server is used
 if __name__ == '__main__':
-    initialize_routes(app)
-    run_simple('0.0.0.0', 5000, app, use_reloader=False, use_evalex=True)
\ No newline at end of file
+    if os.environ.get('SERVER_MODE', '').lower() == "production":
+        from server import run_production
+        run_production(app)
+    else:
+        run_simple('0.0.0.0', 5000, app, use_reloader=False, use_evalex=True)
\ No newline at end of file
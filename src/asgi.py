@@ -0,0 +1,173 @@
+import os
+import re
+import time
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.urls import url_decode
+from app import app
+from models.models import async_session, initialize_async_sql
+from router.routes import MAX_LOOKUP_IDS, add_page_cursor, company_dependencies, parse_languages, parse_page_args, \
+    parse_ranked_limit
+from services import async_company_service
+from services.response_cache import response_cache
+from util import logger, metrics
+from util.startup import startup
+from util.errors import InvalidRequestError
+
+"""
+    ASGI entry point, serving the read endpoints from async handlers on the event loop and
+    every other request through the Flask application
+    Responses are serialized by the Flask JSON provider and share the response cache with the
+    Flask routes, so both paths return identical bodies and ETags
+"""
+
+log = logger.create_logger('asgi')
+
+engine = initialize_async_sql()
+flask_application = WsgiToAsgi(app)
+
+""" Handlers of the read endpoints, returning (payload, dependencies) or None for a 404 """
+
+async def get_companies_by_name_auto(args, name):
+    limit, after = parse_page_args(args)
+    languages = parse_languages(args)
+    ranked_limit = parse_ranked_limit(args)
+    if ranked_limit != None:
+        result = await async_company_service.get_companies_by_name_autocomplete(name, ranked_limit, languages=languages)
+        return dict(searchString = name, matches = result), company_dependencies(result)
+    result = await async_company_service.get_companies_by_name_match(name, limit=limit, after=after, languages=languages)
+    payload = add_page_cursor(dict(searchString = name, matches = result), result, limit)
+    return payload, company_dependencies(result)
+
+async def get_companies_by_ids(args):
+    ids = [id.strip() for id in args.get('ids', '').split(',') if len(id.strip()) > 0]
+    if len(ids) == 0:
+        raise InvalidRequestError("ids must list at least one company UUID")
+    if len(ids) > MAX_LOOKUP_IDS:
+        raise InvalidRequestError("At most %s ids may be requested at once"%MAX_LOOKUP_IDS)
+    result = await async_company_service.get_companies_by_id_list(ids, languages=parse_languages(args))
+    missing = [id for id, company in zip(ids, result) if company == None]
+    found = [company for company in result if company != None]
+    return dict(matches = result, missing = missing), company_dependencies(found)
+
+async def get_company_by_id(args, id):
+    result = await async_company_service.get_company_by_id(id, languages=parse_languages(args))
+    if result == None:
+        return None
+    return dict(matches = result), company_dependencies([result])
+
+async def get_companies_by_name_exact(args, name):
+    result = await async_company_service.get_companies_by_name_exact(name, languages=parse_languages(args))
+    return dict(matches = result), company_dependencies(result)
+
+async def get_companies_by_tag(args, tag):
+    limit, after = parse_page_args(args)
+    languages = parse_languages(args)
+    result = await async_company_service.get_companies_by_tag(tag, limit=limit, after=after, languages=languages)
+    async with async_session() as session:
+        tag_ids = await async_company_service.get_tag_ids_by_name(session, tag)
+    payload = add_page_cursor(dict(companies = result), result, limit)
+    return payload, company_dependencies(result, tag_ids=tag_ids, tag_names=[tag])
+
+async def get_companies_by_tag_query(args):
+    query = args.get('q', '')
+    limit, after = parse_page_args(args)
+    languages = parse_languages(args)
+    result, tag_ids = await async_company_service.get_companies_by_tag_query(query, limit=limit, after=after, languages=languages)
+    payload = add_page_cursor(dict(query = query, companies = result), result, limit)
+    referenced_ids = [tag_id for ids in tag_ids.values() for tag_id in ids]
+    referenced_names = [name for name, _ in tag_ids.keys()]
+    return payload, company_dependencies(result, tag_ids=referenced_ids, tag_names=referenced_names)
+
+# Checked in order, mirroring the precedence of the Flask routes
+routes = [
+    ("/companies/name/auto/<name>", get_companies_by_name_auto),
+    ("/companies", get_companies_by_ids),
+    ("/companies/name/<name>", get_companies_by_name_exact),
+    ("/companies/tags", get_companies_by_tag_query),
+    ("/companies/tags/<tag>", get_companies_by_tag),
+    ("/companies/<id>", get_company_by_id)
+]
+route_patterns = [(re.compile(re.sub(r"<[^>]+>", "([^/]+)", rule)), rule, handler) for rule, handler in routes]
+
+"""
+    Finds the route rule, async handler and path parameters for a request, None when Flask
+    serves it, as it does every request until start-up is done
+"""
+def match_route(scope: dict, args):
+    if scope["method"] != "GET" or args.get('stream', '').lower() == "true" or not startup.ready:
+        return None
+    for pattern, rule, handler in route_patterns:
+        match = pattern.fullmatch(scope["path"])
+        if match != None:
+            return rule, handler, match.groups()
+    return None
+
+async def send_response(send, status: int, body: bytes, headers=()) -> int:
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+            + [(b"content-length", str(len(body)).encode("latin-1"))]
+    })
+    await send({ "type": "http.response.body", "body": body })
+    return status
+
+"""
+    Serves a read endpoint through the response cache, keyed the same way as the Flask routes
+    (request path and query) and answering a matching If-None-Match header with a 304
+"""
+async def cached_json_response(scope: dict, send, handler, args, params):
+    query_string = scope.get("query_string", b"").decode("utf-8", "replace")
+    key = "{}?{}".format(scope["path"], query_string)
+    entry = response_cache.get(key)
+    if entry == None:
+        generation = response_cache.generation
+        try:
+            result = await handler(args, *params)
+        except InvalidRequestError as ex:
+            return await send_response(send, 400, ex.message.encode("utf-8"), [("content-type", "text/html; charset=utf-8")])
+        if result == None:
+            return await send_response(send, 404, b"", [("content-type", "text/html; charset=utf-8")])
+        payload, dependencies = result
+        started = time.perf_counter()
+        body = app.json.response(**payload).get_data()
+        metrics.record_serialization(time.perf_counter() - started)
+        entry = response_cache.put(key, body, generation, **dependencies)
+
+    headers = [("etag", quote_etag(entry.etag))]
+    request_headers = dict(scope.get("headers", []))
+    if_none_match = request_headers.get(b"if-none-match")
+    if if_none_match != None and parse_etags(if_none_match.decode("latin-1")).contains(entry.etag):
+        return await send_response(send, 304, b"", headers)
+    return await send_response(send, 200, entry.body, headers + [("content-type", "application/json")])
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({ "type": "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                await engine.dispose()
+                await send({ "type": "lifespan.shutdown.complete" })
+                return
+
+    if scope["type"] == "http":
+        args = url_decode(scope.get("query_string", b""))
+        route = match_route(scope, args)
+        if route != None:
+            rule, handler, params = route
+            stats, token = metrics.begin_request(rule)
+            status = 500
+            try:
+                status = await cached_json_response(scope, send, handler, args, params)
+            finally:
+                metrics.end_request(stats, token, "GET", status)
+            return
+    await flask_application(scope, receive, send)
+
+# Serves the application from a single process event loop with uvicorn
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,32 @@
+# Utility file used to export the company catalog
+import argparse
+import sys
+from models.models import db
+from services import export_service
+
+"""
+Utility script used to export every company of the database configured by DB_URL, as newline
+delimited JSON documents or in the column layout of the catalog CSV, e.g.
+python ./src/export.py --format ndjson --output ./companies.ndjson
+python ./src/export.py --format csv --output ./wanted-temp-data.csv
+"""
+
+if __name__ == '__main__':
+    from flask import Flask
+    from models.models import initialize_sql
+
+    parser = argparse.ArgumentParser(description="Export every company of the catalog")
+    parser.add_argument('--format', choices=list(export_service.FORMATS), default=export_service.NDJSON_FORMAT, help="export format")
+    parser.add_argument('--output', help="path of the file to write, defaults to standard output")
+    parser.add_argument('--batch-size', type=int, default=export_service.EXPORT_BATCH_SIZE, help="companies fetched per round trip")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    initialize_sql(db, app)
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output != None else sys.stdout
+    try:
+        for chunk in export_service.export(db, args.format, app.json.dumps, batch_size=args.batch_size):
+            output.write(chunk)
+    finally:
+        if output != sys.stdout:
+            output.close()
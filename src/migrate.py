@@ -0,0 +1,35 @@
+# Utility file used to migrate the database schema
+import argparse
+import json
+import sys
+from models.models import db
+from services import migrations
+
+"""
+Utility script used to apply the pending schema migrations to the database configured by DB_URL,
+list them, or check that the service queries are served by indexes, e.g.
+python ./src/migrate.py
+python ./src/migrate.py --status
+python ./src/migrate.py --check
+"""
+
+if __name__ == '__main__':
+    from flask import Flask
+    from models.models import initialize_sql
+
+    parser = argparse.ArgumentParser(description="Apply the versioned schema migrations")
+    parser.add_argument('--target', type=int, help="version to migrate up to, defaults to the latest")
+    parser.add_argument('--status', action='store_true', help="list the migrations and whether they are applied")
+    parser.add_argument('--check', action='store_true', help="EXPLAIN the service queries and fail on full scans")
+    args = parser.parse_args()
+
+    initialize_sql(db, Flask(__name__))
+    if args.status:
+        print(json.dumps(migrations.status(db), indent=4))
+    elif args.check:
+        report = migrations.check_query_plans(db)
+        print(json.dumps(report, indent=4))
+        if any(len(entry["fullScans"]) > 0 for entry in report):
+            sys.exit(1)
+    else:
+        print(json.dumps({ "applied": migrations.migrate(db, target=args.target) }, indent=4))
@@ -1,8 +1,12 @@
 import uuid
 import os
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
+from models.pool import engine_options
 from util.logger import create_logger
 
 """
@@ -13,6 +17,9 @@ log = create_logger("models")
 
 db = SQLAlchemy()
 
+# Session factory for the async read paths, bound to an engine by initialize_async_sql
+async_session = sessionmaker(class_=AsyncSession, expire_on_commit=False)
+
 class Company(db.Model):
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     names = db.relationship('CompanyName')
@@ -47,6 +54,62 @@ class TagLocalization(db.Model):
     language = db.Column(db.String(16), primary_key=True)
     name = db.Column(db.String(32), nullable=False)
 
+# On CompanyDocument
+# Reads serve the complete output document of a company, names and tags with their localizations, from this
+# table with a single primary key lookup rather than joining the tables above. Documents are rebuilt by every
+# path that writes companies or company tags, see services/company_documents.py
+
+class CompanyDocument(db.Model):
+    company_id = db.Column(UUID(as_uuid=True), db.ForeignKey('company.id'), primary_key=True)
+    document = db.Column(JSONB, nullable=False)
+
+# On ImportRecord
+# Catalog imports record the content of each CSV row they import, keyed by the first company name of the row,
+# along with a fingerprint of that content, so that syncing a later version of the catalog only writes the rows
+# that changed, see services/ingest_service.py
+
+class ImportRecord(db.Model):
+    key = db.Column(db.String, primary_key=True)
+    company_id = db.Column(UUID(as_uuid=True), db.ForeignKey('company.id'), nullable=False)
+    fingerprint = db.Column(db.String(40), nullable=False)
+    content = db.Column(JSONB, nullable=False)
+
+# On CatalogChange
+# Statement level triggers on the catalog tables (see services/migrations.py) log the transaction of every
+# statement changing them, so that a snapshot of the in-memory indexes can be checked for changes committed
+# since it was built, see services/index_snapshot.py. The first entry of the log identifies the database and
+# records in pruned_below the transaction id below which older entries were deleted
+
+class CatalogChange(db.Model):
+    id = db.Column(db.BigInteger, primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, server_default=db.text("pg_current_xact_id()::text::bigint"))
+    table_name = db.Column(db.String, nullable=False)
+    changed_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    pruned_below = db.Column(db.BigInteger)
+
+# On CompanyTagChange
+# Row level log of the company tag links and companies changed by each transaction, written by triggers with
+# transition tables on company_tags and company (see services/migrations.py), from which every process applies
+# the changes committed by the others to its tag index, see TagIndex.sync. A link entry holds both ids, a new
+# company entry only its company id, and an entry with neither, logged for bulk changes, asks the processes to
+# rebuild their index. Entries are pruned along with catalog_change, below the horizon recorded there
+
+class CompanyTagChange(db.Model):
+    id = db.Column(db.BigInteger, primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, server_default=db.text("pg_current_xact_id()::text::bigint"))
+    company_id = db.Column(UUID(as_uuid=True))
+    tag_id = db.Column(UUID(as_uuid=True))
+
+# On SchemaMigration
+# The schema is created and evolved by the versioned migrations of services/migrations.py rather than by
+# create_all, including the secondary indexes of the lookups above, which are not declared on the models.
+# Each applied migration is recorded in this table
+
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String, nullable=False)
+    applied_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+
 def initialize_sql(db, app: Flask):
     db_url = os.environ.get('DB_URL')
 
@@ -55,6 +118,20 @@ def initialize_sql(db, app: Flask):
         quit(1)
 
     app.config['SQLALCHEMY_DATABASE_URI'] = db_url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
     log.info("Initializing SQLAlchemy")
     db.app = app
     db.init_app(app)
+
+""" Binds async_session to an asyncpg engine for the database configured by DB_URL """
+def initialize_async_sql():
+    db_url = os.environ.get('DB_URL')
+
+    if db_url == None:
+        log.error("No database URL provided. Shutting down.")
+        quit(1)
+
+    log.info("Initializing async SQLAlchemy")
+    engine = create_async_engine(make_url(db_url).set(drivername="postgresql+asyncpg"), **engine_options(async_driver=True))
+    async_session.configure(bind=engine)
+    return engine
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from util.logger import create_logger
+
+"""
+    Environment driven connection pool configuration and pool instrumentation
+"""
+
+log = create_logger("pool")
+
+# Connections kept open by the pool
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+
+# Connections opened beyond POOL_SIZE under load, closed again when returned
+MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))
+
+# Seconds a checkout waits for a connection before failing
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+
+# Seconds after which a connection is replaced on checkout, -1 keeps connections indefinitely
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', -1))
+
+# Tests connections for liveness on checkout, at the cost of a round trip
+POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '').upper() == "TRUE"
+
+# Milliseconds a statement may run for before the server cancels it, 0 for no limit
+STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+# Checkouts waiting longer than this many milliseconds are logged as warnings
+WAIT_WARNING_MS = float(os.environ.get('DB_POOL_WAIT_WARNING_MS', 100))
+
+"""
+    Counters of a pool class, shared by every pool instance of the class so that they survive
+    the pool being recreated by engine.dispose()
+"""
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.overflows = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        # id of the DBAPI connection -> time it was opened
+        self._opened = {}
+
+    def record_checkout(self, seconds: float, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+        if timed_out or seconds * 1000 > WAIT_WARNING_MS:
+            log.warning("Connection checkout waited {:.1f}ms{}".format(seconds * 1000, ", timed out" if timed_out else ""))
+
+    def record_overflow(self):
+        with self._lock:
+            self.overflows += 1
+
+    def connection_opened(self, dbapi_connection):
+        with self._lock:
+            self._opened[id(dbapi_connection)] = time.monotonic()
+
+    def connection_closed(self, dbapi_connection):
+        with self._lock:
+            self._opened.pop(id(dbapi_connection), None)
+
+    """
+        Forgets every open connection, for pools whose connections were dropped without close
+        events, as by engine.dispose(close=False) in a forked worker
+    """
+    def forget_connections(self):
+        with self._lock:
+            self._opened.clear()
+
+    """ Returns the counters along with the current state of the pool """
+    def stats(self, pool) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - opened for opened in self._opened.values()]
+            return {
+                "size": pool.size(),
+                "checkedOut": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+                "maxOverflow": pool._max_overflow,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "overflowEvents": self.overflows,
+                "waitSecondsTotal": round(self.wait_seconds, 6),
+                "waitMillisecondsAverage": round(self.wait_seconds * 1000 / self.checkouts, 3) if self.checkouts > 0 else None,
+                "waitMillisecondsMax": round(self.max_wait_seconds * 1000, 3),
+                "openConnections": len(ages),
+                "connectionAgeSecondsMax": round(max(ages), 3) if len(ages) > 0 else None,
+                "connectionAgeSecondsAverage": round(sum(ages) / len(ages), 3) if len(ages) > 0 else None
+            }
+
+"""
+    Times every checkout, which covers waiting for a free connection as well as opening an
+    overflow connection, and counts connections opened beyond the pool size
+"""
+class InstrumentedPoolMixin:
+    metrics = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        event.listen(self, "connect", lambda dbapi_connection, record: self.metrics.connection_opened(dbapi_connection))
+        event.listen(self, "close", lambda dbapi_connection, record: self.metrics.connection_closed(dbapi_connection))
+        event.listen(self, "close_detached", lambda dbapi_connection: self.metrics.connection_closed(dbapi_connection))
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except TimeoutError:
+            self.metrics.record_checkout(time.perf_counter() - started, timed_out=True)
+            raise
+        self.metrics.record_checkout(time.perf_counter() - started)
+        return connection
+
+    def _inc_overflow(self):
+        created = super()._inc_overflow()
+        # The overflow counter starts at -size, so positive values are connections beyond the pool size
+        if created and self._overflow > 0:
+            self.metrics.record_overflow()
+        return created
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    metrics = PoolMetrics()
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    metrics = PoolMetrics()
+
+"""
+    Engine keyword arguments applying the pool configuration, for the psycopg2 engine or,
+    with async_driver, the asyncpg engine
+"""
+def engine_options(async_driver=False) -> dict:
+    options = {
+        "poolclass": InstrumentedAsyncQueuePool if async_driver else InstrumentedQueuePool,
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+        "pool_pre_ping": POOL_PRE_PING
+    }
+    if STATEMENT_TIMEOUT > 0:
+        if async_driver:
+            options["connect_args"] = { "server_settings": { "statement_timeout": str(STATEMENT_TIMEOUT) } }
+        else:
+            options["connect_args"] = { "options": "-c statement_timeout=%d"%STATEMENT_TIMEOUT }
+    return options
+
+""" Returns the pool metrics of an engine, sync or async """
+def pool_stats(engine) -> dict:
+    pool = getattr(engine, "sync_engine", engine).pool
+    if not isinstance(pool, InstrumentedPoolMixin):
+        return {}
+    return pool.metrics.stats(pool)
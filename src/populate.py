@@ -1,39 +1,76 @@
 # Utility file used to populate database from the wanted_temp_data.csv document
+import argparse
+import json
+import os
 from util.logger import create_logger
 from models.models import db
-from services import company_service
-import csv
+from services import ingest_service, migrations
+from services.name_index import name_index
+from services.tag_cache import tag_cache
+from services.tag_index import tag_index
+from services.response_cache import response_cache
 
 """
 Utility script used to initialize the database from the provided CSV data
+Can be run directly to (re)populate the database configured by DB_URL, e.g.
+python ./src/populate.py --workers 8 --csv ./wanted-temp-data.csv
+or to sync it with a new version of the CSV data, writing only the rows that changed
+python ./src/populate.py --sync --csv ./wanted-temp-data.csv
 """
 
 log = create_logger('populate')
 
+CSV_PATH = os.environ.get('CSV_PATH', './wanted-temp-data.csv')
+
+"""
+    Drops the caches and in-memory indexes of the dropped catalog. The indexes are left unbuilt,
+    so that population does not maintain them row by row, and are built again by start-up
+"""
+def reset_memory():
+    tag_cache.clear()
+    response_cache.clear()
+    name_index.reset()
+    tag_index.reset()
+
 def purge_db(db):
     log.info("Dropping tables")
     db.drop_all()
+    reset_memory()
 
-def populate_db(db):
+def populate_db(db, csv_path=CSV_PATH, workers=ingest_service.WORKERS, progress=None):
     log.info("Running population script")
 
     db.drop_all()
-    db.create_all()
+    migrations.migrate(db)
+    reset_memory()
+
+    log.info("Parsing csv records from %s"%csv_path)
+    report = ingest_service.ingest_csv(db, csv_path, workers=workers, progress=progress)
+
+    log.info("Data sync successful")
+    return report
+
+def sync_db(db, csv_path=CSV_PATH, progress=None):
+    log.info("Running catalog sync")
 
-    with open('./wanted-temp-data.csv') as csv_file:
-        record_count = sum(1 for row in csv_file) - 1
-        log.info("Parsing %s csv records"%record_count)
-        
-    added_records = 0
+    migrations.migrate(db)
 
-    with open('./wanted-temp-data.csv') as csv_file:
-        reader = csv.reader(csv_file)
+    log.info("Syncing csv records from %s"%csv_path)
+    return ingest_service.sync_csv(db, csv_path, progress=progress)
 
-        # Skip header row
-        next(reader, None)
+if __name__ == '__main__':
+    from flask import Flask
+    from models.models import initialize_sql
 
-        for row in reader:
-            company_service.insert_company_from_csv(db, row)
-        csv_file.close()
+    parser = argparse.ArgumentParser(description="Populate the database from a catalog CSV document")
+    parser.add_argument('--csv', default=CSV_PATH, help="path of the catalog CSV document")
+    parser.add_argument('--workers', type=int, default=ingest_service.WORKERS, help="number of parser processes and writer connections")
+    parser.add_argument('--sync', action='store_true', help="only write the rows added or changed since the last import")
+    args = parser.parse_args()
 
-        log.info("Data sync successful")
+    initialize_sql(db, Flask(__name__))
+    if args.sync:
+        report = sync_db(db, csv_path=args.csv)
+    else:
+        report = populate_db(db, csv_path=args.csv, workers=args.workers)
+    print(json.dumps(report, indent=4))
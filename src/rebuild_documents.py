@@ -0,0 +1,24 @@
+# Utility file used to rebuild the company document read model
+import argparse
+import json
+from models.models import db
+from services import company_documents, migrations
+
+"""
+Utility script used to rebuild the document of every company from the normalized tables, for
+backfills of the database configured by DB_URL, e.g.
+python ./src/rebuild_documents.py --batch-size 5000
+"""
+
+if __name__ == '__main__':
+    from flask import Flask
+    from models.models import initialize_sql
+
+    parser = argparse.ArgumentParser(description="Rebuild the company document read model")
+    parser.add_argument('--batch-size', type=int, default=company_documents.REBUILD_BATCH_SIZE, help="companies rebuilt per transaction")
+    args = parser.parse_args()
+
+    initialize_sql(db, Flask(__name__))
+    migrations.migrate(db)
+    report = company_documents.rebuild(db, batch_size=args.batch_size)
+    print(json.dumps(report, indent=4))
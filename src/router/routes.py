@@ -1,8 +1,18 @@
-from flask import Flask, jsonify, request
+import collections
+import itertools
+import os
+import time
+from flask import Flask, Response, current_app, jsonify, request, stream_with_context
+from models.models import async_session, db
+from models.pool import pool_stats
+from util import metrics
 from util import logger
-from services import company_service
+from services import company_service, export_service
+from services.tag_cache import tag_cache
+from services.response_cache import response_cache
 from sqlalchemy.exc import IntegrityError
-from util.errors import AmbiguousRecordError, NotFoundError, UniqueViolationError
+from util.errors import AmbiguousRecordError, InvalidRequestError, NotFoundError, UniqueViolationError
+from util.startup import startup
 
 """
     Contains Flask request routing and response logic
@@ -10,40 +20,275 @@ from util.errors import AmbiguousRecordError, NotFoundError, UniqueViolationErro
 
 log = logger.create_logger('routes')
 
+# Maximum number of operations accepted by a single tag batch request
+MAX_BATCH_OPERATIONS = int(os.environ.get('MAX_BATCH_OPERATIONS', 100000))
+
+# Maximum number of ids accepted by a single company lookup request
+MAX_LOOKUP_IDS = int(os.environ.get('MAX_LOOKUP_IDS', 1000))
+
+# Number of companies returned by ranked autocomplete without a limit, and the largest limit
+DEFAULT_AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 100
+
+# Seconds clients are asked to wait before retrying requests answered while starting up
+STARTUP_RETRY_AFTER = int(os.environ.get('STARTUP_RETRY_AFTER', 5))
+
+""" Whether a path is served before start-up is done: health checks, metrics and internal stats """
+def served_while_starting(path: str) -> bool:
+    return path in ("/healthz", "/readyz", "/metrics") or path.startswith("/internal/")
+
+"""
+    Serves a read endpoint through the response cache, keyed on the request path and query
+    producer returns the response payload along with the dependencies it was built from (see
+    company_dependencies), or None for a 404. Responses carry an ETag, and requests with a
+    matching If-None-Match header receive a 304
+"""
+def cached_json_response(producer):
+    key = request.full_path
+    entry = response_cache.get(key)
+    if entry == None:
+        generation = response_cache.generation
+        result = producer()
+        if result == None:
+            return '', 404
+        payload, dependencies = result
+        started = time.perf_counter()
+        body = jsonify(**payload).get_data()
+        metrics.record_serialization(time.perf_counter() - started)
+        entry = response_cache.put(key, body, generation, **dependencies)
+    response = Response(entry.body, mimetype='application/json')
+    response.set_etag(entry.etag)
+    return response.make_conditional(request)
+
+"""
+    Parses the limit and after keyset pagination query parameters, after being the id of the
+    last company of the previous page
+    args defaults to the query parameters of the current Flask request
+"""
+def parse_page_args(args=None):
+    if args == None:
+        args = request.args
+    limit = args.get('limit', None)
+    after = args.get('after', None)
+    if limit != None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise InvalidRequestError("limit must be a positive integer")
+        limit = int(limit)
+    if after != None:
+        after = company_service.parse_uuid(after)
+        if after == None:
+            raise InvalidRequestError("after must be a company UUID")
+    return limit, after
+
+"""
+    Parses the language query parameter, a comma separated fallback chain of ISO 639-1 codes
+    such as ja,en, returning None when it is absent
+    args defaults to the query parameters of the current Flask request
+"""
+def parse_languages(args=None):
+    if args == None:
+        args = request.args
+    value = args.get('language', None)
+    if value == None:
+        return None
+    languages = list(dict.fromkeys(language.strip().lower() for language in value.split(',') if len(language.strip()) > 0))
+    if len(languages) == 0 or any(language not in company_service.language_set for language in languages):
+        raise InvalidRequestError("language must be a comma separated list of ISO 639-1 language codes")
+    return languages
+
+"""
+    Parses the arguments of ranked autocomplete, requested with ranked=true, returning the
+    number of companies to return, or None when ranking was not requested
+    args defaults to the query parameters of the current Flask request
+"""
+def parse_ranked_limit(args=None):
+    if args == None:
+        args = request.args
+    if args.get('ranked', '').lower() != "true":
+        return None
+    if args.get('after', None) != None or args.get('stream', '').lower() == "true":
+        raise InvalidRequestError("after and stream are not supported by ranked results")
+    limit, _ = parse_page_args(args)
+    if limit == None:
+        return DEFAULT_AUTOCOMPLETE_LIMIT
+    if limit > MAX_AUTOCOMPLETE_LIMIT:
+        raise InvalidRequestError("limit must be at most %s for ranked results"%MAX_AUTOCOMPLETE_LIMIT)
+    return limit
+
+""" Adds the cursor of the following page to a paginated payload """
+def add_page_cursor(payload: dict, companies: list, limit):
+    if limit != None:
+        payload["next"] = companies[-1]["id"] if len(companies) == limit else None
+    return payload
+
+""" Whether the request asked for a streamed response through the stream query parameter """
+def is_streamed() -> bool:
+    return request.args.get('stream', '').lower() == "true"
+
+"""
+    Streams a JSON object whose key holds the companies, written as they are hydrated so that
+    memory use does not grow with the size of the result
+"""
+def streamed_json_response(fields: dict, key: str, companies, limit=None):
+    dumps = current_app.json.dumps
+    if limit != None:
+        companies = itertools.islice(companies, limit)
+
+    def generate():
+        yield "{"
+        for name, value in fields.items():
+            yield "{}:{},".format(dumps(name), dumps(value))
+        yield "{}:[".format(dumps(key))
+        for index, company in enumerate(companies):
+            yield ("," if index > 0 else "") + dumps(company)
+        yield "]}\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+""" Lists the company and tag ids a response containing the companies was built from """
+def company_dependencies(companies: list, tag_ids=(), tag_names=()) -> dict:
+    return {
+        "company_ids": [company["id"] for company in companies],
+        "tag_ids": [tag["id"] for company in companies for tag in company["tags"]] + list(tag_ids),
+        "tag_names": tag_names
+    }
+
 def initialize_routes(app: Flask):
     log.info("Initializing Flask server")
 
+    @app.errorhandler(InvalidRequestError)
+    def handle_invalid_request(ex):
+        return ex.message, 400
+
+    # Until the start-up steps are done, requests are answered with 503 and the start-up status
+    @app.before_request
+    def require_startup():
+        if not startup.ready and not served_while_starting(request.path):
+            response = jsonify(**startup.status())
+            response.status_code = 503
+            response.headers["Retry-After"] = str(STARTUP_RETRY_AFTER)
+            return response
+
+    # Liveness probe, failing only when a start-up step has failed so that the process is replaced
+    @app.get("/healthz")
+    def get_liveness():
+        if startup.failed:
+            return jsonify(status = "failed"), 503
+        return jsonify(status = "alive"), 200
+
+    # Readiness probe, succeeding once the start-up steps are done and reporting the current step
+    # and its progress until then
+    @app.get("/readyz")
+    def get_readiness():
+        return jsonify(**startup.status()), 200 if startup.ready else 503
+
     # Takes a potentially partial string and searches for companies with names matching it
     # Returns JSON payload including the matching names, language tag, and a UUID
     # of the company
     # Any empty array is considered successful
+    # Companies are ordered by id. An optional limit query parameter caps the number of companies
+    # returned and adds a next cursor to the response, which is passed as the after parameter to
+    # fetch the following page. With stream=true the matches are streamed as they are loaded
+    # Every company read endpoint accepts a language parameter, a fallback chain such as ja,en
+    # which limits company names and tag localizations to the first of the languages they
+    # exist in
+    # With ranked=true the best limit (default 10) matches are returned instead, ranked as
+    # prefix matches, word matches, substring matches and then matches with a typo
     @app.get("/companies/name/auto/<name>")
     def get_companies_by_name_auto(name):
-        result = company_service.get_companies_by_name_match(name)
-        return jsonify(searchString = name, matches = result), 200
+        limit, after = parse_page_args()
+        languages = parse_languages()
+        ranked_limit = parse_ranked_limit()
+        if ranked_limit != None:
+            def produce_ranked():
+                result = company_service.get_companies_by_name_autocomplete(name, ranked_limit, languages=languages)
+                return dict(searchString = name, matches = result), company_dependencies(result)
+            return cached_json_response(produce_ranked)
+        if is_streamed():
+            companies = company_service.iter_companies_by_name_match(name, after=after, languages=languages)
+            return streamed_json_response(dict(searchString = name), "matches", companies, limit=limit)
+        def produce():
+            result = company_service.get_companies_by_name_match(name, limit=limit, after=after, languages=languages)
+            payload = add_page_cursor(dict(searchString = name, matches = result), result, limit)
+            return payload, company_dependencies(result)
+        return cached_json_response(produce)
+
+    # Retrieves multiple company records by UUID value, given as a comma separated ids
+    # query parameter. Matches are returned in request order, with null in place of ids
+    # that do not match a company, which are also listed under missing
+    @app.get("/companies")
+    def get_companies_by_ids():
+        ids = [id.strip() for id in request.args.get('ids', '').split(',') if len(id.strip()) > 0]
+        if len(ids) == 0:
+            raise InvalidRequestError("ids must list at least one company UUID")
+        if len(ids) > MAX_LOOKUP_IDS:
+            raise InvalidRequestError("At most %s ids may be requested at once"%MAX_LOOKUP_IDS)
+        languages = parse_languages()
+        def produce():
+            result = company_service.get_companies_by_id_list(ids, languages=languages)
+            missing = [id for id, company in zip(ids, result) if company == None]
+            found = [company for company in result if company != None]
+            return dict(matches = result, missing = missing), company_dependencies(found)
+        return cached_json_response(produce)
 
     # Retrieves company record by UUID value
     @app.get("/companies/<id>")
     def get_company_by_id(id):
-        result = company_service.get_company_by_id(id)
-        if result != None:
-            return jsonify(matches = result), 200
-        else:
-            return None, 404
+        languages = parse_languages()
+        def produce():
+            result = company_service.get_company_by_id(id, languages=languages)
+            if result == None:
+                return None
+            return dict(matches = result), company_dependencies([result])
+        return cached_json_response(produce)
 
     # Searches for exact matches using the provided company name
     # The result will contain a JSON payload with array data as the same company
     # name could be used in different regions
     @app.get("/companies/name/<name>")
     def get_companies_by_name_exact(name):
-        result = company_service.get_companies_by_name_exact(name)
-        return jsonify(matches = result)
+        languages = parse_languages()
+        def produce():
+            result = company_service.get_companies_by_name_exact(name, languages=languages)
+            return dict(matches = result), company_dependencies(result)
+        return cached_json_response(produce)
 
     # Retrieves companies by tag name
+    # Supports the same limit, after and stream parameters as the partial name search
     @app.get("/companies/tags/<tag>")
     def get_companies_by_tag(tag):
-        result = company_service.get_companies_by_tag(tag)
-        return jsonify(companies = result)
+        limit, after = parse_page_args()
+        languages = parse_languages()
+        if is_streamed():
+            companies = company_service.iter_companies_by_tag(tag, after=after, languages=languages)
+            return streamed_json_response({}, "companies", companies, limit=limit)
+        def produce():
+            result = company_service.get_companies_by_tag(tag, limit=limit, after=after, languages=languages)
+            tag_ids = company_service.get_tag_ids_by_name(tag)
+            payload = add_page_cursor(dict(companies = result), result, limit)
+            return payload, company_dependencies(result, tag_ids=tag_ids, tag_names=[tag])
+        return cached_json_response(produce)
+
+    # Retrieves companies matching a boolean tag query given as the q query parameter, e.g.
+    # q=tag_4 AND (tag_20 OR en:tag_16) NOT tag_3. Tags are combined with AND, OR, NOT and
+    # parentheses, names containing spaces are quoted and a language: prefix matches only the
+    # tag name in that language. Supports the same limit, after and stream parameters as the
+    # single tag search
+    @app.get("/companies/tags")
+    def get_companies_by_tag_query():
+        query = request.args.get('q', '')
+        limit, after = parse_page_args()
+        languages = parse_languages()
+        if is_streamed():
+            companies = company_service.iter_companies_by_tag_query(query, after=after, languages=languages)
+            return streamed_json_response(dict(query = query), "companies", companies, limit=limit)
+        def produce():
+            result, tag_ids = company_service.get_companies_by_tag_query(query, limit=limit, after=after, languages=languages)
+            payload = add_page_cursor(dict(query = query, companies = result), result, limit)
+            referenced_ids = [tag_id for ids in tag_ids.values() for tag_id in ids]
+            referenced_names = [name for name, _ in tag_ids.keys()]
+            return payload, company_dependencies(result, tag_ids=referenced_ids, tag_names=referenced_names)
+        return cached_json_response(produce)
 
 
     # Add existing tags to a company
@@ -99,6 +344,25 @@ def initialize_routes(app: Flask):
             return ex.message, 400
 
 
+    # Applies a batch of tag additions and removals by UUID
+    # Expects a JSON body of the form { "operations": [{ "action": "add", "company": uuid, "tag": uuid }] }
+    # with an optional chunkSize to commit every chunkSize operations rather than in a single
+    # transaction. Returns a result for every operation in request order
+    @app.post("/companies/tag/batch")
+    def apply_company_tag_batch():
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("operations"), list):
+            raise InvalidRequestError("Expected a JSON body with an operations list")
+        if len(data["operations"]) > MAX_BATCH_OPERATIONS:
+            raise InvalidRequestError("At most %s operations may be submitted per request"%MAX_BATCH_OPERATIONS)
+        chunk_size = data.get("chunkSize", None)
+        if chunk_size != None and (not isinstance(chunk_size, int) or chunk_size < 1):
+            raise InvalidRequestError("chunkSize must be a positive integer")
+
+        results = company_service.apply_company_tag_operations(data["operations"], chunk_size=chunk_size)
+        summary = collections.Counter(result["status"] for result in results)
+        return jsonify(results = results, summary = summary), 200
+
     # Insertion of completely new tags
     # Expects a JSON payload in body defining names in each language
     @app.post("/tags")
@@ -106,3 +370,52 @@ def initialize_routes(app: Flask):
         data = request.get_json()
         result = company_service.create_tag(data)
         return jsonify(result), 201
+
+    # Number of companies holding each tag, ordered by descending count, for faceted navigation
+    # An optional q tag query (as for /companies/tags) limits the count to the matching
+    # companies and leaves out the tags it references, listing the tags co-occurring with a
+    # selection. language projects the tag localizations as on the company endpoints, and limit
+    # caps the number of facets. Counted from the tag index, which applies the tag changes of
+    # other processes within a sync interval (see TagIndex.sync), and not cached since any
+    # change to a tag assignment may change the counts
+    @app.get("/tags/facets")
+    def get_tag_facets():
+        limit, _ = parse_page_args()
+        query = request.args.get('q', None)
+        languages = parse_languages()
+        result = company_service.get_tag_facets(query, languages=languages, limit=limit)
+        return jsonify(**result), 200
+
+    # Streams every company, as newline delimited JSON documents (format=ndjson, the default)
+    # or in the column layout of the catalog CSV (format=csv), which population imports back.
+    # language projects the names and tags of NDJSON documents as on the company endpoints
+    @app.get("/export/companies")
+    def export_companies():
+        format = request.args.get('format', export_service.NDJSON_FORMAT).lower()
+        if format not in export_service.FORMATS:
+            raise InvalidRequestError("format must be one of {}".format(", ".join(export_service.FORMATS)))
+        languages = parse_languages()
+        if format == export_service.CSV_FORMAT and languages != None:
+            raise InvalidRequestError("language is not supported by CSV exports")
+        chunks = export_service.export(db, format, current_app.json.dumps, languages=languages)
+        return Response(stream_with_context(chunks), mimetype=export_service.FORMATS[format])
+
+    # Hit, miss and size counters of the in-process caches
+    @app.get("/internal/caches")
+    def get_cache_stats():
+        return jsonify(tags = tag_cache.stats(), responses = response_cache.stats())
+
+    # Saturation counters of the database connection pools, telling an exhausted pool (growing
+    # checkout waits and timeouts) apart from slow queries (long checkouts with short waits)
+    @app.get("/internal/pool")
+    def get_pool_stats():
+        pools = dict(sync = pool_stats(db.engine))
+        async_engine = async_session.kw.get("bind")
+        if async_engine != None:
+            pools["async"] = pool_stats(async_engine)
+        return jsonify(**pools)
+
+    # Request latency, SQL and serialization metrics in the Prometheus text format
+    @app.get("/metrics")
+    def get_metrics():
+        return Response(metrics.metrics.render(), mimetype='text/plain; version=0.0.4')
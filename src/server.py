@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import socket
+import threading
+from flask import Flask
+from gunicorn.app.base import BaseApplication
+from werkzeug.serving import make_server
+from models.models import db
+from models.pool import InstrumentedQueuePool
+from services.tag_index import start_sync
+from util import logger
+from util.startup import startup
+
+"""
+    Production serving mode, running the application in a pre-forked gunicorn server
+    with a pool of threads in each worker process
+"""
+
+log = logger.create_logger('server')
+
+""" Reads the gunicorn configuration from the environment """
+def production_options() -> dict:
+    return {
+        "bind": "0.0.0.0:%s"%os.environ.get('PORT', 5000),
+        "workers": int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1)),
+        "threads": int(os.environ.get('WEB_THREADS', 4)),
+        "worker_class": "gthread",
+        "timeout": int(os.environ.get('WEB_TIMEOUT', 30)),
+        "graceful_timeout": int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30)),
+        "keepalive": int(os.environ.get('WEB_KEEPALIVE', 5)),
+        # The application, including population and index builds, is loaded once in the master
+        # and inherited by the workers
+        "preload_app": True,
+        "post_fork": post_fork
+    }
+
+"""
+    Runs in each worker after it is forked from the master
+    Connections opened by the master are dropped from the worker's pool without being closed,
+    as the sockets are shared with the master, so every worker opens its own connections.
+    Dropping them fires no close events, so the master's connections are also removed from
+    the inherited pool metrics. Each worker then keeps its tag index in sync with the changes
+    committed by the other workers
+"""
+def post_fork(server, worker):
+    db.engine.dispose(close=False)
+    InstrumentedQueuePool.metrics.forget_connections()
+    start_sync()
+    log.info("Worker %s initialized database engine"%worker.pid)
+
+class ProductionServer(BaseApplication):
+    def __init__(self, app: Flask, options: dict):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+"""
+    Serves the application from the master process on the listening socket while the start-up
+    steps run in the background, so that the health checks answer and other requests receive
+    a 503 before the workers are forked. Returns once the steps are done, leaving the socket
+    open for gunicorn, and keeps serving the failure when a step fails
+"""
+def serve_during_startup(app: Flask, listener: socket.socket):
+    server = make_server("0.0.0.0", listener.getsockname()[1], app, threaded=True, fd=listener.fileno())
+    thread = threading.Thread(target=server.serve_forever, name="startup-server", daemon=True)
+    thread.start()
+    log.info("Answering from the master process while starting up")
+    startup.wait()
+    server.shutdown()
+    # Closes the server's duplicate of the listening socket once its requests are answered
+    server.server_close()
+
+"""
+    Serves the application until the master process is stopped
+    With STARTUP_MODE=background, the master binds the port and answers while the start-up steps
+    run, then hands the socket over to gunicorn, so connections queue rather than being refused
+    Sending SIGHUP to the master gracefully replaces the workers, and SIGTERM drains
+    in-flight requests before shutting down
+"""
+def run_production(app: Flask):
+    options = production_options()
+    if not startup.ready:
+        listener = socket.create_server(("0.0.0.0", int(os.environ.get('PORT', 5000))), backlog=2048)
+        serve_during_startup(app, listener)
+        options["bind"] = "fd://%s"%listener.fileno()
+    log.info("Starting production server with %s workers of %s threads"%(options["workers"], options["threads"]))
+    ProductionServer(app, options).run()
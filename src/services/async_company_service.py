@@ -0,0 +1,105 @@
+from sqlalchemy import select
+from models.models import Company, async_session
+from util import logger
+from services.company_service import HYDRATION_BATCH_SIZE, chunked, documents_in_order, name_exact_query, \
+    name_match_query, name_rank_query, normalize_company_ids, paginate_company_ids, parse_uuid, tag_companies_query
+from services.company_documents import documents_query
+from services.name_index import name_index
+from services.tag_cache import tag_cache
+from services.tag_index import tag_index
+from services import tag_query
+
+"""
+    Async versions of the company read paths, executing the statements of company_service
+    through an asyncpg backed AsyncSession so that a single event loop can keep many
+    requests waiting on the database at once
+"""
+
+log = logger.create_logger('async_company_service')
+
+""" Version of company_service.hydrate_companies issuing its queries through the session """
+async def hydrate_companies(session, company_ids: list, languages=None):
+    ordered_ids = normalize_company_ids(company_ids)
+    rows = []
+    for batch in chunked(ordered_ids, HYDRATION_BATCH_SIZE):
+        rows.extend(await session.execute(documents_query(batch)))
+    return documents_in_order(ordered_ids, rows, languages=languages)
+
+""" Get company by UUID value """
+async def get_company_by_id(id: str, languages=None):
+    async with async_session() as session:
+        result = await hydrate_companies(session, [id], languages=languages)
+    if len(result) == 0:
+        return None
+    return result[0]
+
+"""
+    Get companies for a list of UUID values, returning one entry per requested id in request
+    order with None for ids without a company
+"""
+async def get_companies_by_id_list(ids: list, languages=None):
+    async with async_session() as session:
+        companies = dict((company["id"], company) for company in await hydrate_companies(session, ids, languages=languages))
+    return [companies.get(parse_uuid(id)) for id in ids]
+
+""" Get companies which exactly match the input company name """
+async def get_companies_by_name_exact(name: str, languages=None):
+    async with async_session() as session:
+        result = await session.execute(name_exact_query(name))
+        return await hydrate_companies(session, [row.company_id for row in result], languages=languages)
+
+"""
+    Get companies with a name containing the input string, ordered by company id with limit
+    and after pagination. Matches come from the in-memory name index once it has been built
+"""
+async def get_companies_by_name_match(name: str, limit=None, after=None, languages=None):
+    async with async_session() as session:
+        if name_index.ready:
+            company_ids = name_index.search(name, limit=limit, after=after)
+        else:
+            result = await session.execute(name_match_query(name, limit, after))
+            company_ids = [row.company_id for row in result]
+        log.debug("Searching for companies with name contains {}, {} records returned".format(name, len(company_ids)))
+        return await hydrate_companies(session, company_ids, languages=languages)
+
+""" Ranked autocomplete, as company_service.get_companies_by_name_autocomplete """
+async def get_companies_by_name_autocomplete(name: str, limit: int, languages=None):
+    async with async_session() as session:
+        if name_index.ready:
+            company_ids = name_index.autocomplete(name, limit)
+        else:
+            company_ids = [row.company_id for row in await session.execute(name_rank_query(name, limit))]
+        return await hydrate_companies(session, company_ids, languages=languages)
+
+"""
+    Get companies which have a tag with a localization matching the input tag name, ordered by
+    company id with limit and after pagination
+"""
+async def get_companies_by_tag(tag_name: str, limit=None, after=None, languages=None):
+    async with async_session() as session:
+        tag_uuids = await get_tag_ids_by_name(session, tag_name)
+        if len(tag_uuids) == 0:
+            return []
+        result = await session.execute(tag_companies_query(tag_uuids, limit, after))
+        return await hydrate_companies(session, [row.company_id for row in result], languages=languages)
+
+"""
+    Get companies matching a boolean tag query, along with the tag ids of each of its tag
+    references, as company_service.get_companies_by_tag_query
+"""
+async def get_companies_by_tag_query(query: str, limit=None, after=None, languages=None):
+    node = tag_query.parse(query)
+    async with async_session() as session:
+        tag_ids = {}
+        for name, language in tag_query.tag_references(node):
+            tag_ids[(name, language)] = await get_tag_ids_by_name(session, name, language=language)
+        if tag_index.ready:
+            company_ids = tag_index.search(node, tag_ids, limit=limit, after=after)
+        else:
+            statement = select(Company.id).where(tag_query.company_condition(node, tag_ids))
+            company_ids = [row.id for row in await session.execute(paginate_company_ids(statement, Company.id, limit, after))]
+        return await hydrate_companies(session, company_ids, languages=languages), tag_ids
+
+""" Resolves tag ids by name through the tag dictionary cache """
+async def get_tag_ids_by_name(session, tag_name: str, language=None):
+    return await tag_cache.get_tag_ids_async(session, tag_name, language=language)
@@ -0,0 +1,114 @@
+import time
+import uuid
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.dialects.postgresql import UUID
+from models.models import Company, CompanyDocument
+from util import logger
+
+"""
+    Maintenance of the company document read model, one pre-built output document per company
+    Documents are built inside the database from the normalized tables, so refreshing a batch of
+    companies costs a single statement, and are written in the transaction changing the companies
+"""
+
+log = logger.create_logger('company_documents')
+
+# Number of companies whose documents are rebuilt per transaction by a backfill
+REBUILD_BATCH_SIZE = 5000
+
+# Builds and upserts the documents of the companies, holding the company id, a map of language
+# to company name and a list of tags, each with its id and a map of language to tag name
+REFRESH_STATEMENT = text("""
+    INSERT INTO company_document (company_id, document)
+    SELECT company.id, jsonb_build_object(
+        'id', company.id,
+        'names', COALESCE((
+            SELECT jsonb_object_agg(company_name.language, company_name.name)
+            FROM company_name WHERE company_name.company_id = company.id
+        ), '{}'::jsonb),
+        'tags', COALESCE((
+            SELECT jsonb_agg(jsonb_build_object(
+                'id', company_tags.tag_id,
+                'localizations', COALESCE((
+                    SELECT jsonb_object_agg(tag_localization.language, tag_localization.name)
+                    FROM tag_localization WHERE tag_localization.tag_id = company_tags.tag_id
+                ), '{}'::jsonb)
+            ))
+            FROM company_tags WHERE company_tags.company_id = company.id
+        ), '[]'::jsonb)
+    )
+    FROM company WHERE company.id IN :company_ids
+    ON CONFLICT (company_id) DO UPDATE SET document = excluded.document
+""").bindparams(bindparam('company_ids', expanding=True, type_=UUID(as_uuid=True)))
+
+"""
+    Rebuilds the documents of the provided companies through a session or connection, within
+    its current transaction. Pending ORM changes must be flushed beforehand
+"""
+def refresh(connection, company_ids):
+    company_ids = list(set(company_ids))
+    for start in range(0, len(company_ids), REBUILD_BATCH_SIZE):
+        connection.execute(REFRESH_STATEMENT, { "company_ids": company_ids[start:start + REBUILD_BATCH_SIZE] })
+
+""" Statement loading the documents of a batch of company ids """
+def documents_query(company_ids: list):
+    return select(CompanyDocument.company_id, CompanyDocument.document).where(CompanyDocument.company_id.in_(company_ids))
+
+"""
+    Converts a stored document back into service output, with UUID company and tag ids
+    With a languages fallback chain, the company names and the localizations of each tag are
+    limited to the first language of the chain they exist in
+"""
+def from_document(document: dict, languages=None) -> dict:
+    document["id"] = uuid.UUID(document["id"])
+    document["names"] = project_localizations(document["names"], languages)
+    for tag in document["tags"]:
+        tag["id"] = uuid.UUID(tag["id"])
+        tag["localizations"] = project_localizations(tag["localizations"], languages)
+    return document
+
+""" Reduces a map of language to name to the first language of the fallback chain present in it """
+def project_localizations(localizations: dict, languages=None) -> dict:
+    if languages == None:
+        return localizations
+    for language in languages:
+        if language in localizations:
+            return { language: localizations[language] }
+    return {}
+
+"""
+    Rebuilds the document of every company in batches of batch_size, one transaction per batch,
+    for backfills after the read model is introduced or its format changes
+"""
+def rebuild(db, batch_size=REBUILD_BATCH_SIZE) -> dict:
+    started = time.perf_counter()
+    companies = 0
+    after = None
+    while True:
+        query = select(Company.id).order_by(Company.id).limit(batch_size)
+        if after != None:
+            query = query.where(Company.id > after)
+        with db.engine.begin() as connection:
+            company_ids = [row.id for row in connection.execute(query)]
+            if len(company_ids) == 0:
+                break
+            refresh(connection, company_ids)
+        companies += len(company_ids)
+        after = company_ids[-1]
+        log.debug("Rebuilt {} company documents".format(companies))
+
+    report = { "companies": companies, "seconds": round(time.perf_counter() - started, 3) }
+    log.info("Rebuilt {companies} company documents in {seconds}s".format(**report))
+    return report
+
+"""
+    Backfills the documents of a database populated before the read model was introduced, when
+    companies exist but none of their documents do
+"""
+def ensure_built(db):
+    with db.engine.connect() as connection:
+        has_companies = connection.execute(select(Company.id).limit(1)).first() != None
+        has_documents = connection.execute(select(CompanyDocument.company_id).limit(1)).first() != None
+    if has_companies and not has_documents:
+        log.info("No company documents found, rebuilding")
+        rebuild(db)
@@ -1,10 +1,19 @@
+import bisect
+import uuid
 from models.models import CompanyName, Company, CompanyTags, Tag, TagLocalization
-from sqlalchemy import func
+from sqlalchemy import case, func, select, tuple_
+from sqlalchemy.dialects import postgresql
 from models.models import db
 from sqlalchemy.exc import IntegrityError
 from util import logger
 from util.errors import AmbiguousRecordError, NotFoundError, UniqueViolationError
 from util.iso639_1 import languages as iso639_1
+from services.name_index import name_index
+from services.tag_cache import tag_cache
+from services.tag_index import tag_index
+from services import tag_query
+from services.response_cache import response_cache
+from services import company_documents
 
 """
     Contains internal service logic relating to companies and tags
@@ -13,105 +22,280 @@ from util.iso639_1 import languages as iso639_1
 log = logger.create_logger('company_service')
 language_set = set(map(lambda lang:lang[0], iso639_1))
 
+# Maximum number of company ids loaded per round of hydration queries
+HYDRATION_BATCH_SIZE = 1000
+
+# Number of companies hydrated at a time when streaming a response
+STREAM_BATCH_SIZE = 500
+
 """ 
     Used to search for companies using incomplete company names
     Will return a list of companies which includes companies with names that match the input
-    string in any stored language
+    string in any stored language, ordered by company id
+    When provided, limit caps the number of companies returned and after (a company id)
+    skips to companies following it, for keyset pagination
+"""
+def get_companies_by_name_match(name: str, limit=None, after=None, languages=None):
+    return hydrate_companies(get_company_ids_by_name_match(name, limit=limit, after=after), languages=languages)
+
+"""
+    Ids of the companies matched by get_companies_by_name_match
+    Served from the in-memory name index once it has been built, falling back to a
+    database scan otherwise
 """
-def get_companies_by_name_match(name: str):
+def get_company_ids_by_name_match(name: str, limit=None, after=None):
+    if name_index.ready:
+        company_ids = name_index.search(name, limit=limit, after=after)
+        log.debug("Searching name index for companies with name contains {}, {} records returned".format(name, len(company_ids)))
+        return company_ids
+
+    company_ids = [row.company_id for row in db.session.execute(name_match_query(name, limit, after))]
+    log.debug("Searching for companies with name contains {}, {} records returned".format(name, len(company_ids)))
+    return company_ids
+
+""" Statement selecting a page of the ids of companies with a name containing the string """
+def name_match_query(name: str, limit=None, after=None):
     search_string = '%{}%'.format(name).lower()
-    query = CompanyName.query.filter(func.lower(CompanyName.name).ilike("%{}%".format(name)))
-    result = query.all()
-    log.debug("Searching for companies with name contains {}, {} records returned".format(search_string, len(result)))
-    return format_company_list_output(map(lambda c:c.company, result))
+    query = select(CompanyName.company_id).where(func.lower(CompanyName.name).ilike(search_string))
+    return paginate_company_ids(query, CompanyName.company_id, limit, after)
+
+"""
+    Ranked autocomplete, returning up to limit companies with a name matching the input string
+    with the best matches first: prefix matches, then word matches, then substring matches and
+    then matches with typos (see NameIndex.autocomplete)
+"""
+def get_companies_by_name_autocomplete(name: str, limit: int, languages=None):
+    return hydrate_companies(get_company_ids_by_name_autocomplete(name, limit), languages=languages)
+
+"""
+    Ids of the companies matched by get_companies_by_name_autocomplete
+    Until the name index is built, matches are ranked by the database without typo tolerance
+"""
+def get_company_ids_by_name_autocomplete(name: str, limit: int):
+    if name_index.ready:
+        return name_index.autocomplete(name, limit)
+    return [row.company_id for row in db.session.execute(name_rank_query(name, limit))]
+
+""" Statement selecting the ids of the limit companies best matching the name, prefix matches first """
+def name_rank_query(name: str, limit: int):
+    key = name.lower()
+    lowered = func.lower(CompanyName.name)
+    rank = case((lowered.like('{}%'.format(key)), 0), (lowered.like('% {}%'.format(key)), 1), else_=2)
+    return select(CompanyName.company_id).where(lowered.like('%{}%'.format(key))) \
+        .group_by(CompanyName.company_id) \
+        .order_by(func.min(rank), func.min(lowered), CompanyName.company_id).limit(limit)
+
+"""
+    Yields every company matched by get_companies_by_name_match after the provided company id,
+    hydrating them in batches
+"""
+def iter_companies_by_name_match(name: str, after=None, languages=None):
+    if name_index.ready:
+        # The index resolves every matching id at once, so batches are sliced from that list
+        company_ids = name_index.search(name, after=after)
+
+        def fetch_ids(limit, after):
+            start = 0 if after == None else bisect.bisect_right(company_ids, after)
+            return company_ids[start:start + limit]
+    else:
+        def fetch_ids(limit, after):
+            return get_company_ids_by_name_match(name, limit=limit, after=after)
+    return iter_companies(fetch_ids, after=after, languages=languages)
+
+""" Applies distinct company id ordering and keyset pagination to a company id statement """
+def paginate_company_ids(query, column, limit=None, after=None):
+    query = query.distinct().order_by(column)
+    if after != None:
+        query = query.where(column > after)
+    if limit != None:
+        query = query.limit(limit)
+    return query
+
+"""
+    Yields the companies of a company id source one at a time, hydrating them in batches
+    fetch_ids is called with (limit, after) and returns company ids in ascending order, so
+    that memory use stays bounded by batch_size whatever the size of the result
+"""
+def iter_companies(fetch_ids, after=None, batch_size=STREAM_BATCH_SIZE, languages=None):
+    while True:
+        company_ids = fetch_ids(batch_size, after)
+        for company in hydrate_companies(company_ids, languages=languages):
+            yield company
+        if len(company_ids) < batch_size:
+            return
+        after = company_ids[-1]
+
+"""
+    Get companies for a list of UUID values in a single round of hydration queries
+    Returns one entry per requested id in request order, None for ids without a company
+"""
+def get_companies_by_id_list(ids: list, languages=None):
+    companies = dict((company["id"], company) for company in hydrate_companies(ids, languages=languages))
+    return [companies.get(parse_uuid(id)) for id in ids]
 
 """ Get company by UUID value """
-def get_company_by_id(id: str):
-    result = Company.query.filter_by(id=id).first()
-    return format_company_output(result)
+def get_company_by_id(id: str, languages=None):
+    result = hydrate_companies([id], languages=languages)
+    if len(result) == 0:
+        return None
+    return result[0]
 
 """ 
     Get companies which exactly match the input company name
     Returned as a list, as it is possible that the same name could be used between different
     locations
 """
-def get_companies_by_name_exact(name: str):
-    result = CompanyName.query.filter_by(name=name).all()
-    return format_company_list_output(map(lambda c:c.company, result))
+def get_companies_by_name_exact(name: str, languages=None):
+    result = db.session.execute(name_exact_query(name))
+    return hydrate_companies([row.company_id for row in result], languages=languages)
+
+""" Statement selecting the ids of companies with a name exactly matching the input """
+def name_exact_query(name: str):
+    return select(CompanyName.company_id).where(CompanyName.name == name).distinct()
+
+"""
+    Get companies which have a tag with a localization matching the input tag name, ordered
+    by company id, with the same limit and after pagination as get_companies_by_name_match
+"""
+def get_companies_by_tag(tag_name: str, limit=None, after=None, languages=None):
+    return hydrate_companies(get_company_ids_by_tag(tag_name, limit=limit, after=after), languages=languages)
+
+"""
+    Yields every company matched by get_companies_by_tag after the provided company id,
+    hydrating them in batches
 """
+def iter_companies_by_tag(tag_name: str, after=None, languages=None):
+    fetch_ids = lambda limit, after: get_company_ids_by_tag(tag_name, limit=limit, after=after)
+    return iter_companies(fetch_ids, after=after, languages=languages)
 
+""" Ids of the companies matched by get_companies_by_tag """
+def get_company_ids_by_tag(tag_name: str, limit=None, after=None):
+    tag_uuids = get_tag_ids_by_name(tag_name)
+    if len(tag_uuids) == 0:
+        return []
+    return [row.company_id for row in db.session.execute(tag_companies_query(tag_uuids, limit, after))]
+
+"""
+    Get companies matching a boolean tag query such as tag_4 AND (tag_20 OR en:tag_16) NOT tag_3
+    (see tag_query), ordered by company id with limit and after pagination
+    Returns the companies along with a map of each tag reference of the query to its tag ids
+"""
+def get_companies_by_tag_query(query: str, limit=None, after=None, languages=None):
+    node, tag_ids = resolve_tag_query(query)
+    company_ids = get_company_ids_by_tag_query(node, tag_ids, limit=limit, after=after)
+    return hydrate_companies(company_ids, languages=languages), tag_ids
+
+"""
+    Yields every company matched by get_companies_by_tag_query after the provided company id,
+    hydrating them in batches
 """
-def get_companies_by_tag(tag_name: str):
-    tag_localization = TagLocalization.query.filter_by(name=tag_name).all()
-    tag_uuids = map(lambda tl:tl.tag_id, tag_localization)
-    if tag_localization != None:
-        company_tags = CompanyTags.query.filter(CompanyTags.tag_id.in_(tag_uuids)).all()
-        log.info(company_tags)
-        return format_company_list_output(map(lambda t:t.company, company_tags))
+def iter_companies_by_tag_query(query: str, after=None, languages=None):
+    node, tag_ids = resolve_tag_query(query)
+    fetch_ids = lambda limit, after: get_company_ids_by_tag_query(node, tag_ids, limit=limit, after=after)
+    return iter_companies(fetch_ids, after=after, languages=languages)
+
+"""
+    Parses a tag query and resolves each of its tag references to tag ids through the tag
+    dictionary cache, raising InvalidRequestError when the query is malformed
+"""
+def resolve_tag_query(query: str):
+    node = tag_query.parse(query)
+    tag_ids = {}
+    for name, language in tag_query.tag_references(node):
+        tag_ids[(name, language)] = get_tag_ids_by_name(name, language=language)
+    return node, tag_ids
+
+"""
+    Ids of the companies matched by a parsed tag query
+    Evaluated against the in-memory tag index once it has been built, falling back to a
+    database query otherwise
+"""
+def get_company_ids_by_tag_query(node: tuple, tag_ids: dict, limit=None, after=None):
+    if tag_index.ready:
+        return tag_index.search(node, tag_ids, limit=limit, after=after)
+    query = select(Company.id).where(tag_query.company_condition(node, tag_ids))
+    return [row.id for row in db.session.execute(paginate_company_ids(query, Company.id, limit, after))]
+
+"""
+    Counts the companies holding each tag, limited to the companies matching a tag query when
+    one is provided, in which case the tags referenced by the query are left out
+    Facets are ordered by descending count and capped at limit, each with the tag id, its
+    count and its localizations, projected onto the languages fallback chain when provided
+    Counts are read from the tag index once it is ready, so they reflect the changes made by
+    other processes within a sync interval, and from the database until then
+"""
+def get_tag_facets(query=None, languages=None, limit=None):
+    node, tag_ids = resolve_tag_query(query) if query != None else (None, {})
+    if tag_index.ready:
+        counts, total = tag_index.facet_counts(node, tag_ids)
     else:
+        counts, total = get_tag_facet_counts(node, tag_ids)
+
+    selected = set(tag_id for ids in tag_ids.values() for tag_id in ids)
+    facets = sorted((item for item in counts.items() if item[0] not in selected), key=lambda item: (-item[1], str(item[0])))
+    if limit != None:
+        facets = facets[:limit]
+    localizations = tag_cache.get_localizations([tag_id for tag_id, _ in facets])
+    output = []
+    for tag_id, count in facets:
+        tag_localizations = company_documents.project_localizations(localizations.get(tag_id, {}), languages)
+        output.append({ "id": tag_id, "count": count, "localizations": tag_localizations })
+    return { "total": total, "facets": output }
+
+""" Version of TagIndex.facet_counts grouping company_tags in the database """
+def get_tag_facet_counts(node=None, tag_ids=None):
+    counts = select(CompanyTags.tag_id, func.count().label("count")).group_by(CompanyTags.tag_id)
+    total = select(func.count()).select_from(Company)
+    if node != None:
+        condition = tag_query.company_condition(node, tag_ids)
+        counts = counts.where(CompanyTags.company_id.in_(select(Company.id).where(condition)))
+        total = total.where(condition)
+    return dict((row.tag_id, row.count) for row in db.session.execute(counts)), db.session.execute(total).scalar()
+
+""" Statement selecting a page of the ids of companies with any of the provided tags """
+def tag_companies_query(tag_uuids: list, limit=None, after=None):
+    query = select(CompanyTags.company_id).where(CompanyTags.tag_id.in_(tag_uuids))
+    return paginate_company_ids(query, CompanyTags.company_id, limit, after)
+
+""" Parses a UUID value, returning None when the value is not a valid UUID """
+def parse_uuid(value):
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
         return None
 
-""" Maps list of CompanyName records to Company records, removing duplicate Company entries """
-def format_company_list_output(company_records: list):
-    uuids = set()
-    companies = []
+"""
+    Loads the documents of the provided company ids from the company document read model
+    Issues one primary key lookup per HYDRATION_BATCH_SIZE ids. Results follow the order of the
+    provided ids, duplicates and ids without a matching company are dropped
+    With a languages fallback chain, company names and tag localizations are limited to the
+    first language of the chain they exist in
+"""
+def hydrate_companies(company_ids: list, languages=None):
+    ordered_ids = normalize_company_ids(company_ids)
+    rows = []
+    for batch in chunked(ordered_ids, HYDRATION_BATCH_SIZE):
+        rows.extend(db.session.execute(company_documents.documents_query(batch)))
+    return documents_in_order(ordered_ids, rows, languages=languages)
+
+""" Parses company ids into UUIDs, dropping invalid values and duplicates while preserving order """
+def normalize_company_ids(company_ids: list) -> list:
+    ordered_ids = []
+    for company_id in company_ids:
+        company_id = parse_uuid(company_id)
+        if company_id != None:
+            ordered_ids.append(company_id)
+    return list(dict.fromkeys(ordered_ids))
 
-    for company_record in company_records:
-        if company_record.id in uuids:
-            continue
-        else:
-            uuids.add(company_record.id)
-            company = format_company_output(company_record)
-            companies.append(company)
-    return companies
-
-""" Utility function to map entity storage objects to service output format """
-def format_company_output(company_record):
-    company = { 
-        "id": company_record.id,
-        "names": { },
-        "tags": [ ]
-    }
-    for name in company_record.names:
-        company["names"][name.language] = name.name
-    for company_tag in company_record.tags:
-        tag = {
-            "id": company_tag.tag_id,
-            "localizations": { }
-        }
-        for localization in company_tag.tag.localizations:
-            tag["localizations"][localization.language] = localization.name
-        company["tags"].append(tag)
-    return company
-
-""" Maps list of CompanyName records to Company records, removing duplicate Company entries """
-def map_company_names_to_companies(company_names: list):
-    uuids = set()
-    companies = []
-
-    for company_name in company_names:
-        if company_name.company_id in uuids:
-            continue
-        else:
-            uuids.add(company_name.company_id)
-            company = { 
-                "id": company_name.company_id,
-                "names": { },
-                "tags": [ ]
-            }
-            for name in company_name.company.names:
-                company["names"][name.language] = name.name
-            for company_tag in company_name.company.tags:
-                tag = {
-                    "id": company_tag.tag_id,
-                    "localizations": { }
-                }
-                for localization in company_tag.tag.localizations:
-                    tag["localizations"][localization.language] = localization.name
-                company["tags"].append(tag)
-
-            companies.append(company)
-    return companies
+"""
+    Orders loaded document rows by ordered_ids, converting them into service output projected
+    onto the languages fallback chain
+"""
+def documents_in_order(ordered_ids: list, rows, languages=None) -> list:
+    documents = dict((row.company_id, row.document) for row in rows)
+    return [company_documents.from_document(documents[id], languages) for id in ordered_ids if id in documents]
 
 """ Create a company tag record between existing company and tag """
 def add_company_tag_record(company_name: str, tag_name: str, language=None):
@@ -128,9 +312,13 @@ def add_company_tag_record(company_name: str, tag_name: str, language=None):
     tag_record = CompanyTags(company_id=companies[0]["id"], tag_id=ids[0])
     db.session.add(tag_record)
     try:
-        db.session.commit()
+        db.session.flush()
     except IntegrityError:
         raise UniqueViolationError("Tag already present on company")
+    company_documents.refresh(db.session, [companies[0]["id"]])
+    db.session.commit()
+    tag_index.apply(added=[(companies[0]["id"], ids[0])])
+    response_cache.invalidate(company_ids=[companies[0]["id"]], tag_ids=[ids[0]])
 
 
 """ Remove a company tag record """
@@ -148,7 +336,11 @@ def remove_tag_from_company(company_name: str, tag_name: str, language=None):
 
     tag_record = CompanyTags.query.filter_by(company_id=companies[0]["id"], tag_id=ids[0]).first()
     db.session.delete(tag_record)
+    db.session.flush()
+    company_documents.refresh(db.session, [companies[0]["id"]])
     db.session.commit()
+    tag_index.apply(removed=[(companies[0]["id"], ids[0])])
+    response_cache.invalidate(company_ids=[companies[0]["id"]], tag_ids=[ids[0]])
 
 """ Add company tag record utilizing UUIDs for Company, Tag - avoids ambiguity in names """
 def add_company_tag_record_by_uuid(company_uuid: str, tag_uuid: str):
@@ -159,13 +351,109 @@ def add_company_tag_record_by_uuid(company_uuid: str, tag_uuid: str):
     if tag == None:
         raise NotFoundError("No tag found with provided UUID")
     db.session.add(CompanyTags(company=company, tag=tag))
+    db.session.flush()
+    company_documents.refresh(db.session, [company.id])
     db.session.commit()
+    tag_index.apply(added=[(company.id, tag.id)])
+    response_cache.invalidate(company_ids=[company.id], tag_ids=[tag.id])
 
 """ Removes company tag record utilizing UUIDs for Company, Tag - avoids ambiguity in names """
 def remove_tag_from_company_by_uuid(company_uuid: str, tag_uuid: str):
     tag = CompanyTags.query.filter_by(company_id=company_uuid, tag_id=tag_uuid).first()
     db.session.delete(tag)
+    db.session.flush()
+    company_documents.refresh(db.session, [tag.company_id])
+    db.session.commit()
+    tag_index.apply(removed=[(tag.company_id, tag.tag_id)])
+    response_cache.invalidate(company_ids=[tag.company_id], tag_ids=[tag.tag_id])
+
+"""
+    Applies a list of tag assignment and removal operations by UUID, each a dict of the form
+    { "action": "add" | "remove", "company": company UUID, "tag": tag UUID }
+    Operations are validated with set-based queries and applied in order, in a single
+    transaction or one transaction per chunk_size operations. Returns one result per
+    operation with a status of added, removed, duplicate, not_found or invalid
+"""
+def apply_company_tag_operations(operations: list, chunk_size=None):
+    if chunk_size == None or chunk_size < 1:
+        chunk_size = max(len(operations), 1)
+    results = []
+    for start in range(0, len(operations), chunk_size):
+        for offset, result in enumerate(apply_company_tag_chunk(operations[start:start + chunk_size])):
+            result["index"] = start + offset
+            results.append(result)
+    return results
+
+""" Validates and applies one transaction of company tag operations """
+def apply_company_tag_chunk(operations: list):
+    results = [None] * len(operations)
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("action") not in ("add", "remove"):
+            results[index] = { "status": "invalid", "message": "action must be add or remove" }
+            continue
+        company_id = parse_uuid(operation.get("company"))
+        tag_id = parse_uuid(operation.get("tag"))
+        if company_id == None or tag_id == None:
+            results[index] = { "status": "invalid", "message": "company and tag must be UUIDs" }
+            continue
+        parsed.append((index, operation["action"], company_id, tag_id))
+
+    company_ids = set(company_id for _, _, company_id, _ in parsed)
+    tag_ids = set(tag_id for _, _, _, tag_id in parsed)
+    existing_companies = set()
+    existing_tags = set()
+    links = set()
+    for batch in chunked(list(company_ids), HYDRATION_BATCH_SIZE):
+        existing_companies.update(row.id for row in db.session.query(Company.id).filter(Company.id.in_(batch)))
+    for batch in chunked(list(tag_ids), HYDRATION_BATCH_SIZE):
+        existing_tags.update(row.id for row in db.session.query(Tag.id).filter(Tag.id.in_(batch)))
+    pairs = list(set((company_id, tag_id) for _, _, company_id, tag_id in parsed))
+    for batch in chunked(pairs, HYDRATION_BATCH_SIZE):
+        query = db.session.query(CompanyTags.company_id, CompanyTags.tag_id) \
+            .filter(tuple_(CompanyTags.company_id, CompanyTags.tag_id).in_(batch))
+        links.update((row.company_id, row.tag_id) for row in query)
+
+    # Replay the operations in order against the current links, then write the net change
+    initial_links = set(links)
+    for index, action, company_id, tag_id in parsed:
+        pair = (company_id, tag_id)
+        if company_id not in existing_companies:
+            results[index] = { "status": "not_found", "message": "No company found with provided UUID" }
+        elif tag_id not in existing_tags:
+            results[index] = { "status": "not_found", "message": "No tag found with provided UUID" }
+        elif action == "add" and pair in links:
+            results[index] = { "status": "duplicate", "message": "Tag already present on company" }
+        elif action == "add":
+            links.add(pair)
+            results[index] = { "status": "added" }
+        elif pair not in links:
+            results[index] = { "status": "not_found", "message": "Tag not present on company" }
+        else:
+            links.discard(pair)
+            results[index] = { "status": "removed" }
+
+    inserted = links - initial_links
+    deleted = initial_links - links
+    if len(inserted) > 0:
+        rows = [{ "company_id": company_id, "tag_id": tag_id } for company_id, tag_id in inserted]
+        db.session.execute(postgresql.insert(CompanyTags.__table__).on_conflict_do_nothing(), rows)
+    for batch in chunked(list(deleted), HYDRATION_BATCH_SIZE):
+        db.session.execute(CompanyTags.__table__.delete()
+            .where(tuple_(CompanyTags.company_id, CompanyTags.tag_id).in_(batch)))
+    changed = inserted | deleted
+    company_documents.refresh(db.session, set(pair[0] for pair in changed))
     db.session.commit()
+    tag_index.apply(added=inserted, removed=deleted)
+
+    if len(changed) > 0:
+        response_cache.invalidate(company_ids=set(pair[0] for pair in changed), tag_ids=set(pair[1] for pair in changed))
+    return results
+
+""" Splits a list into consecutive lists of at most size items """
+def chunked(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 """
     Will accept localization keys for any language matching iso 639-1 specification
@@ -178,6 +466,9 @@ def create_tag(data):
         tag.localizations.append(TagLocalization(language=key, name=data[key]))
     db.session.add(tag)
     db.session.commit()
+    tag_cache.invalidate_names([localization.name for localization in tag.localizations])
+    tag_cache.invalidate_tags([tag.id])
+    response_cache.invalidate(tag_names=[localization.name for localization in tag.localizations])
     payload = { "id": tag.id, "localizations": { }}
     for localization in tag.localizations:
         payload["localizations"][localization.language] = localization.name
@@ -185,99 +476,7 @@ def create_tag(data):
 
 """
     Utility function to retrieve ID value of tags by a given name
+    Resolved through the tag dictionary cache
 """
 def get_tag_ids_by_name(tag_name: str, language=None):
-    if language == None:
-        result = TagLocalization.query.filter_by(name=tag_name).all()
-        log.info('y')
-        log.info(result)
-        return list(map(lambda tl:tl.tag_id, result))
-    else:
-        result = TagLocalization.query.filter_by(name=tag_name, language=language).first()
-        log.info(result)
-        return [result.tag_id]
-
-"""
-    Utility function to insert CSV record data
-"""
-def insert_company_from_csv(db, items: list):
-    company_ko = items[0].strip(" ")
-    company_en = items[1].strip(" ")
-    company_ja = items[2].strip(" ")
-    tags_ko = items[3].strip(" ").split("|")
-    tags_en = items[4].strip(" ").split("|")
-    tags_ja = items[5].strip(" ").split("|")
-
-    present = False
-    missing = False
-    present_record = None
-
-    session = db.session()
-
-    names = []
-
-    # Check if existing company names exist already
-    if len(company_ko) > 0:
-        result = CompanyName.query.filter_by(name=company_ko, language="ko").first()
-        if result != None:
-            present = True
-            present_record = result
-        else:
-            missing = True
-            names.append(CompanyName(language="ko", name=company_ko))
-
-    if len(company_en) > 0:
-        result = CompanyName.query.filter_by(name=company_en, language="en").first()
-        if result != None:
-            present = True
-            present_record = result
-        else:
-            missing = True
-            names.append(CompanyName(language="en", name=company_en))
-
-    
-    if len(company_ja) > 0:
-        result = CompanyName.query.filter_by(name=company_ja, language="ja").first()
-        if result != None:
-            present = True
-            present_record = result
-        else:
-            missing = True
-            names.append(CompanyName(language="ja", name=company_ja))
-
-    company = None
-
-    # Return early if data for company is already detected
-    if present:
-        log.debug("Up to date, continuing")
-        return
-
-    company = Company()
-    company.names.extend(names)
-    log.debug("Adding company with names: [%s, %s, %s]"%(company_ko, company_en, company_ja))
-
-    # Validating the tags for equivalency between languages, just a sanity check
-    if len(tags_ko) != len(tags_en) or len(tags_ko) != len(tags_ja):
-        log.warn("Tag numbers not equivalent between languages.") 
-
-    for x in range(0, len(tags_ko)):
-        # Check if tag exists already
-        result = TagLocalization.query.filter_by(name=tags_ko[x], language="ko").first()
-        if result != None:
-            # If tag exists, just add a new CompanyTag record for it
-            log.debug("Tag for %s exists already, adding to company"%tags_en[x])
-            company.tags.append(CompanyTags(company=company, tag=result.tag))
-        else:
-            # If the tag does not already exist, create it and and a CompanyTag record
-            log.debug("Tag for %s not found. Creating."%tags_en[x])
-            tag = Tag()
-            tag.localizations.append(TagLocalization(language="ko", name=tags_ko[x]))
-            tag.localizations.append(TagLocalization(language="en", name=tags_en[x]))
-            tag.localizations.append(TagLocalization(language="ja", name=tags_ja[x]))
-            company_tag = CompanyTags(company=company, tag=tag)
-            company.tags.append(company_tag)
-
-    if not present:
-        db.session.add(company)
-    
-    db.session.commit()
\ No newline at end of file
+    return tag_cache.get_tag_ids(tag_name, language=language)
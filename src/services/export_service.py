@@ -0,0 +1,74 @@
+import csv
+import io
+import os
+import time
+from sqlalchemy import select
+from models.models import CompanyDocument
+from services import company_documents
+from services.ingest_service import LANGUAGES
+from util import logger
+
+"""
+    Streaming export of every company in the catalog, as newline delimited JSON documents or in
+    the column layout of the catalog CSV
+    Documents are read in company id order through a server-side cursor, one batch at a time,
+    so memory use stays constant whatever the size of the catalog
+"""
+
+log = logger.create_logger('export_service')
+
+# Number of companies fetched from the server-side cursor and written out at a time
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+NDJSON_FORMAT = "ndjson"
+CSV_FORMAT = "csv"
+
+# Export format -> mimetype of the exported data
+FORMATS = { NDJSON_FORMAT: "application/x-ndjson", CSV_FORMAT: "text/csv" }
+
+# Header row of the catalog CSV, company names then tag names in each of the catalog languages
+CSV_HEADER = ["company_" + language for language in LANGUAGES] + ["tag_" + language for language in LANGUAGES]
+
+"""
+    Yields the documents of every company in batches of batch_size, in company id order. The
+    statement runs on a server-side cursor, which is fetched from batch by batch
+"""
+def iter_company_batches(db, languages=None, batch_size=EXPORT_BATCH_SIZE):
+    statement = select(CompanyDocument.document).order_by(CompanyDocument.company_id) \
+        .execution_options(stream_results=True, max_row_buffer=batch_size)
+    with db.engine.connect() as connection:
+        for rows in connection.execute(statement).partitions(batch_size):
+            yield [company_documents.from_document(row.document, languages=languages) for row in rows]
+
+"""
+    Converts a company into a catalog CSV row. Tags are listed in the same order in each
+    language, with an empty name where a tag has no localization, so that population reads
+    them back as the same tags. Names in other languages are left out
+"""
+def csv_row(company: dict) -> list:
+    names = [company["names"].get(language, "") for language in LANGUAGES]
+    tags = ["|".join(tag["localizations"].get(language, "") for tag in company["tags"]) for language in LANGUAGES]
+    return names + tags
+
+def csv_text(rows) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue()
+
+"""
+    Yields the export of every company in the provided format as chunks of text, one per
+    batch. dumps serializes a company document into JSON. Languages project the names and tags
+    of NDJSON documents as on the company endpoints, CSV rows hold every catalog language
+"""
+def export(db, format: str, dumps, languages=None, batch_size=EXPORT_BATCH_SIZE):
+    started = time.perf_counter()
+    companies = 0
+    if format == CSV_FORMAT:
+        yield csv_text([CSV_HEADER])
+    for batch in iter_company_batches(db, languages=languages, batch_size=batch_size):
+        if format == CSV_FORMAT:
+            yield csv_text(csv_row(company) for company in batch)
+        else:
+            yield "".join(dumps(company) + "\n" for company in batch)
+        companies += len(batch)
+    log.info("Exported {} companies as {} in {:.3f}s".format(companies, format, time.perf_counter() - started))
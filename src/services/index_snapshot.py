@@ -0,0 +1,379 @@
+import gc
+import json
+import mmap
+import os
+import sys
+import tempfile
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
+from datetime import timedelta
+from sqlalchemy import delete, func, select, text, update
+from models.models import db, CatalogChange, CompanyTagChange
+from util import logger
+
+"""
+    On-disk snapshots of the in-memory search indexes, so that a restarting process maps them
+    from a file instead of rebuilding them from the database
+    A snapshot is a flat file of arrays and string tables, read through mmap, along with the
+    watermark of the database state it holds: the transaction snapshot its rows were read in.
+    It is only loaded while no change logged in catalog_change (see services/migrations.py) is
+    invisible to that transaction snapshot, so a stale snapshot is rebuilt rather than served
+"""
+
+log = logger.create_logger('index_snapshot')
+
+# Directory the snapshot files are written to, snapshots are disabled when unset
+SNAPSHOT_DIR = os.environ.get('INDEX_SNAPSHOT_DIR')
+
+# Seconds for which change log entries are kept whatever the watermarks in use, so that pruning
+# from one process does not outpace the indexes other processes keep in sync with the log
+CHANGE_LOG_RETENTION = float(os.environ.get('CHANGE_LOG_RETENTION', 600))
+
+MAGIC = b'IDXSNAP\x00'
+
+# Version of the file layout, files of another version are rebuilt. Each index also records the
+# version of its own sections
+FORMAT_VERSION = 1
+
+# Sections start at multiples of ALIGNMENT bytes so that arrays are read in place
+ALIGNMENT = 8
+
+class SnapshotError(Exception):
+    pass
+
+def aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+"""
+    Accumulates the sections of a snapshot and writes them to a file
+    File layout: MAGIC, the length of the JSON header as 8 little endian bytes, the header, then
+    the sections, each aligned to ALIGNMENT bytes at the offset listed in the header
+"""
+class SnapshotWriter:
+    def __init__(self, kind: str, version: int, watermark: dict):
+        self.kind = kind
+        self.version = version
+        self.watermark = watermark
+        # Index specific values stored in the header
+        self.metadata = {}
+        self._sections = {}
+        self._chunks = []
+        self._size = 0
+
+    """ Adds a section of raw bytes """
+    def add_bytes(self, name: str, data):
+        self._add(name, { "type": "bytes" }, bytes(data))
+
+    """ Adds an array of the provided array module typecode """
+    def add_array(self, name: str, typecode: str, values):
+        if not isinstance(values, array) or values.typecode != typecode:
+            values = array(typecode, values)
+        self._add(name, { "type": "array", "typecode": typecode }, values.tobytes())
+
+    """ Adds a section of UUIDs, 16 bytes each """
+    def add_uuids(self, name: str, ids):
+        self._add(name, { "type": "uuids" }, b"".join(id.bytes for id in ids))
+
+    """
+        Adds a string table, stored as the strings concatenated in UTF-8 (name.text) and the
+        character offset of the start of each string, followed by the total length (name.offsets)
+    """
+    def add_strings(self, name: str, strings):
+        strings = list(strings)
+        offsets = array('I', [0])
+        total = 0
+        for string in strings:
+            total += len(string)
+            offsets.append(total)
+        self.add_array(name + ".offsets", 'I', offsets)
+        self.add_bytes(name + ".text", "".join(strings).encode('utf-8', 'surrogatepass'))
+
+    """ Writes the snapshot, replacing any previous file at the path only once it is complete """
+    def write(self, path: str):
+        header = json.dumps({
+            "format": FORMAT_VERSION,
+            "kind": self.kind,
+            "version": self.version,
+            "byteorder": sys.byteorder,
+            "watermark": self.watermark,
+            "metadata": self.metadata,
+            "sections": self._sections
+        }).encode()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".")
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(MAGIC)
+                file.write(len(header).to_bytes(8, 'little'))
+                file.write(header)
+                file.write(bytes(aligned(file.tell()) - file.tell()))
+                for chunk in self._chunks:
+                    file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def _add(self, name: str, section: dict, data: bytes):
+        if name in self._sections:
+            raise SnapshotError("Duplicate snapshot section {}".format(name))
+        padding = aligned(self._size) - self._size
+        if padding > 0:
+            self._chunks.append(bytes(padding))
+        section.update(offset=self._size + padding, length=len(data))
+        self._sections[name] = section
+        self._chunks.append(data)
+        self._size += padding + len(data)
+
+"""
+    A snapshot file mapped read-only into memory. Sections are returned as memoryviews of the
+    mapping, which must be released before the snapshot is closed
+"""
+class Snapshot:
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        try:
+            if len(self._view) < 16 or self._view[:len(MAGIC)] != MAGIC:
+                raise SnapshotError("{} is not an index snapshot".format(path))
+            length = int.from_bytes(self._view[8:16], 'little')
+            header = json.loads(bytes(self._view[16:16 + length]))
+            if header["format"] != FORMAT_VERSION or header["byteorder"] != sys.byteorder:
+                raise SnapshotError("{} was written in another format".format(path))
+        except BaseException:
+            self.close()
+            raise
+        self._data = aligned(16 + length)
+        self._sections = header["sections"]
+        self.kind = header["kind"]
+        self.version = header["version"]
+        self.watermark = header["watermark"]
+        self.metadata = header["metadata"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    """ Returns a section of raw bytes """
+    def bytes(self, name: str) -> memoryview:
+        section = self._section(name)
+        start = self._data + section["offset"]
+        return self._view[start:start + section["length"]]
+
+    """ Returns an array section, as a memoryview of its typecode """
+    def array(self, name: str) -> memoryview:
+        return self.bytes(name).cast(self._section(name)["typecode"])
+
+    """ Returns the UUIDs of a section written by SnapshotWriter.add_uuids """
+    def uuids(self, name: str) -> list:
+        with self.bytes(name) as data:
+            ids = bytes(data)
+        return [uuid.UUID(bytes=ids[start:start + 16]) for start in range(0, len(ids), 16)]
+
+    """ Returns the strings of a string table (see SnapshotWriter.add_strings) """
+    def strings(self, name: str) -> list:
+        with self.bytes(name + ".text") as data:
+            content = str(data, 'utf-8', 'surrogatepass')
+        with self.array(name + ".offsets") as offsets:
+            bounds = offsets.tolist()
+        return [content[start:end] for start, end in zip(bounds, bounds[1:])]
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+    def _section(self, name: str) -> dict:
+        section = self._sections.get(name)
+        if section == None:
+            raise SnapshotError("Missing snapshot section {}".format(name))
+        return section
+
+# Whether any catalog change was committed by a transaction not visible to a transaction
+# snapshot. Changes of transactions below its xmin were committed before it was taken
+CHANGED_SINCE = text("""
+    SELECT EXISTS (
+        SELECT 1 FROM catalog_change
+        WHERE txid >= pg_snapshot_xmin(CAST(:snapshot AS pg_snapshot))::text::bigint
+        AND NOT pg_visible_in_snapshot(txid::text::xid8, CAST(:snapshot AS pg_snapshot))
+    )
+""")
+
+def has_change_log(connection) -> bool:
+    return connection.execute(text("SELECT to_regclass('catalog_change')")).scalar() != None
+
+"""
+    Returns the first entry of the change log, which identifies the database the change log
+    belongs to and records its pruning horizon, or None when the change log does not exist
+"""
+def read_epoch(connection):
+    if not has_change_log(connection):
+        return None
+    return connection.execute(select(CatalogChange.id, CatalogChange.changed_at, CatalogChange.pruned_below)
+        .order_by(CatalogChange.id).limit(1)).first()
+
+def epoch_key(epoch) -> str:
+    return "{}@{}".format(epoch.id, epoch.changed_at.isoformat())
+
+"""
+    Returns the watermark of the transaction a connection is in: its transaction snapshot, and
+    the key of the first entry of the change log. Returns None when the change log does not exist
+"""
+def read_watermark(connection):
+    if not has_change_log(connection):
+        return None
+    snapshot = connection.execute(text("SELECT pg_current_snapshot()::text")).scalar()
+    epoch = connection.execute(select(CatalogChange.id, CatalogChange.changed_at).order_by(CatalogChange.id).limit(1)).first()
+    return { "snapshot": snapshot, "epoch": None if epoch == None else epoch_key(epoch) }
+
+""" Transaction id below which every transaction had completed when the watermark was read """
+def watermark_xmin(watermark) -> int:
+    return int(watermark["snapshot"].split(":")[0])
+
+"""
+    Opens a repeatable read transaction for reading the rows of an index, yielding the
+    connection and the watermark of the rows it reads
+"""
+@contextmanager
+def consistent_read():
+    with db.engine.execution_options(isolation_level="REPEATABLE READ").begin() as connection:
+        yield connection, read_watermark(connection)
+
+"""
+    Whether the change logs still hold every change made since the watermark was read: the
+    watermark is of the same database, and not older than the pruning horizon
+"""
+def covers(connection, watermark) -> bool:
+    if watermark == None or watermark["epoch"] == None:
+        return False
+    epoch = read_epoch(connection)
+    if epoch == None or epoch_key(epoch) != watermark["epoch"]:
+        return False
+    return epoch.pruned_below == None or epoch.pruned_below <= watermark_xmin(watermark)
+
+""" Whether the database holds no change made since the watermark was read """
+def is_current(connection, watermark) -> bool:
+    if not covers(connection, watermark):
+        return False
+    return not connection.execute(CHANGED_SINCE, { "snapshot": watermark["snapshot"] }).scalar()
+
+""" Watermarks of the snapshot files that are still current, and may be loaded """
+def current_snapshot_watermarks(connection) -> list:
+    if SNAPSHOT_DIR == None or not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    watermarks = []
+    for file_name in sorted(os.listdir(SNAPSHOT_DIR)):
+        if not file_name.endswith(".snapshot"):
+            continue
+        try:
+            with Snapshot(os.path.join(SNAPSHOT_DIR, file_name)) as snapshot:
+                watermark = snapshot.watermark
+        except (SnapshotError, OSError, ValueError, KeyError):
+            continue
+        if is_current(connection, watermark):
+            watermarks.append(watermark)
+    return watermarks
+
+"""
+    Deletes the change log entries no watermark in use needs any more: those of transactions
+    completed before the oldest of the provided watermarks and of the current snapshot files,
+    and logged more than CHANGE_LOG_RETENTION seconds ago. The first entry is kept, and records
+    the horizon so that older watermarks are treated as stale. Returns the number of entries
+    deleted
+"""
+def prune(watermarks) -> int:
+    with db.engine.begin() as connection:
+        epoch = read_epoch(connection)
+        if epoch == None:
+            return 0
+        in_use = [watermark for watermark in list(watermarks) + current_snapshot_watermarks(connection)
+            if watermark != None and watermark["epoch"] == epoch_key(epoch)]
+        if len(in_use) == 0:
+            return 0
+        horizon = min(watermark_xmin(watermark) for watermark in in_use)
+        retained = connection.execute(select(func.min(CatalogChange.txid)).where(CatalogChange.id != epoch.id,
+            CatalogChange.changed_at > func.now() - timedelta(seconds=CHANGE_LOG_RETENTION))).scalar()
+        if retained != None:
+            horizon = min(horizon, retained)
+        if epoch.pruned_below != None and horizon <= epoch.pruned_below:
+            return 0
+        deleted = connection.execute(delete(CatalogChange)
+            .where(CatalogChange.txid < horizon, CatalogChange.id != epoch.id)).rowcount
+        deleted += connection.execute(delete(CompanyTagChange).where(CompanyTagChange.txid < horizon)).rowcount
+        # Concurrent prunes only ever raise the horizon
+        connection.execute(update(CatalogChange).where(CatalogChange.id == epoch.id)
+            .values(pruned_below=func.greatest(func.coalesce(CatalogChange.pruned_below, 0), horizon)))
+    log.info("Pruned {} change log entries below transaction {}".format(deleted, horizon))
+    return deleted
+
+def snapshot_path(name: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, name + ".snapshot")
+
+"""
+    Loads the snapshot of an index written by save, returning False when it is missing or does
+    not match the current database
+"""
+def load(index, name: str) -> bool:
+    path = snapshot_path(name)
+    if not os.path.exists(path):
+        return False
+    started = time.perf_counter()
+    with Snapshot(path) as snapshot:
+        if snapshot.kind != name or snapshot.version != index.SNAPSHOT_VERSION:
+            log.info("Snapshot {} is of another version".format(path))
+            return False
+        with db.engine.connect() as connection:
+            if not is_current(connection, snapshot.watermark):
+                log.info("Snapshot {} is stale".format(path))
+                return False
+        # The loaded structures hold no reference cycles, so the collection passes triggered by
+        # allocating them are paused, which makes loading about a third faster
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            index.load_snapshot(snapshot)
+        finally:
+            if collecting:
+                gc.enable()
+    log.info("Loaded snapshot {} in {:.3f}s".format(path, time.perf_counter() - started))
+    return True
+
+""" Writes the snapshot of an index, provided it holds a watermark """
+def save(index, name: str):
+    if index.watermark == None:
+        log.warning("Not writing a snapshot of {}, the catalog change log does not exist".format(name))
+        return
+    started = time.perf_counter()
+    writer = SnapshotWriter(name, index.SNAPSHOT_VERSION, index.watermark)
+    index.write_snapshot(writer)
+    writer.write(snapshot_path(name))
+    log.info("Wrote snapshot {} in {:.3f}s".format(snapshot_path(name), time.perf_counter() - started))
+
+"""
+    Loads an index from its snapshot when it is current, and otherwise builds it and writes a
+    new snapshot. Snapshots are only used when INDEX_SNAPSHOT_DIR is set, and failing to read
+    or write one falls back to building the index
+    After a build, the change log is pruned of the entries older than the index and the
+    snapshots still current
+"""
+def load_or_build(index, name: str):
+    if SNAPSHOT_DIR != None:
+        try:
+            if load(index, name):
+                return
+        except (SnapshotError, OSError, ValueError, KeyError) as ex:
+            log.warning("Could not load snapshot {}: {}".format(snapshot_path(name), ex))
+    index.build()
+    if SNAPSHOT_DIR != None:
+        try:
+            save(index, name)
+        except OSError as ex:
+            log.warning("Could not write snapshot {}: {}".format(snapshot_path(name), ex))
+    prune([index.watermark])
@@ -0,0 +1,627 @@
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects import postgresql
+from models.models import CompanyName, Company, CompanyTags, ImportRecord, Tag, TagLocalization
+from services import company_documents
+from services.company_service import chunked
+from services.name_index import name_index
+from services.tag_index import tag_index
+from services.tag_cache import tag_cache
+from services.response_cache import response_cache
+from util import logger
+
+"""
+    Streaming bulk ingestion of company catalog CSV data
+"""
+
+log = logger.create_logger('ingest_service')
+
+# Number of CSV rows buffered before their records are written and committed
+BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 5000))
+
+# Number of parser processes and writer connections, a single worker ingests sequentially
+WORKERS = int(os.environ.get('INGEST_WORKERS', 1))
+
+# Upper bound on the size of the byte range parsed by a worker process at a time
+SHARD_BYTES = 8 * 1024 * 1024
+
+# Column order of the catalog CSV, names and tags are given for each of these languages
+LANGUAGES = ["ko", "en", "ja"]
+
+"""
+    Normalizes a CSV row into a tuple of company names and tag localizations
+    names is a list of (language, name) pairs for every non-empty company name and tags is a
+    list of (ko, en, ja) tag name triples
+"""
+def parse_row(items: list):
+    names = []
+    for index, language in enumerate(LANGUAGES):
+        name = items[index].strip(" ")
+        if len(name) > 0:
+            names.append((language, name))
+
+    tags_ko = items[3].strip(" ").split("|")
+    tags_en = items[4].strip(" ").split("|")
+    tags_ja = items[5].strip(" ").split("|")
+
+    # Validating the tags for equivalency between languages, just a sanity check
+    if len(tags_ko) != len(tags_en) or len(tags_ko) != len(tags_ja):
+        log.warning("Tag numbers not equivalent between languages.")
+
+    tags = []
+    for x in range(0, len(tags_ko)):
+        tag = (tags_ko[x], tags_en[x] if x < len(tags_en) else "", tags_ja[x] if x < len(tags_ja) else "")
+        if any(len(name) > 0 for name in tag):
+            tags.append(tag)
+    return names, tags
+
+"""
+    Identity of a parsed row across versions of the catalog, its first company name as
+    language:name, or None for rows without any company name
+"""
+def row_key(names: list):
+    if len(names) == 0:
+        return None
+    return "{}:{}".format(*names[0])
+
+""" Digest of the names and tags of a parsed row, compared to detect rows that changed """
+def row_fingerprint(names: list, tags: list) -> str:
+    return hashlib.sha1(json.dumps([names, tags], ensure_ascii=False).encode()).hexdigest()
+
+"""
+    Writes rows into a table through a SQLAlchemy connection
+    Rows are streamed through COPY on PostgreSQL, which avoids per-row statement overhead,
+    and inserted with a multi-row executemany elsewhere. Dict values are written as JSON
+"""
+def write_rows(connection, table, rows: list):
+    if len(rows) == 0:
+        return
+    if connection.dialect.name != "postgresql":
+        connection.execute(table.insert(), rows)
+        return
+
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([json.dumps(row[column]) if isinstance(row[column], dict) else row[column] for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table.name, ", ".join(columns)), buffer)
+    cursor.close()
+
+"""
+    Resolves parsed CSV rows against in-memory maps of known company names and tags, and
+    writes the resulting records in multi-row batches with one commit per batch
+    A row is skipped when any of its company names already exists for the same language,
+    and tags are identified by their Korean name, as in the catalog CSV
+    The row of each company written is recorded in import_record, for later syncs. When
+    provided, progress is called with the number of rows read after each batch
+"""
+class CatalogIngestor:
+    def __init__(self, db, batch_size=BATCH_SIZE, progress=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.progress = progress
+        # (language, name) -> company id
+        self.company_names = {}
+        # Korean tag name -> tag id
+        self.tags = {}
+        self.rows = 0
+        self.companies = 0
+        self.created_tags = 0
+        self._pending_rows = 0
+        self._clear_pending()
+
+    """ Loads the names of existing companies and tags so that they are not inserted again """
+    def load_existing(self):
+        with self.db.engine.connect() as connection:
+            names = select(CompanyName.company_id, CompanyName.language, CompanyName.name)
+            for row in connection.execute(names):
+                self.company_names[(row.language, row.name)] = row.company_id
+            tags = select(TagLocalization.tag_id, TagLocalization.name).where(TagLocalization.language == "ko")
+            for row in connection.execute(tags):
+                self.tags[row.name] = row.tag_id
+
+    """ Adds a parsed row, writing out the pending records once a batch is full """
+    def add(self, names: list, tags: list):
+        self.rows += 1
+        self._pending_rows += 1
+
+        if any(name in self.company_names for name in names):
+            log.debug("Up to date, continuing")
+        else:
+            self._add_company(names, tags)
+
+        if self._pending_rows >= self.batch_size:
+            self.flush()
+
+    """
+        Writes and commits all pending records. A batch is published to the caches and indexes
+        of this process once it has committed, so that reads never see records that may not
+        exist yet
+    """
+    def flush(self):
+        batch = self._take_pending()
+        self._write(batch)
+        if self.progress != None:
+            self.progress(self.rows)
+
+    """ Waits for any outstanding writes, called once every row has been added """
+    def finish(self):
+        self.flush()
+
+    """ Streams every row of a catalog CSV file, skipping the header row """
+    def ingest_file(self, path: str):
+        with open(path, newline='', encoding='utf-8') as csv_file:
+            reader = csv.reader(csv_file)
+            next(reader, None)
+            for row in reader:
+                names, tags = parse_row(row)
+                self.add(names, tags)
+        self.finish()
+
+    """ Removes the pending records from the ingestor, returning them as a batch to write """
+    def _take_pending(self) -> dict:
+        batch = {
+            "companies": self._companies,
+            "tags": self._tags,
+            "localizations": self._localizations,
+            "names": self._names,
+            "company_tags": self._company_tags,
+            "records": self._records
+        }
+        self._pending_rows = 0
+        self._clear_pending()
+        return batch
+
+    """ Brings the caches and indexes of this process up to date with a written batch """
+    def _publish(self, batch: dict):
+        tag_cache.invalidate_names(localization["name"] for localization in batch["localizations"])
+        if len(batch["companies"]) > 0:
+            response_cache.clear()
+
+        # Indexes that have not been built yet load every record when they are
+        if name_index.ready:
+            name_index.add_many((name["company_id"], name["language"], name["name"]) for name in batch["names"])
+        if tag_index.ready:
+            tag_index.add_companies(company["id"] for company in batch["companies"])
+            tag_index.apply(added=[(link["company_id"], link["tag_id"]) for link in batch["company_tags"]])
+
+    def _write(self, batch: dict):
+        with self.db.engine.begin() as connection:
+            self._write_tags(connection, batch)
+            self._write_companies(connection, batch)
+        self._publish(batch)
+
+    def _write_tags(self, connection, batch: dict):
+        write_rows(connection, Tag.__table__, batch["tags"])
+        write_rows(connection, TagLocalization.__table__, batch["localizations"])
+
+    def _write_companies(self, connection, batch: dict):
+        write_rows(connection, Company.__table__, batch["companies"])
+        write_rows(connection, CompanyName.__table__, batch["names"])
+        write_rows(connection, CompanyTags.__table__, batch["company_tags"])
+        write_rows(connection, ImportRecord.__table__, batch["records"])
+        company_documents.refresh(connection, [company["id"] for company in batch["companies"]])
+
+    def _add_company(self, names: list, tags: list):
+        company_id = uuid.uuid4()
+        self.companies += 1
+        self._companies.append({ "id": company_id })
+        for language, name in names:
+            self.company_names[(language, name)] = company_id
+            self._names.append({ "company_id": company_id, "language": language, "name": name })
+        for tag_id in self._tag_ids(tags):
+            self._company_tags.append({ "company_id": company_id, "tag_id": tag_id })
+
+        key = row_key(names)
+        if key != None:
+            self._records.append({
+                "key": key,
+                "company_id": company_id,
+                "fingerprint": row_fingerprint(names, tags),
+                "content": { "names": names, "tags": tags }
+            })
+        return company_id
+
+    """ Ids of the tags of a row, in order and without duplicates, creating unknown tags """
+    def _tag_ids(self, tags: list) -> list:
+        tag_ids = []
+        for tag in tags:
+            tag_id = self.tags.get(tag[0])
+            if tag_id == None:
+                tag_id = self._add_tag(tag)
+            if tag_id not in tag_ids:
+                tag_ids.append(tag_id)
+        return tag_ids
+
+    def _add_tag(self, tag: tuple):
+        tag_id = uuid.uuid4()
+        self.created_tags += 1
+        self.tags[tag[0]] = tag_id
+        self._tags.append({ "id": tag_id })
+        for language, name in zip(LANGUAGES, tag):
+            self._localizations.append({ "tag_id": tag_id, "language": language, "name": name })
+        return tag_id
+
+    def _clear_pending(self):
+        self._companies = []
+        self._tags = []
+        self._localizations = []
+        self._names = []
+        self._company_tags = []
+        self._records = []
+
+"""
+    Ingestor which hands batches to a pool of writer threads, each writing through its own
+    database connection. Tags created by a batch are committed before the batch is handed
+    off, so every writer can reference them, and tag identity is still resolved by the
+    single thread calling add, which also publishes each batch once its writer has committed it
+"""
+class ParallelCatalogIngestor(CatalogIngestor):
+    def __init__(self, db, workers: int, batch_size=BATCH_SIZE, progress=None):
+        super().__init__(db, batch_size=batch_size, progress=progress)
+        self.workers = workers
+        self.write_wait_seconds = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = deque()
+
+    def finish(self):
+        try:
+            self.flush()
+            started = time.perf_counter()
+            while len(self._futures) > 0:
+                self._complete()
+            self.write_wait_seconds += time.perf_counter() - started
+        finally:
+            self._executor.shutdown()
+
+    def _write(self, batch: dict):
+        if len(batch["tags"]) > 0:
+            with self.db.engine.begin() as connection:
+                self._write_tags(connection, batch)
+
+        # Bound the number of batches in flight so memory stays proportional to the workers
+        started = time.perf_counter()
+        while len(self._futures) >= self.workers:
+            self._complete()
+        self.write_wait_seconds += time.perf_counter() - started
+
+        self._futures.append((self._executor.submit(self._write_batch_companies, batch), batch))
+
+    """ Stops the writers after a failure, dropping the batches not started yet unpublished """
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    """
+        Waits for the oldest batch in flight to commit and publishes it. A failed batch raises
+        without being published, so its records never reach the indexes
+    """
+    def _complete(self):
+        future, batch = self._futures.popleft()
+        future.result()
+        self._publish(batch)
+
+    def _write_batch_companies(self, batch: dict):
+        with self.db.engine.begin() as connection:
+            self._write_companies(connection, batch)
+
+"""
+    Ingestor applying a catalog CSV to a database populated from an earlier version of it
+    Rows whose fingerprint matches the one recorded when they were last imported are skipped,
+    so a sync costs reading the file plus writing the rows that changed. Changed rows are
+    diffed against their recorded content, so that names and tag links are only written where
+    the catalog changed them, and tag links added or removed through the API are kept
+    Companies imported before import records existed are matched by any of their names, as
+    by a full import, and adopted by recording their row
+"""
+class CatalogSync(CatalogIngestor):
+    def __init__(self, db, batch_size=BATCH_SIZE, progress=None):
+        super().__init__(db, batch_size=batch_size, progress=progress)
+        # Row key -> (company id, fingerprint)
+        self.records = {}
+        # Company id -> row key
+        self.record_keys = {}
+        self.updated = 0
+        self.unchanged = 0
+        self.skipped = 0
+        self._seen = set()
+        self._updates = []
+
+    """ Loads the existing names, tags and import records """
+    def load_existing(self):
+        super().load_existing()
+        with self.db.engine.connect() as connection:
+            for row in connection.execute(select(ImportRecord.key, ImportRecord.company_id, ImportRecord.fingerprint)):
+                self.records[row.key] = (row.company_id, row.fingerprint)
+                self.record_keys[row.company_id] = row.key
+
+    """ Number of recorded rows missing from the synced catalog, whose companies are kept """
+    @property
+    def missing(self) -> int:
+        return len(self.records.keys() - self._seen)
+
+    """ Adds a parsed row, queuing it for writing when it is new or changed """
+    def add(self, names: list, tags: list):
+        self.rows += 1
+        # Unchanged rows are not flushed, progress is reported every batch of rows read instead
+        if self.progress != None and self.rows % self.batch_size == 0:
+            self.progress(self.rows)
+        key = row_key(names)
+        if key == None or key in self._seen:
+            self.skipped += 1
+            return
+        fingerprint = row_fingerprint(names, tags)
+        record = self.records.get(key)
+        if record != None and record[1] == fingerprint:
+            self._seen.add(key)
+            self.unchanged += 1
+            return
+
+        if record != None:
+            company_id = record[0]
+        else:
+            company_id = next((self.company_names[name] for name in names if name in self.company_names), None)
+        # The key a row was recorded under changes with its first name, the company's record is moved
+        previous_key = self.record_keys.get(company_id)
+        if previous_key in self._seen:
+            # Another row of this catalog has already been matched to the company
+            self.skipped += 1
+            return
+        self._seen.add(key)
+
+        if company_id == None:
+            company_id = self._add_company(names, tags)
+        else:
+            self.updated += 1
+            self._updates.append((company_id, key, previous_key, names, tags, fingerprint))
+            self.records.pop(previous_key, None)
+        self.records[key] = (company_id, fingerprint)
+        self.record_keys[company_id] = key
+
+        self._pending_rows += 1
+        if self._pending_rows >= self.batch_size:
+            self.flush()
+
+    """ Diffs the queued changed rows against their previous content and adds them to the batch """
+    def _take_pending(self) -> dict:
+        updates = self._updates
+        self._updates = []
+        previous = self._previous_content(updates)
+        changes = { "companies": [], "names": [], "removed_names": [], "links": [], "removed_links": [],
+            "records": [], "removed_records": [] }
+
+        for company_id, key, previous_key, names, tags, fingerprint in updates:
+            old_names, old_tag_ids = previous[company_id]
+            new_names = dict(names)
+            written = sum(len(changes[change]) for change in ("names", "removed_names", "links", "removed_links"))
+            for language, name in new_names.items():
+                if old_names.get(language) != name:
+                    changes["names"].append({ "company_id": company_id, "language": language, "name": name })
+                    self.company_names[(language, name)] = company_id
+            for language, name in old_names.items():
+                if language not in new_names:
+                    changes["removed_names"].append((company_id, language))
+                if new_names.get(language) != name and self.company_names.get((language, name)) == company_id:
+                    del self.company_names[(language, name)]
+
+            tag_ids = self._tag_ids(tags)
+            changes["links"].extend((company_id, tag_id) for tag_id in tag_ids if tag_id not in old_tag_ids)
+            changes["removed_links"].extend((company_id, tag_id) for tag_id in old_tag_ids if tag_id not in tag_ids)
+            # Rows whose changes cancel out, e.g. reordered tags, only update their record
+            if sum(len(changes[change]) for change in ("names", "removed_names", "links", "removed_links")) > written:
+                changes["companies"].append(company_id)
+
+            if previous_key != None and previous_key != key:
+                changes["removed_records"].append(previous_key)
+            changes["records"].append({
+                "key": key,
+                "company_id": company_id,
+                "fingerprint": fingerprint,
+                "content": { "names": names, "tags": tags }
+            })
+
+        batch = super()._take_pending()
+        batch["changes"] = changes
+        return batch
+
+    """
+        Loads the names and tag ids the changed rows were last imported with, as a map of
+        company id to ({ language: name }, set of tag ids)
+        Adopted companies have no recorded row, their current names in the languages of the row
+        and current tags also on the row are used instead, so nothing else is removed
+    """
+    def _previous_content(self, updates: list) -> dict:
+        previous = {}
+        recorded = [update for update in updates if update[2] != None]
+        adopted = [update for update in updates if update[2] == None]
+        with self.db.engine.connect() as connection:
+            for batch in chunked(recorded, self.batch_size):
+                contents = dict((row.key, row.content) for row in connection.execute(
+                    select(ImportRecord.key, ImportRecord.content).where(ImportRecord.key.in_([update[2] for update in batch]))))
+                for company_id, _, previous_key, _, _, _ in batch:
+                    content = contents[previous_key]
+                    tag_ids = set(self.tags[tag[0]] for tag in content["tags"] if tag[0] in self.tags)
+                    previous[company_id] = (dict(content["names"]), tag_ids)
+            for batch in chunked(adopted, self.batch_size):
+                documents = dict(connection.execute(company_documents.documents_query([update[0] for update in batch])).all())
+                for company_id, _, _, names, tags, _ in batch:
+                    document = documents.get(company_id, { "names": {}, "tags": [] })
+                    row_tag_ids = set(self.tags.get(tag[0]) for tag in tags)
+                    previous[company_id] = (
+                        dict((language, document["names"][language]) for language, _ in names if language in document["names"]),
+                        set(uuid.UUID(tag["id"]) for tag in document["tags"]) & row_tag_ids
+                    )
+        return previous
+
+    def _write_companies(self, connection, batch: dict):
+        super()._write_companies(connection, batch)
+        changes = batch["changes"]
+        if len(changes["names"]) > 0:
+            statement = postgresql.insert(CompanyName.__table__)
+            connection.execute(statement.on_conflict_do_update(index_elements=["company_id", "language"],
+                set_={ "name": statement.excluded.name }), changes["names"])
+        for names in chunked(changes["removed_names"], self.batch_size):
+            connection.execute(CompanyName.__table__.delete()
+                .where(tuple_(CompanyName.company_id, CompanyName.language).in_(names)))
+        if len(changes["links"]) > 0:
+            rows = [{ "company_id": company_id, "tag_id": tag_id } for company_id, tag_id in changes["links"]]
+            connection.execute(postgresql.insert(CompanyTags.__table__).on_conflict_do_nothing(), rows)
+        for links in chunked(changes["removed_links"], self.batch_size):
+            connection.execute(CompanyTags.__table__.delete()
+                .where(tuple_(CompanyTags.company_id, CompanyTags.tag_id).in_(links)))
+        for keys in chunked(changes["removed_records"], self.batch_size):
+            connection.execute(ImportRecord.__table__.delete().where(ImportRecord.key.in_(keys)))
+        if len(changes["records"]) > 0:
+            statement = postgresql.insert(ImportRecord.__table__)
+            connection.execute(statement.on_conflict_do_update(index_elements=["key"], set_={
+                "company_id": statement.excluded.company_id,
+                "fingerprint": statement.excluded.fingerprint,
+                "content": statement.excluded.content
+            }), changes["records"])
+        company_documents.refresh(connection, changes["companies"])
+
+    def _publish(self, batch: dict):
+        super()._publish(batch)
+        changes = batch["changes"]
+        if len(changes["companies"]) > 0:
+            response_cache.clear()
+        if name_index.ready:
+            for company_id, language in changes["removed_names"]:
+                name_index.remove(company_id, language)
+            name_index.add_many((name["company_id"], name["language"], name["name"]) for name in changes["names"])
+        if tag_index.ready:
+            tag_index.apply(added=changes["links"], removed=changes["removed_links"])
+
+"""
+    Splits the data rows of a CSV file into line-aligned byte ranges of roughly equal size
+    Assumes that no field contains an embedded line break, which holds for the catalog format
+"""
+def shard_file(path: str, shard_count: int) -> list:
+    size = os.path.getsize(path)
+    with open(path, 'rb') as csv_file:
+        csv_file.readline()
+        start = csv_file.tell()
+        boundaries = [start]
+        step = max(1, (size - start) // shard_count)
+        for shard in range(1, shard_count):
+            csv_file.seek(start + shard * step)
+            csv_file.readline()
+            boundaries.append(min(csv_file.tell(), size))
+    boundaries.append(size)
+
+    shards = []
+    for begin, end in zip(boundaries, boundaries[1:]):
+        if end > begin:
+            shards.append((path, begin, end))
+    return shards
+
+"""
+    Parses the rows within a byte range of a CSV file, run within the ingestion process pool
+"""
+def parse_shard(shard: tuple) -> list:
+    path, begin, end = shard
+    with open(path, 'rb') as csv_file:
+        csv_file.seek(begin)
+        text = csv_file.read(end - begin).decode('utf-8')
+    return [parse_row(row) for row in csv.reader(io.StringIO(text, newline='')) if len(row) > 0]
+
+"""
+    Ingests a catalog CSV file, parsing shards of the file in a pool of worker processes and
+    writing batches through parallel connections
+    Parsed shards are consumed in file order, so the resulting records are the same as those
+    of a sequential run
+"""
+def ingest_file_parallel(ingestor: ParallelCatalogIngestor, path: str) -> dict:
+    size = os.path.getsize(path)
+    shard_count = max(ingestor.workers, -(-size // SHARD_BYTES))
+    shards = shard_file(path, shard_count)
+    parse_wait = 0.0
+
+    try:
+        with multiprocessing.Pool(ingestor.workers) as pool:
+            results = pool.imap(parse_shard, shards)
+            while True:
+                started = time.perf_counter()
+                rows = next(results, None)
+                parse_wait += time.perf_counter() - started
+                if rows == None:
+                    break
+                for names, tags in rows:
+                    ingestor.add(names, tags)
+    except BaseException:
+        ingestor.close()
+        raise
+    ingestor.finish()
+
+    return {
+        "shards": len(shards),
+        "parseWaitSeconds": round(parse_wait, 3),
+        "writeWaitSeconds": round(ingestor.write_wait_seconds, 3)
+    }
+
+"""
+    Ingests a catalog CSV file into the database, returning a throughput report
+    With more than one worker, parsing and writing are spread over worker processes and
+    connections. The report's wait times show whether parsing or the database was the
+    bottleneck of a parallel run
+"""
+def ingest_csv(db, path: str, batch_size=BATCH_SIZE, workers=WORKERS, progress=None):
+    started = time.perf_counter()
+    report = { "workers": workers }
+
+    if workers > 1:
+        ingestor = ParallelCatalogIngestor(db, workers, batch_size=batch_size, progress=progress)
+        ingestor.load_existing()
+        report.update(ingest_file_parallel(ingestor, path))
+    else:
+        ingestor = CatalogIngestor(db, batch_size=batch_size, progress=progress)
+        ingestor.load_existing()
+        ingestor.ingest_file(path)
+    elapsed = time.perf_counter() - started
+
+    report.update({
+        "rows": ingestor.rows,
+        "companies": ingestor.companies,
+        "tags": ingestor.created_tags,
+        "seconds": round(elapsed, 3),
+        "rowsPerSecond": round(ingestor.rows / elapsed, 1) if elapsed > 0 else None
+    })
+    log.info("Ingested {rows} csv records ({companies} companies, {tags} new tags) in {seconds}s "
+        "with {workers} worker(s), {rowsPerSecond} rows/s".format(**report))
+    return report
+
+"""
+    Syncs the database with a catalog CSV file, writing only new and changed rows (see
+    CatalogSync), and returns a report of the rows by outcome
+"""
+def sync_csv(db, path: str, batch_size=BATCH_SIZE, progress=None):
+    started = time.perf_counter()
+    ingestor = CatalogSync(db, batch_size=batch_size, progress=progress)
+    ingestor.load_existing()
+    ingestor.ingest_file(path)
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "rows": ingestor.rows,
+        "companies": ingestor.companies,
+        "updated": ingestor.updated,
+        "unchanged": ingestor.unchanged,
+        "skipped": ingestor.skipped,
+        "missing": ingestor.missing,
+        "tags": ingestor.created_tags,
+        "seconds": round(elapsed, 3)
+    }
+    log.info("Synced {rows} csv records ({companies} new companies, {updated} updated, {unchanged} unchanged, "
+        "{missing} missing from the catalog, {tags} new tags) in {seconds}s".format(**report))
+    return report
@@ -0,0 +1,242 @@
+import time
+import uuid
+from sqlalchemy import insert, select, text
+from models.models import CatalogChange, Company, CompanyDocument, CompanyName, CompanyTags, CompanyTagChange, \
+    ImportRecord, SchemaMigration, Tag, TagLocalization
+from services.company_documents import documents_query
+from services.company_service import name_exact_query, name_match_query, name_rank_query, tag_companies_query
+from services.tag_cache import localizations_query, tag_ids_query
+from util import logger
+
+"""
+    Versioned schema migrations, evolving the schema of an existing database in place
+    Migrations are applied in version order, each in its own transaction, and recorded in the
+    schema_migration table. A migration whose prerequisites are missing from the server may
+    skip itself, in which case it is not recorded and is retried by the next run
+"""
+
+log = logger.create_logger('migrations')
+
+# Key of the advisory lock serializing migration runs of concurrently starting processes
+LOCK_KEY = 7346201
+
+"""
+    Creates the tables of the original schema. Existing tables are kept, so that databases
+    created before migrations were introduced are adopted as they are
+"""
+def create_baseline(connection):
+    for model in (Company, CompanyName, Tag, TagLocalization, CompanyTags, CompanyDocument):
+        model.__table__.create(connection, checkfirst=True)
+
+"""
+    Indexes of the name lookups, which also serve lookups by name and language, and the reverse
+    (tag_id, company_id) index of company_tags, whose primary key leads with company_id
+"""
+def create_lookup_indexes(connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_company_name_name_language ON company_name (name, language)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_tag_localization_name_language ON tag_localization (name, language)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_company_tags_tag_id_company_id ON company_tags (tag_id, company_id)"))
+
+"""
+    Trigram index serving the substring searches on lower(name) of name_match_query and
+    name_rank_query. Skipped when the pg_trgm extension is not installed on the server
+"""
+def create_trigram_index(connection):
+    available = connection.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first()
+    if available == None:
+        log.warning("The pg_trgm extension is not available, substring searches will scan company_name")
+        return False
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_company_name_name_trgm ON company_name USING gin (lower(name) gin_trgm_ops)"))
+
+""" Table recording the rows imported from the catalog, for incremental catalog sync """
+def create_import_records(connection):
+    ImportRecord.__table__.create(connection, checkfirst=True)
+
+# Tables whose changes are logged into catalog_change
+CATALOG_TABLES = ["company", "company_name", "company_tags", "tag", "tag_localization"]
+
+"""
+    Log of the transactions changing the catalog tables, written by statement level triggers
+    so that every writer is covered, including population and other processes
+"""
+def create_catalog_change_log(connection):
+    CatalogChange.__table__.create(connection, checkfirst=True)
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_catalog_change_txid ON catalog_change (txid)"))
+    connection.execute(text("""
+        CREATE OR REPLACE FUNCTION log_catalog_change() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO catalog_change (table_name) VALUES (TG_TABLE_NAME);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """))
+    for table in CATALOG_TABLES:
+        connection.execute(text("DROP TRIGGER IF EXISTS log_catalog_change ON {}".format(table)))
+        connection.execute(text("CREATE TRIGGER log_catalog_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {} "
+            "FOR EACH STATEMENT EXECUTE FUNCTION log_catalog_change()".format(table)))
+    # Logged as a change itself, so that snapshots of a database recreated since are stale
+    connection.execute(insert(CatalogChange).values(table_name="catalog_change"))
+
+""" Pruning horizon of the catalog change log, recorded on its first entry """
+def add_change_log_horizon(connection):
+    connection.execute(text("ALTER TABLE catalog_change ADD COLUMN IF NOT EXISTS pruned_below BIGINT"))
+
+# Number of rows changed by a statement above which the company tag change log holds a single entry asking
+# for a rebuild instead of the rows, which keeps population and other bulk writes from logging every row
+BULK_CHANGE_ROWS = 1000
+
+"""
+    Log of the company tag links and companies changed by each transaction, from which the tag
+    indexes of other processes are kept in sync. The triggers are statement level and read the
+    changed rows from transition tables, which are only available to single event triggers.
+    Bulk changes, deleted companies and truncations are logged as entries asking for a rebuild
+"""
+def create_company_tag_change_log(connection):
+    CompanyTagChange.__table__.create(connection, checkfirst=True)
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_company_tag_change_txid ON company_tag_change (txid)"))
+    connection.execute(text("""
+        CREATE OR REPLACE FUNCTION log_company_tag_change() RETURNS trigger AS $$
+        DECLARE
+            changed bigint := 0;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                changed := changed + (SELECT count(*) FROM new_rows);
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                changed := changed + (SELECT count(*) FROM old_rows);
+            END IF;
+            IF TG_OP = 'TRUNCATE' OR changed > {bulk} THEN
+                INSERT INTO company_tag_change (company_id, tag_id) VALUES (NULL, NULL);
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO company_tag_change (company_id, tag_id) SELECT company_id, tag_id FROM new_rows;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO company_tag_change (company_id, tag_id) SELECT company_id, tag_id FROM old_rows;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """.replace("{bulk}", str(BULK_CHANGE_ROWS))))
+    connection.execute(text("""
+        CREATE OR REPLACE FUNCTION log_company_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' AND (SELECT count(*) FROM new_rows) <= {bulk} THEN
+                INSERT INTO company_tag_change (company_id) SELECT id FROM new_rows;
+            ELSE
+                INSERT INTO company_tag_change (company_id, tag_id) VALUES (NULL, NULL);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """.replace("{bulk}", str(BULK_CHANGE_ROWS))))
+    triggers = [
+        ("company_tags", "log_company_tag_insert", "INSERT", "REFERENCING NEW TABLE AS new_rows", "log_company_tag_change"),
+        ("company_tags", "log_company_tag_update", "UPDATE", "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows", "log_company_tag_change"),
+        ("company_tags", "log_company_tag_delete", "DELETE", "REFERENCING OLD TABLE AS old_rows", "log_company_tag_change"),
+        ("company_tags", "log_company_tag_truncate", "TRUNCATE", "", "log_company_tag_change"),
+        ("company", "log_company_insert", "INSERT", "REFERENCING NEW TABLE AS new_rows", "log_company_change"),
+        ("company", "log_company_delete", "DELETE OR TRUNCATE", "", "log_company_change"),
+    ]
+    for table, name, events, referencing, function in triggers:
+        connection.execute(text("DROP TRIGGER IF EXISTS {} ON {}".format(name, table)))
+        connection.execute(text("CREATE TRIGGER {} AFTER {} ON {} {} FOR EACH STATEMENT EXECUTE FUNCTION {}()"
+            .format(name, events, table, referencing, function)))
+
+# (version, description, upgrade), in the order they are applied. Applied migrations must not
+# be changed, later schema changes are added as new versions
+MIGRATIONS = [
+    (1, "Create the baseline tables", create_baseline),
+    (2, "Add name, language and reverse company tag indexes", create_lookup_indexes),
+    (3, "Add a trigram index for company name substring search", create_trigram_index),
+    (4, "Add the catalog import record table", create_import_records),
+    (5, "Add the catalog change log", create_catalog_change_log),
+    (6, "Add the catalog change log pruning horizon", add_change_log_horizon),
+    (7, "Add the company tag change log", create_company_tag_change_log),
+]
+
+""" Versions of the migrations recorded as applied """
+def applied_versions(connection) -> set:
+    return set(row.version for row in connection.execute(select(SchemaMigration.version)))
+
+"""
+    Applies the pending migrations up to the target version, or every pending migration when no
+    target is provided. Returns the versions applied
+"""
+def migrate(db, target=None) -> list:
+    applied = []
+    with db.engine.connect() as connection:
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), { "key": LOCK_KEY })
+        try:
+            with connection.begin():
+                SchemaMigration.__table__.create(connection, checkfirst=True)
+            done = applied_versions(connection)
+            for version, description, upgrade in MIGRATIONS:
+                if version in done or (target != None and version > target):
+                    continue
+                started = time.perf_counter()
+                with connection.begin():
+                    if upgrade(connection) == False:
+                        log.warning("Skipped migration {}: {}".format(version, description))
+                        continue
+                    connection.execute(insert(SchemaMigration).values(version=version, description=description))
+                applied.append(version)
+                log.info("Applied migration {}: {} in {:.3f}s".format(version, description, time.perf_counter() - started))
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), { "key": LOCK_KEY })
+    return applied
+
+""" Lists every migration with whether it has been applied """
+def status(db) -> list:
+    with db.engine.connect() as connection:
+        done = applied_versions(connection) if db.engine.dialect.has_table(connection, SchemaMigration.__tablename__) else set()
+    return [{ "version": version, "description": description, "applied": version in done } for version, description, _ in MIGRATIONS]
+
+""" Statements issued by the read and write paths, by name, with placeholder parameters """
+def service_queries() -> list:
+    sample = uuid.UUID(int=0)
+    return [
+        ("name_exact_query", name_exact_query("sample")),
+        ("company name by name and language", select(CompanyName.company_id).where(CompanyName.name == "sample", CompanyName.language == "en")),
+        ("name_match_query", name_match_query("sample", 10)),
+        ("name_rank_query", name_rank_query("sample", 10)),
+        ("tag_ids_query", tag_ids_query("sample")),
+        ("tag_ids_query by language", tag_ids_query("sample", "en")),
+        ("localizations_query", localizations_query([sample])),
+        ("tag_companies_query", tag_companies_query([sample], 10, sample)),
+        ("documents_query", documents_query([sample])),
+    ]
+
+"""
+    Yields the (node type, relation, index, whether it is a full scan) of the scans of a JSON
+    query plan. Index scans without an index condition read the whole index, filtering each row
+"""
+def plan_scans(plan: dict):
+    if plan["Node Type"] == "Seq Scan":
+        yield (plan["Node Type"], plan["Relation Name"], None, True)
+    elif "Index Name" in plan:
+        yield (plan["Node Type"], plan.get("Relation Name"), plan["Index Name"], "Index Cond" not in plan)
+    for child in plan.get("Plans", []):
+        yield from plan_scans(child)
+
+"""
+    Runs EXPLAIN on each service query and reports the scans of its plan. Sequential scans are
+    disabled while planning, so that small tables are not scanned by preference, and any full
+    scan that remains is of a table without an index usable by the query
+"""
+def check_query_plans(db) -> list:
+    report = []
+    with db.engine.begin() as connection:
+        connection.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, statement in service_queries():
+            compiled = statement.compile(dialect=connection.dialect, compile_kwargs={ "render_postcompile": True })
+            plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + compiled.string, compiled.params).scalar()
+            scans = list(plan_scans(plan[0]["Plan"]))
+            report.append({
+                "query": name,
+                "scans": [{ "type": type, "relation": relation, "index": index } for type, relation, index, _ in scans],
+                "fullScans": sorted(set(relation or index for _, relation, index, full in scans if full))
+            })
+    return report
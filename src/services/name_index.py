@@ -0,0 +1,434 @@
+import bisect
+import heapq
+import itertools
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+from sqlalchemy import select
+from models.models import CompanyName
+from services.index_snapshot import SnapshotError, consistent_read
+from util import logger
+from util.search_keys import chosung_key, fold_kana, has_hangul, is_chosung_query, jamo_key
+
+"""
+    Process-local n-gram index over company names, used to serve substring searches
+    (autocomplete) without scanning the company_name table
+    Names are also kept in sorted arrays of keys and of the suffixes starting at each word,
+    so that ranked autocomplete finds prefix and word matches with a binary search. Korean
+    names are additionally kept under their decomposed jamo and initial consonant (chosung)
+    keys (see util.search_keys), so that those searches cost the same as plain prefix lookups
+    The index can be saved to and loaded from a snapshot file (see services.index_snapshot)
+"""
+
+log = logger.create_logger('name_index')
+
+# Every substring of length 1 to GRAM_SIZE is indexed, so queries of up to GRAM_SIZE
+# characters resolve with a single posting lookup and longer queries intersect the
+# posting lists of their grams
+GRAM_SIZE = 3
+
+# Queries shorter than this are not matched with typos
+FUZZY_MIN_LENGTH = 4
+
+# Queries of at least this length are matched with up to two typos rather than one
+FUZZY_TWO_EDITS_LENGTH = 8
+
+# Maximum number of names compared against the query when matching with typos, drawn from at
+# most FUZZY_SCAN_LIMIT posting entries, which bounds the cost of typo matching whatever the
+# size of the catalog at the price of missing some matches of very common letter pairs
+FUZZY_CANDIDATES = 300
+FUZZY_SCAN_LIMIT = 10000
+
+# Forms of the sorted arrays searched by ranked autocomplete
+TEXT_FORM = "text"
+JAMO_FORM = "jamo"
+CHOSUNG_FORM = "chosung"
+
+# Functions computing the key of a normalized name in each form
+FORM_KEYS = { TEXT_FORM: lambda key: key, JAMO_FORM: jamo_key, CHOSUNG_FORM: chosung_key }
+
+"""
+    Merges items into a sorted array in place, with one binary search per item and a single
+    copy of the array, rather than the shift of the array tail per item of repeated insorts
+"""
+def merge_sorted(array: list, items: list):
+    items.sort()
+    merged = []
+    start = 0
+    for item in items:
+        end = bisect.bisect_left(array, item, start)
+        merged += array[start:end]
+        merged.append(item)
+        start = end
+    merged += array[start:]
+    array[:] = merged
+
+"""
+    Normalizes a name or search string into the form stored in the index, applying Unicode
+    compatibility normalization (so full width and half width forms match), case folding and
+    folding katakana into hiragana
+"""
+def normalize(text: str) -> str:
+    return fold_kana(unicodedata.normalize('NFKC', text).casefold())
+
+""" Returns the prefix search keys of a normalized name by form, jamo and chosung keys for Korean names """
+def search_keys(key: str) -> dict:
+    if not has_hangul(key):
+        return { TEXT_FORM: key }
+    return { TEXT_FORM: key, JAMO_FORM: jamo_key(key), CHOSUNG_FORM: chosung_key(key) }
+
+"""
+    Returns the form and key a normalized search string is looked up under: chosung for
+    strings of initial consonants, jamo for other Korean strings, so that a syllable still
+    being typed matches, and text otherwise
+"""
+def search_form(key: str) -> tuple:
+    if is_chosung_query(key):
+        return CHOSUNG_FORM, chosung_key(key)
+    if has_hangul(key):
+        return JAMO_FORM, jamo_key(key)
+    return TEXT_FORM, key
+
+""" Returns the offsets of the words of the key (alphanumeric runs) following the first one """
+def word_starts(key: str) -> list:
+    return [start for start in range(1, len(key)) if key[start].isalnum() and not key[start - 1].isalnum()]
+
+"""
+    Returns the smallest number of edits turning the query into a substring of the key, or
+    None when it exceeds max_edits
+"""
+def substring_distance(query: str, key: str, max_edits: int):
+    # Sellers' algorithm: edit distance with the match free to start anywhere in the key
+    previous = [0] * (len(key) + 1)
+    for row, query_char in enumerate(query, 1):
+        current = [row]
+        for column, key_char in enumerate(key, 1):
+            current.append(min(previous[column] + 1, current[column - 1] + 1, previous[column - 1] + (query_char != key_char)))
+        if min(current) > max_edits:
+            return None
+        previous = current
+    distance = min(previous)
+    return distance if distance <= max_edits else None
+
+""" Returns every distinct substring of the key with a length between 1 and GRAM_SIZE """
+def grams_for(key: str) -> set:
+    grams = set()
+    for size in range(1, GRAM_SIZE + 1):
+        for start in range(0, len(key) - size + 1):
+            grams.add(key[start:start + size])
+    return grams
+
+class NameIndex:
+    # Version of the snapshot sections, to change along with them
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Entry ordinal -> (company_id, language, key), removed entries are set to None
+        self._entries = []
+        # (company_id, language) -> entry ordinal
+        self._positions = {}
+        # gram -> set of entry ordinals whose key contains the gram
+        self._postings = {}
+        # Form -> (sorted (key, entry ordinal) of every entry with a key in the form, sorted
+        # (suffix, entry ordinal) of the key suffix starting at each word but the first)
+        self._sorted = dict((form, ([], [])) for form in (TEXT_FORM, JAMO_FORM, CHOSUNG_FORM))
+        # Watermark of the database state the index was built from (see services.index_snapshot)
+        self.watermark = None
+        self.ready = False
+
+    """ Empties the index, whose searches then fall back to the database until it is built again """
+    def reset(self):
+        with self._lock:
+            self._entries = []
+            self._positions = {}
+            self._postings = {}
+            self._sorted = dict((form, ([], [])) for form in self._sorted)
+            self.watermark = None
+            self.ready = False
+
+    """ Replaces the index contents with every CompanyName row currently in the database """
+    def build(self):
+        # Read through a dedicated connection so no transaction is left open on the session
+        with consistent_read() as (connection, watermark):
+            rows = connection.execute(select(CompanyName.company_id, CompanyName.language, CompanyName.name)).all()
+        with self._lock:
+            self.watermark = watermark
+            self._entries = []
+            self._positions = {}
+            self._postings = {}
+            self._sorted = dict((form, ([], [])) for form in self._sorted)
+            for row in rows:
+                self._add(row.company_id, row.language, row.name, sort=False)
+            for keys, words in self._sorted.values():
+                keys.sort()
+                words.sort()
+            self.ready = True
+        log.info("Name index built with {} names and {} grams".format(len(rows), len(self._postings)))
+
+    """
+        Writes the index to a snapshot. Removed entries are left out and the remaining entries
+        renumbered in order, which keeps the sorted arrays sorted. Sorted array entries are
+        stored as ordinals, and word suffixes as their length, their keys being recomputed
+        from the names on load
+    """
+    def write_snapshot(self, writer):
+        with self._lock:
+            live = [ordinal for ordinal, entry in enumerate(self._entries) if entry != None]
+            renumbered = dict(zip(live, range(0, len(live))))
+            entries = [self._entries[ordinal] for ordinal in live]
+            languages = sorted(set(entry[1] for entry in entries))
+            language_numbers = dict((language, number) for number, language in enumerate(languages))
+            writer.metadata["gram_size"] = GRAM_SIZE
+            writer.add_uuids("company_ids", (entry[0] for entry in entries))
+            writer.add_strings("languages", languages)
+            writer.add_array("entry_languages", 'H', (language_numbers[entry[1]] for entry in entries))
+            writer.add_strings("keys", (entry[2] for entry in entries))
+            grams = list(self._postings)
+            offsets = array('I', [0])
+            pool = array('I')
+            for gram in grams:
+                pool.extend(renumbered[ordinal] for ordinal in self._postings[gram])
+                offsets.append(len(pool))
+            writer.add_strings("grams", grams)
+            writer.add_array("postings.offsets", 'I', offsets)
+            writer.add_array("postings", 'I', pool)
+            for form, (keys, words) in self._sorted.items():
+                writer.add_array(form + ".keys", 'I', (renumbered[ordinal] for _, ordinal in keys))
+                writer.add_array(form + ".words", 'I', (renumbered[ordinal] for _, ordinal in words))
+                writer.add_array(form + ".word_lengths", 'I', (len(suffix) for suffix, _ in words))
+
+    """ Replaces the index contents with those of a snapshot written by write_snapshot """
+    def load_snapshot(self, snapshot):
+        if snapshot.metadata.get("gram_size") != GRAM_SIZE:
+            raise SnapshotError("The snapshot was written with another gram size")
+        company_ids = snapshot.uuids("company_ids")
+        languages = snapshot.strings("languages")
+        with snapshot.array("entry_languages") as numbers:
+            entry_languages = [languages[number] for number in numbers]
+        keys = snapshot.strings("keys")
+        entries = list(zip(company_ids, entry_languages, keys))
+        positions = dict(((entry[0], entry[1]), ordinal) for ordinal, entry in enumerate(entries))
+        grams = snapshot.strings("grams")
+        with snapshot.array("postings.offsets") as offsets, snapshot.array("postings") as pool:
+            postings = dict((gram, set(pool[offsets[number]:offsets[number + 1]])) for number, gram in enumerate(grams))
+        sorted_arrays = {}
+        for form in self._sorted:
+            with snapshot.array(form + ".keys") as ordinals:
+                form_keys = dict((ordinal, FORM_KEYS[form](keys[ordinal])) for ordinal in ordinals)
+                form_array = [(form_keys[ordinal], ordinal) for ordinal in ordinals]
+            with snapshot.array(form + ".words") as ordinals, snapshot.array(form + ".word_lengths") as lengths:
+                words = [(form_keys[ordinal][-length:], ordinal) for ordinal, length in zip(ordinals, lengths)]
+            sorted_arrays[form] = (form_array, words)
+        with self._lock:
+            self._entries = entries
+            self._positions = positions
+            self._postings = postings
+            self._sorted = sorted_arrays
+            self.watermark = snapshot.watermark
+            self.ready = True
+        log.info("Name index loaded with {} names and {} grams".format(len(entries), len(postings)))
+
+    """ Adds or replaces the indexed name of a company for a language """
+    def add(self, company_id, language: str, name: str):
+        with self._lock:
+            self._add(company_id, language, name)
+
+    """
+        Adds or replaces the indexed names of (company id, language, name) triples, the last one
+        of each company and language winning. The new keys are appended and merged into the
+        sorted arrays once, so that adding a batch costs one pass over the arrays
+    """
+    def add_many(self, names):
+        latest = dict(((company_id, language), name) for company_id, language, name in names)
+        with self._lock:
+            # Replaced names are removed while the arrays are still sorted
+            for company_id, language in latest:
+                self._remove(company_id, language)
+            sizes = dict((form, (len(keys), len(words))) for form, (keys, words) in self._sorted.items())
+            for (company_id, language), name in latest.items():
+                self._add(company_id, language, name, sort=False)
+            for form, (keys, words) in self._sorted.items():
+                for array, size in zip((keys, words), sizes[form]):
+                    added = array[size:]
+                    del array[size:]
+                    merge_sorted(array, added)
+
+    """ Removes the indexed name of a company for a language, if present """
+    def remove(self, company_id, language: str):
+        with self._lock:
+            self._remove(company_id, language)
+
+    """
+        Returns the ids of companies with a name containing the search string, ordered by
+        company id and without duplicates
+        When provided, only ids greater than after are returned (keyset pagination) and the
+        result is capped at limit companies
+    """
+    def search(self, text: str, limit=None, after=None) -> list:
+        key = normalize(text)
+        with self._lock:
+            company_ids = set()
+            for ordinal in self._candidates(key):
+                entry = self._entries[ordinal]
+                if entry != None and key in entry[2]:
+                    company_ids.add(entry[0])
+        if after != None:
+            company_ids = [id for id in company_ids if id > after]
+        if limit != None:
+            return heapq.nsmallest(limit, company_ids)
+        return sorted(company_ids)
+
+    """
+        Returns the ids of up to limit companies with a name matching the search string, best
+        matches first: names starting with it, then names with a word starting with it, then
+        names containing it, then names containing it with up to one typo (two for longer
+        search strings). Within a tier, prefix and word matches follow name order and other
+        matches are ordered by match position and name length
+        Prefix and word matches are read from sorted arrays, so when they fill the limit the
+        cost depends on the limit rather than the number of names
+        Korean search strings are matched by prefix on decomposed jamo, and strings of initial
+        consonants by prefix on the chosung of names, without substring or typo matching
+    """
+    def autocomplete(self, text: str, limit: int) -> list:
+        key = normalize(text)
+        if len(key.strip()) == 0:
+            return []
+        form, form_key = search_form(key)
+        company_ids = {}
+        with self._lock:
+            # The sorted arrays and entries are read together, since a build or snapshot load
+            # replaces both and ordinals of one only index the other
+            keys, words = self._sorted[form]
+            entries = self._entries
+            # Tiers are only searched while the previous ones leave the limit unfilled
+            tiers = [
+                lambda: self._prefix_matches(keys, form_key),
+                lambda: self._prefix_matches(words, form_key)
+            ]
+            if form != CHOSUNG_FORM:
+                tiers.append(lambda: self._substring_matches(key, limit))
+                tiers.append(lambda: self._fuzzy_matches(key, limit))
+            for tier in tiers:
+                for ordinal in tier():
+                    company_ids[entries[ordinal][0]] = True
+                    if len(company_ids) >= limit:
+                        return list(company_ids)
+        return list(company_ids)
+
+    """ Yields the ordinals of the entries of a sorted array starting with the key """
+    def _prefix_matches(self, array: list, key: str):
+        for index in range(bisect.bisect_left(array, (key,)), len(array)):
+            prefix, ordinal = array[index]
+            if not prefix.startswith(key):
+                return
+            yield ordinal
+
+    """
+        Ordinals of the best entries of limit companies containing the key past their start and
+        word starts
+    """
+    def _substring_matches(self, key: str, limit: int) -> list:
+        matches = {}
+        for ordinal in self._candidates(key):
+            entry = self._entries[ordinal]
+            if entry == None:
+                continue
+            position = entry[2].find(key)
+            if position > 0 and position not in word_starts(entry[2]):
+                self._keep_best(matches, entry[0], (position, len(entry[2]), entry[2], ordinal))
+        return [match[3] for match in heapq.nsmallest(limit, matches.values())]
+
+    """ Ordinals of the limit best entries containing the key with typos, fewest edits first """
+    def _fuzzy_matches(self, key: str, limit: int) -> list:
+        if len(key) < FUZZY_MIN_LENGTH:
+            return []
+        max_edits = 2 if len(key) >= FUZZY_TWO_EDITS_LENGTH else 1
+        # Each edit breaks at most two of the bigrams of the key, so a match keeps all but
+        # 2 * max_edits of them and contains at least one of any 2 * max_edits + 1 of them.
+        # Candidates are drawn from the rarest bigrams and ranked by the bigrams they share
+        bigrams = sorted(set(key[start:start + 2] for start in range(0, len(key) - 1)),
+            key=lambda gram: len(self._postings.get(gram, ())))
+        shared = Counter()
+        budget = FUZZY_SCAN_LIMIT
+        for gram in bigrams[:2 * max_edits + 1]:
+            posting = self._postings.get(gram, ())
+            shared.update(itertools.islice(posting, budget))
+            budget -= min(len(posting), budget)
+        matches = {}
+        for ordinal, _ in shared.most_common(FUZZY_CANDIDATES):
+            entry = self._entries[ordinal]
+            if entry == None:
+                continue
+            distance = substring_distance(key, entry[2], max_edits)
+            if distance != None and distance > 0:
+                self._keep_best(matches, entry[0], (distance, len(entry[2]), entry[2], ordinal))
+        return [match[3] for match in heapq.nsmallest(limit, matches.values())]
+
+    """ Records a ranked match of a company unless it has a better one, lower comparing first """
+    def _keep_best(self, matches: dict, company_id, match: tuple):
+        if company_id not in matches or match < matches[company_id]:
+            matches[company_id] = match
+
+    def _candidates(self, key: str) -> set:
+        if len(key) == 0:
+            return set(range(0, len(self._entries)))
+        if len(key) <= GRAM_SIZE:
+            return self._postings.get(key, set())
+
+        # Intersect starting from the rarest gram so the working set only shrinks
+        postings = []
+        for start in range(0, len(key) - GRAM_SIZE + 1):
+            posting = self._postings.get(key[start:start + GRAM_SIZE])
+            if posting == None:
+                return set()
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates &= posting
+            if len(candidates) == 0:
+                break
+        return candidates
+
+    def _add(self, company_id, language: str, name: str, sort=True):
+        self._remove(company_id, language)
+        key = normalize(name)
+        ordinal = len(self._entries)
+        self._entries.append((company_id, language, key))
+        self._positions[(company_id, language)] = ordinal
+        for gram in grams_for(key):
+            self._postings.setdefault(gram, set()).add(ordinal)
+        # The arrays are sorted once at the end of a build, and kept sorted on later changes
+        insert = bisect.insort if sort else list.append
+        for form, form_key in search_keys(key).items():
+            keys, words = self._sorted[form]
+            insert(keys, (form_key, ordinal))
+            for start in word_starts(form_key):
+                insert(words, (form_key[start:], ordinal))
+
+    def _remove(self, company_id, language: str):
+        ordinal = self._positions.pop((company_id, language), None)
+        if ordinal == None:
+            return
+        key = self._entries[ordinal][2]
+        self._entries[ordinal] = None
+        for form, form_key in search_keys(key).items():
+            keys, words = self._sorted[form]
+            self._discard(keys, (form_key, ordinal))
+            for start in word_starts(form_key):
+                self._discard(words, (form_key[start:], ordinal))
+        for gram in grams_for(key):
+            posting = self._postings.get(gram)
+            if posting != None:
+                posting.discard(ordinal)
+                if len(posting) == 0:
+                    del self._postings[gram]
+
+    def _discard(self, array: list, item: tuple):
+        index = bisect.bisect_left(array, item)
+        if index < len(array) and array[index] == item:
+            del array[index]
+
+name_index = NameIndex()
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from util import logger
+
+"""
+    Process-wide cache of serialized read endpoint responses
+    Entries record the companies, tags and tag names they were built from, so that the
+    mutation paths can invalidate exactly the responses they affect
+"""
+
+log = logger.create_logger('response_cache')
+
+# Maximum number of cached responses, 0 disables the cache
+MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+
+# Seconds a response is served from the cache for, bounds staleness from mutations made by
+# other processes
+TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 30))
+
+class CachedResponse:
+    def __init__(self, body: bytes, expiry: float, dependencies: list):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.expiry = expiry
+        self.dependencies = dependencies
+
+class ResponseCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> CachedResponse
+        self._entries = OrderedDict()
+        # ("company" | "tag" | "tag_name", value) -> set of keys depending on it
+        self._dependents = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Incremented by every invalidation, responses built before one are not cached
+        self.generation = 0
+
+    """ Returns the cached response for the key, or None when absent or expired """
+    def get(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None and entry.expiry > now:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry
+            self.misses += 1
+            if entry != None:
+                self._remove(key)
+            return None
+
+    """
+        Caches a serialized response body under the key, recording the company ids, tag ids
+        and tag names it was built from
+        generation is the cache generation read before the response was built, the response
+        is not cached if an invalidation has happened since
+    """
+    def put(self, key: str, body: bytes, generation: int, company_ids=(), tag_ids=(), tag_names=()) -> CachedResponse:
+        dependencies = [("company", str(id)) for id in company_ids] \
+            + [("tag", str(id)) for id in tag_ids] \
+            + [("tag_name", name) for name in tag_names]
+        entry = CachedResponse(body, time.monotonic() + self.ttl, dependencies)
+        if self.max_entries <= 0:
+            return entry
+
+        with self._lock:
+            if generation != self.generation:
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    """ Drops every response built from any of the provided companies, tags or tag names """
+    def invalidate(self, company_ids=(), tag_ids=(), tag_names=()):
+        dependencies = [("company", str(id)) for id in company_ids] \
+            + [("tag", str(id)) for id in tag_ids] \
+            + [("tag_name", name) for name in tag_names]
+        with self._lock:
+            self.generation += 1
+            for dependency in dependencies:
+                for key in list(self._dependents.get(dependency, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    """ Drops every cached response """
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._dependents.clear()
+
+    """ Returns hit, miss and size counters of the cache """
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries
+            }
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry == None:
+            return
+        for dependency in entry.dependencies:
+            keys = self._dependents.get(dependency)
+            if keys != None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._dependents[dependency]
+
+response_cache = ResponseCache()
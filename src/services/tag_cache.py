@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import select
+from models.models import db, TagLocalization
+from util import logger
+
+"""
+    Process-wide cache of the tag dictionary, mapping tag names to tag ids and tag ids to
+    their localizations so that tag resolution does not cost a database round trip
+"""
+
+log = logger.create_logger('tag_cache')
+
+# Maximum number of entries held in each of the name and localization maps
+MAX_ENTRIES = int(os.environ.get('TAG_CACHE_SIZE', 10000))
+
+# Seconds an entry is trusted for, bounds staleness from tags created by other processes
+TTL = float(os.environ.get('TAG_CACHE_TTL', 60))
+
+""" Statement selecting the ids of tags with a localization matching the name """
+def tag_ids_query(name: str, language=None):
+    query = select(TagLocalization.tag_id).where(TagLocalization.name == name)
+    if language != None:
+        query = query.where(TagLocalization.language == language)
+    return query
+
+""" Statement selecting every localization of the provided tags """
+def localizations_query(tag_ids: list):
+    return select(TagLocalization.tag_id, TagLocalization.language, TagLocalization.name) \
+        .where(TagLocalization.tag_id.in_(tag_ids))
+
+class TagCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # name -> { language (None for any language): (expiry, tag ids) }
+        self._names = OrderedDict()
+        # tag id -> (expiry, { language: name })
+        self._localizations = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Incremented by every invalidation, so that a lookup which raced with one is not cached
+        self._generation = 0
+
+    """
+        Returns the ids of tags with a localization matching the name, limited to the
+        localization for language when provided
+    """
+    def get_tag_ids(self, name: str, language=None) -> list:
+        cached, generation = self._lookup_tag_ids(name, language)
+        if cached != None:
+            return list(cached)
+        with db.engine.connect() as connection:
+            tag_ids = tuple(dict.fromkeys(row.tag_id for row in connection.execute(tag_ids_query(name, language))))
+        self._store_tag_ids(name, language, tag_ids, generation)
+        return list(tag_ids)
+
+    """ Version of get_tag_ids loading missing entries through an AsyncSession """
+    async def get_tag_ids_async(self, session, name: str, language=None) -> list:
+        cached, generation = self._lookup_tag_ids(name, language)
+        if cached != None:
+            return list(cached)
+        result = await session.execute(tag_ids_query(name, language))
+        tag_ids = tuple(dict.fromkeys(row.tag_id for row in result))
+        self._store_tag_ids(name, language, tag_ids, generation)
+        return list(tag_ids)
+
+    """ Returns a map of tag id to { language: name } localizations for the provided tag ids """
+    def get_localizations(self, tag_ids) -> dict:
+        result, missing, generation = self._lookup_localizations(tag_ids)
+        if len(missing) == 0:
+            return result
+        with db.engine.connect() as connection:
+            rows = connection.execute(localizations_query(missing)).all()
+        result.update(self._store_localizations(missing, rows, generation))
+        return result
+
+    """ Version of get_localizations loading missing entries through an AsyncSession """
+    async def get_localizations_async(self, session, tag_ids) -> dict:
+        result, missing, generation = self._lookup_localizations(tag_ids)
+        if len(missing) == 0:
+            return result
+        rows = (await session.execute(localizations_query(missing))).all()
+        result.update(self._store_localizations(missing, rows, generation))
+        return result
+
+    """ Drops cached name lookups for the provided tag names, in every language """
+    def invalidate_names(self, names):
+        with self._lock:
+            self._generation += 1
+            for name in names:
+                if self._names.pop(name, None) != None:
+                    self.invalidations += 1
+
+    """ Drops cached localizations for the provided tag ids """
+    def invalidate_tags(self, tag_ids):
+        with self._lock:
+            self._generation += 1
+            for tag_id in tag_ids:
+                if self._localizations.pop(tag_id, None) != None:
+                    self.invalidations += 1
+
+    """ Drops every cached entry """
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._names) + len(self._localizations)
+            self._names.clear()
+            self._localizations.clear()
+
+    """ Returns hit, miss and size counters of the cache """
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "names": len(self._names),
+                "localizations": len(self._localizations),
+                "maxEntries": self.max_entries
+            }
+
+    def _lookup_tag_ids(self, name: str, language):
+        with self._lock:
+            entry = self._names.get(name, {}).get(language)
+            if entry != None and entry[0] > time.monotonic():
+                self.hits += 1
+                self._names.move_to_end(name)
+                return entry[1], self._generation
+            self.misses += 1
+            return None, self._generation
+
+    def _store_tag_ids(self, name: str, language, tag_ids: tuple, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self._names.setdefault(name, {})[language] = (time.monotonic() + self.ttl, tag_ids)
+                self._names.move_to_end(name)
+                self._evict(self._names)
+
+    def _lookup_localizations(self, tag_ids):
+        now = time.monotonic()
+        result = {}
+        missing = []
+        with self._lock:
+            for tag_id in set(tag_ids):
+                entry = self._localizations.get(tag_id)
+                if entry != None and entry[0] > now:
+                    self.hits += 1
+                    self._localizations.move_to_end(tag_id)
+                    result[tag_id] = entry[1]
+                else:
+                    self.misses += 1
+                    missing.append(tag_id)
+            return result, missing, self._generation
+
+    def _store_localizations(self, missing: list, rows, generation: int) -> dict:
+        loaded = dict((tag_id, {}) for tag_id in missing)
+        for row in rows:
+            loaded[row.tag_id][row.language] = row.name
+        with self._lock:
+            if generation == self._generation:
+                expiry = time.monotonic() + self.ttl
+                for tag_id, localizations in loaded.items():
+                    self._localizations[tag_id] = (expiry, localizations)
+                    self._localizations.move_to_end(tag_id)
+                self._evict(self._localizations)
+        return loaded
+
+    def _evict(self, entries: OrderedDict):
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+tag_cache = TagCache()
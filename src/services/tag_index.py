@@ -0,0 +1,411 @@
+import bisect
+import heapq
+import operator
+import os
+import re
+import threading
+import time
+from array import array
+from sqlalchemy import select, text, tuple_
+from models.models import Company, CompanyTags
+from services import index_snapshot
+from services.index_snapshot import consistent_read
+from services.response_cache import response_cache
+from util import logger
+
+"""
+    Process-local inverted index of tag id -> companies, used to evaluate boolean tag queries
+    with bitwise operations instead of multi-way joins
+    Companies are numbered with dense ordinals. A tag on a sizeable share of the companies holds
+    a bitmap of ordinals in a Python int, while rarer tags hold a sorted array of ordinals,
+    which takes less memory, and are only expanded into a bitmap while evaluating a query
+    The index can be saved to and loaded from a snapshot file (see services.index_snapshot)
+    Each process holds its own index, and applies the changes committed by other processes from
+    the company tag change log every TAG_INDEX_SYNC_INTERVAL seconds (see TagIndex.sync)
+"""
+
+log = logger.create_logger('tag_index')
+
+# Seconds between syncs of the tag index with the changes committed by other processes, which
+# bounds how stale the index of a process can be. 0 disables syncing
+SYNC_INTERVAL = float(os.environ.get('TAG_INDEX_SYNC_INTERVAL', 5))
+
+# Number of changes above which a sync rebuilds the index rather than applying them
+SYNC_REBUILD_THRESHOLD = int(os.environ.get('TAG_INDEX_SYNC_REBUILD_THRESHOLD', 50000))
+
+# Number of changed links whose presence is read per statement during a sync
+SYNC_BATCH_SIZE = 1000
+
+# Seconds between prunes of the change logs by the sync thread
+PRUNE_INTERVAL = 60
+
+# Entries of the company tag change log logged by transactions not visible to a transaction snapshot
+CHANGES_SINCE = text("""
+    SELECT DISTINCT company_id, tag_id FROM company_tag_change
+    WHERE txid >= pg_snapshot_xmin(CAST(:snapshot AS pg_snapshot))::text::bigint
+    AND NOT pg_visible_in_snapshot(txid::text::xid8, CAST(:snapshot AS pg_snapshot))
+    LIMIT :limit
+""")
+
+# A tag is stored as a bitmap once more than 1 in DENSE_RATIO companies have it, the point at
+# which a bitmap of every company is smaller than 4 byte ordinals
+DENSE_RATIO = 32
+
+NONZERO_BYTES = re.compile(b'[^\x00]')
+
+# Bit positions set in each byte value, for extracting ordinals from bitmaps
+BYTE_BITS = [[bit for bit in range(8) if value & (1 << bit)] for value in range(256)]
+
+""" Returns a bitmap with the provided ordinals set """
+def to_bitmap(ordinals, size: int) -> int:
+    buffer = bytearray((size + 7) // 8)
+    for ordinal in ordinals:
+        buffer[ordinal >> 3] |= 1 << (ordinal & 7)
+    return int.from_bytes(buffer, 'little')
+
+""" Yields the ordinals set in a bitmap in ascending order, starting from the start ordinal """
+def iter_ordinals(bitmap: int, start=0):
+    bitmap >>= start
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for match in NONZERO_BYTES.finditer(data):
+        base = start + match.start() * 8
+        for bit in BYTE_BITS[data[match.start()]]:
+            yield base + bit
+
+# Number of bits set in each byte value
+BYTE_POPCOUNT = bytes(len(bits) for bits in BYTE_BITS)
+
+# Maps the characters of a binary string to byte values
+BINARY_DIGITS = bytes.maketrans(b'01', b'\x00\x01')
+
+""" Number of ordinals set in a bitmap """
+def popcount(bitmap: int) -> int:
+    return sum(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little').translate(BYTE_POPCOUNT))
+
+""" Expands a bitmap into one byte per ordinal, 1 for ordinals set and 0 otherwise """
+def to_flags(bitmap: int, size: int) -> bytes:
+    return bin(bitmap)[:1:-1].encode().translate(BINARY_DIGITS).ljust(size, b'\x00')
+
+""" Number of the provided ordinals flagged in a to_flags expansion """
+def count_flagged(flags: bytes, ordinals) -> int:
+    if len(ordinals) == 1:
+        return flags[ordinals[0]]
+    return sum(operator.itemgetter(*ordinals)(flags))
+
+class TagIndex:
+    # Version of the snapshot sections, to change along with them
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clear()
+        # Watermark of the database state the index was built from (see services.index_snapshot)
+        self.watermark = None
+        self.ready = False
+
+    """ Empties the index, whose queries then fall back to the database until it is built again """
+    def reset(self):
+        with self._lock:
+            self._clear()
+            self.watermark = None
+            self.ready = False
+
+    """ Replaces the index contents with every Company and CompanyTags row in the database """
+    def build(self):
+        with consistent_read() as (connection, watermark):
+            company_ids = sorted(row.id for row in connection.execute(select(Company.id)))
+            links = connection.execute(select(CompanyTags.company_id, CompanyTags.tag_id)).all()
+        with self._lock:
+            self._clear()
+            self.watermark = watermark
+            self._add_companies(company_ids)
+            # Companies are numbered in id order, so that pages of ids are read in bitmap order
+            self._ordered = len(self._companies)
+            members = {}
+            for row in links:
+                members.setdefault(row.tag_id, []).append(self._ordinals[row.company_id])
+            for tag_id, ordinals in members.items():
+                self._store(tag_id, set(ordinals))
+            self.ready = True
+        log.info("Tag index built with {} companies and {} tags".format(len(company_ids), len(members)))
+
+    """
+        Writes the index to a snapshot: the company ids in ordinal order, then the ids and
+        counts of the tags, and the postings of the tags held by companies, array postings as
+        ranges of a pool of ordinals and bitmaps as ranges of a pool of little endian bytes
+    """
+    def write_snapshot(self, writer):
+        with self._lock:
+            writer.metadata["ordered"] = self._ordered
+            writer.add_uuids("companies", self._companies)
+            writer.add_uuids("tags", self._counts)
+            writer.add_array("counts", 'I', self._counts.values())
+            arrays = [(tag_id, posting) for tag_id, posting in self._postings.items() if not isinstance(posting, int)]
+            bitmaps = [(tag_id, posting) for tag_id, posting in self._postings.items() if isinstance(posting, int)]
+            pool = array('I')
+            ends = array('I')
+            for _, posting in arrays:
+                pool.extend(posting)
+                ends.append(len(pool))
+            writer.add_uuids("array_tags", (tag_id for tag_id, _ in arrays))
+            writer.add_array("array_ends", 'I', ends)
+            writer.add_array("arrays", 'I', pool)
+            width = (len(self._companies) + 7) // 8
+            writer.add_uuids("bitmap_tags", (tag_id for tag_id, _ in bitmaps))
+            writer.add_bytes("bitmaps", b"".join(posting.to_bytes(width, 'little') for _, posting in bitmaps))
+
+    """ Replaces the index contents with those of a snapshot written by write_snapshot """
+    def load_snapshot(self, snapshot):
+        companies = snapshot.uuids("companies")
+        tag_ids = snapshot.uuids("tags")
+        with snapshot.array("counts") as counts:
+            tag_counts = dict(zip(tag_ids, counts.tolist()))
+        postings = {}
+        start = 0
+        with snapshot.array("array_ends") as ends, snapshot.bytes("arrays") as pool:
+            for tag_id, end in zip(snapshot.uuids("array_tags"), ends):
+                posting = array('I')
+                posting.frombytes(pool[start * posting.itemsize:end * posting.itemsize])
+                postings[tag_id] = posting
+                start = end
+        width = (len(companies) + 7) // 8
+        with snapshot.bytes("bitmaps") as pool:
+            for number, tag_id in enumerate(snapshot.uuids("bitmap_tags")):
+                postings[tag_id] = int.from_bytes(pool[number * width:(number + 1) * width], 'little')
+        with self._lock:
+            self._clear()
+            self._companies = companies
+            self._ordinals = dict(zip(companies, range(0, len(companies))))
+            self._ordered = snapshot.metadata["ordered"]
+            self._universe = (1 << len(companies)) - 1
+            self._postings = postings
+            self._counts = tag_counts
+            self.watermark = snapshot.watermark
+            self.ready = True
+        log.info("Tag index loaded with {} companies and {} tags".format(len(companies), len(postings)))
+
+    """
+        Applies the company tag links and companies changed since the watermark of the index,
+        by this or any other process, as read from the company tag change log. Links are applied
+        as the database holds them rather than as logged, so that changes read twice or out of
+        order leave the index as the database is. The index is rebuilt instead when the change
+        log no longer covers its watermark, asks for a rebuild, or holds more than
+        SYNC_REBUILD_THRESHOLD changes. Cached responses built from the changes are dropped
+    """
+    def sync(self):
+        watermark = self.watermark
+        if not self.ready or watermark == None:
+            return
+        rebuild = None
+        with consistent_read() as (connection, current):
+            if not index_snapshot.covers(connection, watermark):
+                rebuild = "the change log no longer covers it"
+            else:
+                changes = connection.execute(CHANGES_SINCE,
+                    { "snapshot": watermark["snapshot"], "limit": SYNC_REBUILD_THRESHOLD + 1 }).all()
+                if len(changes) > SYNC_REBUILD_THRESHOLD:
+                    rebuild = "more than {} changes were made".format(SYNC_REBUILD_THRESHOLD)
+                elif any(row.company_id == None for row in changes):
+                    rebuild = "a bulk change, company deletion or truncation was logged"
+                else:
+                    companies = [row.company_id for row in changes if row.tag_id == None]
+                    links = list(set((row.company_id, row.tag_id) for row in changes if row.tag_id != None))
+                    present = set()
+                    for start in range(0, len(links), SYNC_BATCH_SIZE):
+                        present.update((row.company_id, row.tag_id) for row in connection.execute(
+                            select(CompanyTags.company_id, CompanyTags.tag_id)
+                            .where(tuple_(CompanyTags.company_id, CompanyTags.tag_id).in_(links[start:start + SYNC_BATCH_SIZE]))))
+        if rebuild != None:
+            log.info("Rebuilding the tag index, {}".format(rebuild))
+            self.build()
+            response_cache.clear()
+            return
+        if len(changes) == 0:
+            self.watermark = current
+            return
+        with self._lock:
+            # Skipped when the index was rebuilt from a later state in the meantime
+            if self.watermark is not watermark:
+                return
+            self._add_companies(companies)
+            self.apply(added=[link for link in links if link in present], removed=[link for link in links if link not in present])
+            self.watermark = current
+        if len(companies) > 0:
+            response_cache.clear()
+        else:
+            response_cache.invalidate(company_ids=set(link[0] for link in links), tag_ids=set(link[1] for link in links))
+        log.info("Tag index synced {} changed links and {} new companies".format(len(links), len(companies)))
+
+    """ Registers new companies so that they are matched by queries negating tags """
+    def add_companies(self, company_ids):
+        with self._lock:
+            self._add_companies(company_ids)
+
+    """ Applies added and removed (company id, tag id) links """
+    def apply(self, added=(), removed=()):
+        with self._lock:
+            self._add_companies(company_id for company_id, _ in added)
+            changes = {}
+            for company_id, tag_id in added:
+                changes.setdefault(tag_id, (set(), set()))[0].add(self._ordinals[company_id])
+            for company_id, tag_id in removed:
+                ordinal = self._ordinals.get(company_id)
+                if ordinal != None:
+                    changes.setdefault(tag_id, (set(), set()))[1].add(ordinal)
+            for tag_id, (add, remove) in changes.items():
+                self._update(tag_id, add - remove, remove - add)
+
+    """
+        Evaluates a parsed tag query (see tag_query.parse), given a map of each tag reference to
+        the ids of the matching tags. Returns the ids of the matching companies in ascending
+        order, limited to limit ids greater than after when provided
+    """
+    def search(self, node: tuple, tag_ids: dict, limit=None, after=None) -> list:
+        with self._lock:
+            bitmap = self._evaluate(node, tag_ids)
+            companies = self._companies
+            ordered = self._ordered
+            # Ordinals below ordered follow company id order, later companies are scanned in full
+            start = 0 if after == None else bisect.bisect_right(companies, after, 0, ordered)
+            head = []
+            for ordinal in iter_ordinals(bitmap & ((1 << ordered) - 1), start):
+                head.append(companies[ordinal])
+                if limit != None and len(head) >= limit:
+                    break
+            tail = [companies[ordinal] for ordinal in iter_ordinals(bitmap, ordered)]
+        if after != None:
+            tail = [id for id in tail if id > after]
+        if len(tail) == 0:
+            return head
+        if limit != None:
+            return heapq.nsmallest(limit, head + tail)
+        return sorted(head + tail)
+
+    """ Returns the number of companies with each of the provided tags """
+    def counts(self, tag_ids) -> dict:
+        with self._lock:
+            return dict((tag_id, self._counts.get(tag_id, 0)) for tag_id in tag_ids)
+
+    """
+        Returns a map of tag id to the number of companies with the tag, for every tag held by
+        at least one company, along with the number of companies counted
+        Companies are limited to those matching a parsed tag query when node is provided, and
+        every company is counted otherwise, served from the maintained per tag counts
+    """
+    def facet_counts(self, node=None, tag_ids=None) -> tuple:
+        with self._lock:
+            if node == None:
+                return dict((tag_id, count) for tag_id, count in self._counts.items() if count > 0), len(self._companies)
+            selection = self._evaluate(node, tag_ids)
+            # Array postings are counted by looking their ordinals up in the expanded selection
+            flags = to_flags(selection, len(self._companies))
+            counts = {}
+            for tag_id, posting in self._postings.items():
+                if isinstance(posting, int):
+                    count = popcount(posting & selection)
+                else:
+                    count = count_flagged(flags, posting)
+                if count > 0:
+                    counts[tag_id] = count
+            return counts, popcount(selection)
+
+    def _clear(self):
+        # Ordinal -> company id
+        self._companies = []
+        # Company id -> ordinal
+        self._ordinals = {}
+        # Number of leading ordinals assigned in company id order
+        self._ordered = 0
+        # Bitmap of every company
+        self._universe = 0
+        # Tag id -> bitmap (int) or sorted ordinals (array)
+        self._postings = {}
+        # Tag id -> number of companies with the tag
+        self._counts = {}
+
+    def _add_companies(self, company_ids):
+        ordinals = []
+        for company_id in company_ids:
+            if company_id not in self._ordinals:
+                self._ordinals[company_id] = len(self._companies)
+                ordinals.append(len(self._companies))
+                self._companies.append(company_id)
+        if len(ordinals) > 0:
+            self._universe |= to_bitmap(ordinals, len(self._companies))
+
+    def _store(self, tag_id, ordinals: set):
+        self._counts[tag_id] = len(ordinals)
+        if len(ordinals) == 0:
+            self._postings.pop(tag_id, None)
+        elif len(ordinals) * DENSE_RATIO > len(self._companies):
+            self._postings[tag_id] = to_bitmap(ordinals, len(self._companies))
+        else:
+            self._postings[tag_id] = array('I', sorted(ordinals))
+
+    def _update(self, tag_id, add: set, remove: set):
+        posting = self._postings.get(tag_id)
+        if not isinstance(posting, int):
+            self._store(tag_id, (set(posting or ()) | add) - remove)
+            return
+
+        # Bitmaps are updated with masks rather than expanded, counting only the changed bits
+        added = to_bitmap(add, len(self._companies)) & ~posting
+        removed = to_bitmap(remove, len(self._companies)) & posting
+        posting = (posting | added) & ~removed
+        count = self._counts[tag_id] + popcount(added) - popcount(removed)
+        if count * DENSE_RATIO * 2 < len(self._companies):
+            # Half the density at which a tag becomes a bitmap, so tags do not flip at the boundary
+            self._store(tag_id, set(iter_ordinals(posting)))
+        else:
+            self._postings[tag_id] = posting
+            self._counts[tag_id] = count
+
+    def _bitmap(self, tag_id) -> int:
+        posting = self._postings.get(tag_id, 0)
+        if isinstance(posting, int):
+            return posting
+        return to_bitmap(posting, len(self._companies))
+
+    def _evaluate(self, node: tuple, tag_ids: dict) -> int:
+        if node[0] == "tag":
+            bitmap = 0
+            for tag_id in tag_ids[(node[1], node[2])]:
+                bitmap |= self._bitmap(tag_id)
+            return bitmap
+        if node[0] == "not":
+            return self._universe & ~self._evaluate(node[1], tag_ids)
+        if node[0] == "and" and node[2][0] == "not":
+            # A AND NOT B without materializing the complement of B
+            return self._evaluate(node[1], tag_ids) & ~self._evaluate(node[2][1], tag_ids)
+        left = self._evaluate(node[1], tag_ids)
+        right = self._evaluate(node[2], tag_ids)
+        return left & right if node[0] == "and" else left | right
+
+tag_index = TagIndex()
+
+"""
+    Keeps the tag index of the process in sync with the database, syncing it every SYNC_INTERVAL
+    seconds and pruning the change logs every PRUNE_INTERVAL seconds in a daemon thread. Each
+    process syncs its own index, so the production workers start the thread once forked
+"""
+def start_sync(index=tag_index):
+    if SYNC_INTERVAL <= 0:
+        log.info("Tag index sync is disabled")
+        return None
+
+    def run():
+        pruned = time.monotonic()
+        while True:
+            time.sleep(SYNC_INTERVAL)
+            try:
+                index.sync()
+                if time.monotonic() - pruned >= PRUNE_INTERVAL:
+                    pruned = time.monotonic()
+                    index_snapshot.prune([index.watermark])
+            except Exception:
+                log.exception("Tag index sync failed")
+
+    thread = threading.Thread(target=run, name="tag-index-sync", daemon=True)
+    thread.start()
+    log.info("Syncing the tag index every {}s".format(SYNC_INTERVAL))
+    return thread
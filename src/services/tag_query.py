@@ -0,0 +1,162 @@
+import re
+from sqlalchemy import and_, not_, or_, select, true
+from models.models import Company, CompanyTags
+from util.errors import InvalidRequestError
+from util.iso639_1 import languages as iso639_1
+
+"""
+    Parsing of boolean tag queries, such as tag_4 AND (tag_20 OR en:tag_16) NOT tag_3
+    Tags are combined with AND, OR and NOT (case insensitive) and parentheses, adjacent tags are
+    combined with AND and A NOT B selects companies with A but without B. A tag may be quoted
+    when its name contains spaces, and qualified with a language as language:name to match
+    only its localization in that language
+    Queries are parsed into tuples of ("tag", name, language), ("and", left, right),
+    ("or", left, right) and ("not", operand)
+"""
+
+# Maximum number of tags referenced by a single query
+MAX_TERMS = 32
+
+# Maximum nesting of parentheses and NOT operators in a single query, which bounds the
+# recursion of the parser and of query evaluation
+MAX_DEPTH = 32
+
+language_set = set(map(lambda lang:lang[0], iso639_1))
+
+TOKEN_PATTERN = re.compile(r'\s*(\(|\)|(?:[A-Za-z]{2}:)?"(?:[^"\\]|\\.)*"|[^\s()]+)')
+KEYWORDS = { "AND", "OR", "NOT" }
+
+def tokenize(query: str) -> list:
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if match == None:
+            raise InvalidRequestError("Unterminated quote in tag query")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+""" Parses a tag reference token into a ("tag", name, language) node """
+def parse_tag(token: str) -> tuple:
+    language = None
+    if len(token) > 3 and token[2] == ":" and token[:2].lower() in language_set:
+        language = token[:2].lower()
+        token = token[3:]
+    if token.startswith('"'):
+        if len(token) < 2 or not token.endswith('"'):
+            raise InvalidRequestError("Unterminated quote in tag query")
+        token = re.sub(r'\\(.)', r'\1', token[1:-1])
+    if len(token) == 0:
+        raise InvalidRequestError("Empty tag name in tag query")
+    return ("tag", token, language)
+
+class Parser:
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+        self.terms = 0
+        self.depth = 0
+
+    def parse(self) -> tuple:
+        if len(self.tokens) == 0:
+            raise InvalidRequestError("Tag query must reference at least one tag")
+        node = self._expression()
+        if self.position < len(self.tokens):
+            raise InvalidRequestError("Unexpected '%s' in tag query"%self.tokens[self.position])
+        return node
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _keyword(self):
+        token = self._peek()
+        if token != None and token.upper() in KEYWORDS:
+            return token.upper()
+        return None
+
+    # expression := conjunction (OR conjunction)*
+    def _expression(self) -> tuple:
+        node = self._conjunction()
+        while self._keyword() == "OR":
+            self.position += 1
+            node = ("or", node, self._conjunction())
+        return node
+
+    # conjunction := factor ((AND | NOT)? factor)*, where A NOT B is A AND NOT B
+    def _conjunction(self) -> tuple:
+        node = self._factor()
+        while True:
+            keyword = self._keyword()
+            token = self._peek()
+            if keyword == "AND":
+                self.position += 1
+                node = ("and", node, self._factor())
+            elif keyword == "NOT":
+                self.position += 1
+                node = ("and", node, ("not", self._factor()))
+            elif token != None and keyword == None and token != ")":
+                node = ("and", node, self._factor())
+            else:
+                return node
+
+    # factor := NOT factor | ( expression ) | tag
+    def _factor(self) -> tuple:
+        token = self._peek()
+        if token == None:
+            raise InvalidRequestError("Tag query ends unexpectedly")
+        self.position += 1
+        if token.upper() == "NOT":
+            return ("not", self._nested(self._factor))
+        if token == "(":
+            node = self._nested(self._expression)
+            if self._peek() != ")":
+                raise InvalidRequestError("Missing ')' in tag query")
+            self.position += 1
+            return node
+        if token == ")" or token.upper() in KEYWORDS:
+            raise InvalidRequestError("Unexpected '%s' in tag query"%token)
+        self.terms += 1
+        if self.terms > MAX_TERMS:
+            raise InvalidRequestError("Tag queries may reference at most %s tags"%MAX_TERMS)
+        return parse_tag(token)
+
+    """ Parses a nested factor or expression, failing once nesting exceeds MAX_DEPTH """
+    def _nested(self, rule) -> tuple:
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise InvalidRequestError("Tag queries may nest parentheses and NOT at most %s deep"%MAX_DEPTH)
+        node = rule()
+        self.depth -= 1
+        return node
+
+""" Parses a tag query, raising InvalidRequestError when it is malformed """
+def parse(query: str) -> tuple:
+    return Parser(tokenize(query)).parse()
+
+""" Lists the distinct (name, language) tag references of a parsed query """
+def tag_references(node: tuple) -> list:
+    if node[0] == "tag":
+        return [(node[1], node[2])]
+    references = []
+    for child in node[1:]:
+        references.extend(reference for reference in tag_references(child) if reference not in references)
+    return references
+
+"""
+    Compiles a parsed query into a condition on Company.id, given a map of tag reference to
+    the ids of matching tags, for evaluation by the database
+"""
+def company_condition(node: tuple, tag_ids: dict):
+    if node[0] == "tag":
+        ids = tag_ids[(node[1], node[2])]
+        if len(ids) == 0:
+            return not_(true())
+        return Company.id.in_(select(CompanyTags.company_id).where(CompanyTags.tag_id.in_(ids)))
+    if node[0] == "not":
+        return not_(company_condition(node[1], tag_ids))
+    children = [company_condition(child, tag_ids) for child in node[1:]]
+    return and_(*children) if node[0] == "and" else or_(*children)
@@ -12,3 +12,8 @@ class NotFoundError(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+class InvalidRequestError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
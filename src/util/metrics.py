@@ -0,0 +1,207 @@
+import bisect
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import uuid
+from flask import Flask, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from util import logger
+
+"""
+    Per-request latency, SQL and serialization metrics, rendered in the Prometheus text
+    exposition format
+"""
+
+log = logger.create_logger('metrics')
+
+# Statements running longer than this many milliseconds are logged, 0 disables the log
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+
+# Requests carrying an X-Profile: true header are profiled when enabled, with the profile
+# written into PROFILE_DIR
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '').upper() == "TRUE"
+PROFILE_DIR = os.environ.get('PROFILE_DIR', './profiles')
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+STATEMENT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+class Histogram:
+    def __init__(self, buckets: list):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+"""
+    Statement and timing counters of the request being served, held in a context variable so
+    that they follow the request across threads and event loop tasks
+"""
+class RequestStats:
+    def __init__(self, route: str):
+        self.route = route
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.serialization_seconds = 0.0
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (route, method, status) -> latency Histogram
+        self.latency = {}
+        # route -> Histogram of statements per request
+        self.statements = {}
+        # route -> [statements, sql seconds, serialization seconds]
+        self.totals = {}
+        self.slow_queries = 0
+
+    def record_request(self, stats: RequestStats, method: str, status: int):
+        elapsed = time.perf_counter() - stats.started
+        with self._lock:
+            key = (stats.route, method, str(status))
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.latency[key].observe(elapsed)
+            if stats.route not in self.statements:
+                self.statements[stats.route] = Histogram(STATEMENT_BUCKETS)
+                self.totals[stats.route] = [0, 0.0, 0.0]
+            self.statements[stats.route].observe(stats.statements)
+            totals = self.totals[stats.route]
+            totals[0] += stats.statements
+            totals[1] += stats.sql_seconds
+            totals[2] += stats.serialization_seconds
+
+    def record_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    """ Renders every metric in the Prometheus text exposition format """
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            lines.append("# HELP http_request_duration_seconds Request latency by route, method and status")
+            lines.append("# TYPE http_request_duration_seconds histogram")
+            for (route, method, status), histogram in sorted(self.latency.items()):
+                labels = 'route="{}",method="{}",status="{}"'.format(escape(route), method, status)
+                render_histogram(lines, "http_request_duration_seconds", labels, histogram)
+
+            lines.append("# HELP http_request_sql_statements SQL statements issued per request by route")
+            lines.append("# TYPE http_request_sql_statements histogram")
+            for route, histogram in sorted(self.statements.items()):
+                render_histogram(lines, "http_request_sql_statements", 'route="{}"'.format(escape(route)), histogram)
+
+            for index, (name, description) in enumerate([
+                ("http_request_sql_statements_total", "SQL statements issued by route"),
+                ("http_request_sql_seconds_total", "Seconds spent executing SQL by route"),
+                ("http_request_serialization_seconds_total", "Seconds spent serializing responses by route")
+            ]):
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} counter".format(name))
+                for route, totals in sorted(self.totals.items()):
+                    lines.append('{}{{route="{}"}} {}'.format(name, escape(route), format_value(totals[index])))
+
+            lines.append("# HELP sql_slow_queries_total Statements slower than the slow query threshold")
+            lines.append("# TYPE sql_slow_queries_total counter")
+            lines.append("sql_slow_queries_total {}".format(self.slow_queries))
+        return "\n".join(lines) + "\n"
+
+def render_histogram(lines: list, name: str, labels: str, histogram: Histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, format_value(bound), cumulative))
+    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, histogram.count))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, format_value(histogram.sum)))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = MetricsRegistry()
+
+""" Starts collecting the statistics of a request served under the route """
+def begin_request(route: str):
+    stats = RequestStats(route)
+    return stats, current_request.set(stats)
+
+""" Records a finished request and stops collecting its statistics """
+def end_request(stats: RequestStats, token, method: str, status: int):
+    metrics.record_request(stats, method, status)
+    current_request.reset(token)
+
+""" Adds time spent serializing a response to the current request """
+def record_serialization(seconds: float):
+    stats = current_request.get()
+    if stats != None:
+        stats.serialization_seconds += seconds
+
+# Every engine, including the sync engine underlying the async engine, reports its statements
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info['query_started'].pop()
+    stats = current_request.get()
+    if stats != None:
+        stats.statements += 1
+        stats.sql_seconds += elapsed
+    if SLOW_QUERY_MS > 0 and elapsed * 1000 >= SLOW_QUERY_MS:
+        metrics.record_slow_query()
+        log.warning("Slow query ({:.1f}ms) in {}: {}".format(elapsed * 1000,
+            stats.route if stats != None else "no request", " ".join(statement.split())[:500]))
+
+"""
+    Writes the cProfile profile of a request into PROFILE_DIR and logs its most expensive
+    functions. Returns the id of the profile
+"""
+def save_profile(profile: cProfile.Profile, route: str) -> str:
+    profile_id = uuid.uuid4().hex
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, "{}.prof".format(profile_id))
+    profile.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(15)
+    log.info("Profiled request to {} written to {}\n{}".format(route, path, summary.getvalue()))
+    return profile_id
+
+""" Whether the request asked to be profiled and profiling is enabled """
+def profiling_requested(header_value) -> bool:
+    return PROFILING_ENABLED and header_value != None and header_value.lower() == "true"
+
+""" Records the metrics of every request served by the Flask application """
+def initialize_metrics(app: Flask):
+    @app.before_request
+    def start_request_metrics():
+        route = request.url_rule.rule if request.url_rule != None else "unmatched"
+        g.request_stats, g.request_stats_token = begin_request(route)
+        if profiling_requested(request.headers.get('X-Profile')):
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        stats = g.pop('request_stats', None)
+        if stats != None:
+            end_request(stats, g.pop('request_stats_token'), request.method, response.status_code)
+        profile = g.pop('profile', None)
+        if profile != None:
+            profile.disable()
+            response.headers['X-Profile-Id'] = save_profile(profile, stats.route)
+        return response
@@ -0,0 +1,66 @@
+"""
+    Script specific search keys for company names
+    Korean names are searched by their decomposed jamo, so that the partial syllables produced
+    while a name is being typed match, and by their initial consonants (chosung), as in
+    ㅇㅌㄷㄹ for 원티드랩. Japanese names are searched with katakana folded into hiragana
+"""
+
+HANGUL_SYLLABLE_FIRST = 0xAC00
+HANGUL_SYLLABLE_LAST = 0xD7A3
+
+# Compatibility jamo of the initial, medial and final of Hangul syllables, in the order of the
+# syllable and conjoining jamo blocks. Compound vowels and finals are split into the simple
+# jamo they are typed as, so that a syllable still being composed is a prefix of the full one
+INITIALS = "ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎ"
+MEDIALS = ["ㅏ", "ㅐ", "ㅑ", "ㅒ", "ㅓ", "ㅔ", "ㅕ", "ㅖ", "ㅗ", "ㅗㅏ", "ㅗㅐ", "ㅗㅣ", "ㅛ", "ㅜ",
+    "ㅜㅓ", "ㅜㅔ", "ㅜㅣ", "ㅠ", "ㅡ", "ㅡㅣ", "ㅣ"]
+FINALS = ["", "ㄱ", "ㄲ", "ㄱㅅ", "ㄴ", "ㄴㅈ", "ㄴㅎ", "ㄷ", "ㄹ", "ㄹㄱ", "ㄹㅁ", "ㄹㅂ", "ㄹㅅ", "ㄹㅌ",
+    "ㄹㅍ", "ㄹㅎ", "ㅁ", "ㅂ", "ㅂㅅ", "ㅅ", "ㅆ", "ㅇ", "ㅈ", "ㅊ", "ㅋ", "ㅌ", "ㅍ", "ㅎ"]
+
+# Conjoining jamo, which NFKC normalization turns compatibility jamo into
+CONJOINING_INITIAL_FIRST = 0x1100
+CONJOINING_MEDIAL_FIRST = 0x1161
+CONJOINING_FINAL_FIRST = 0x11A8
+
+JAMO = {}
+for index, initial in enumerate(INITIALS):
+    JAMO[chr(CONJOINING_INITIAL_FIRST + index)] = initial
+for index, medial in enumerate(MEDIALS):
+    JAMO[chr(CONJOINING_MEDIAL_FIRST + index)] = medial
+for index, final in enumerate(FINALS[1:]):
+    JAMO[chr(CONJOINING_FINAL_FIRST + index)] = final
+
+# Translation tables from Hangul syllables and conjoining jamo to their decomposed jamo and
+# their initial consonant, built once so that keys are computed by str.translate
+JAMO_TRANSLATION = dict((ord(char), jamo) for char, jamo in JAMO.items())
+CHOSUNG_TRANSLATION = dict(JAMO_TRANSLATION)
+for code in range(HANGUL_SYLLABLE_FIRST, HANGUL_SYLLABLE_LAST + 1):
+    index = code - HANGUL_SYLLABLE_FIRST
+    JAMO_TRANSLATION[code] = INITIALS[index // 588] + MEDIALS[(index % 588) // 28] + FINALS[index % 28]
+    CHOSUNG_TRANSLATION[code] = INITIALS[index // 588]
+
+KATAKANA_TO_HIRAGANA = dict((code, code - 0x60) for code in range(0x30A1, 0x30F7))
+
+""" Replaces katakana with the matching hiragana """
+def fold_kana(text: str) -> str:
+    return text.translate(KATAKANA_TO_HIRAGANA)
+
+""" Whether the text contains Hangul syllables or jamo """
+def has_hangul(text: str) -> bool:
+    return any(ord(char) in JAMO_TRANSLATION for char in text)
+
+""" Decomposes the Hangul syllables and conjoining jamo of a text into compatibility jamo """
+def jamo_key(text: str) -> str:
+    return text.translate(JAMO_TRANSLATION)
+
+""" Replaces the Hangul syllables of a text with their initial consonant """
+def chosung_key(text: str) -> str:
+    return text.translate(CHOSUNG_TRANSLATION)
+
+"""
+    Whether a normalized search string consists only of initial consonants (and spaces), as
+    typed when searching by chosung
+"""
+def is_chosung_query(text: str) -> bool:
+    letters = [char for char in text if not char.isspace()]
+    return len(letters) > 0 and all(CONJOINING_INITIAL_FIRST <= ord(char) < CONJOINING_INITIAL_FIRST + len(INITIALS) for char in letters)
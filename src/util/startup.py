@@ -0,0 +1,97 @@
+import threading
+import time
+from util import logger
+
+"""
+    Tracking of the application start-up steps (population, migrations and index builds), so
+    that their progress can be reported while the server is already accepting connections
+"""
+
+log = logger.create_logger('startup')
+
+class Startup:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # starting, ready or failed
+        self.state = "starting"
+        self.step = None
+        self.progress = {}
+        self.completed = []
+        self.error = None
+        self.started = time.perf_counter()
+        self.seconds = None
+        self._done = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def failed(self) -> bool:
+        return self.state == "failed"
+
+    """
+        Runs the (name, function) steps in order, raising the error of a failed step after
+        recording it
+    """
+    def run(self, steps: list):
+        try:
+            for name, function in steps:
+                with self._lock:
+                    self.step = name
+                    self.progress = {}
+                started = time.perf_counter()
+                log.info("Start-up step {}".format(name))
+                function()
+                with self._lock:
+                    self.completed.append({ "step": name, "seconds": round(time.perf_counter() - started, 3) })
+        except Exception as ex:
+            log.exception("Start-up step {} failed".format(self.step))
+            with self._lock:
+                self.state = "failed"
+                self.error = "{}: {}".format(type(ex).__name__, ex)
+            raise
+        with self._lock:
+            self.state = "ready"
+            self.step = None
+            self.progress = {}
+            self.seconds = round(time.perf_counter() - self.started, 3)
+        self._done.set()
+        log.info("Start-up completed in {}s".format(self.seconds))
+
+    """ Blocks until the steps are done, which never happens once one has failed """
+    def wait(self):
+        self._done.wait()
+
+    """ Runs the steps in a background thread, returning immediately """
+    def start(self, steps: list) -> threading.Thread:
+        def run_steps():
+            try:
+                self.run(steps)
+            except Exception:
+                # Recorded by run and reported through status
+                pass
+        thread = threading.Thread(target=run_steps, name="startup", daemon=True)
+        thread.start()
+        return thread
+
+    """ Records the progress of the current step, e.g. the number of rows imported """
+    def update(self, **progress):
+        with self._lock:
+            self.progress.update(progress)
+
+    def status(self) -> dict:
+        with self._lock:
+            status = {
+                "status": self.state,
+                "completed": list(self.completed),
+                "seconds": self.seconds if self.seconds != None else round(time.perf_counter() - self.started, 3)
+            }
+            if self.step != None:
+                status["step"] = self.step
+                status["progress"] = dict(self.progress)
+            if self.error != None:
+                status["error"] = self.error
+            return status
+
+startup = Startup()
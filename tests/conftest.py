@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+from flask import Flask
+
+"""
+    Shared fixtures of the test suite. The tests read the catalog of the database configured by
+    DB_URL, populated as on start-up, and are skipped when it is not set
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+""" Flask application bound to the configured database, with an application context pushed """
+@pytest.fixture(scope="session")
+def app():
+    if os.environ.get('DB_URL') == None:
+        pytest.skip("DB_URL is not set")
+    from models.models import db, initialize_sql
+    app = Flask(__name__)
+    initialize_sql(db, app)
+    with app.app_context():
+        yield app
@@ -0,0 +1,156 @@
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+import pytest
+from services import name_index as name_index_module
+from services.name_index import NameIndex, merge_sorted, normalize, substring_distance, word_starts
+
+"""
+    Substring search and ranked autocomplete of the name index, including jamo, chosung and
+    kana matching. Indexes are built from rows provided in place of the database
+"""
+
+NameRow = namedtuple("NameRow", ["company_id", "language", "name"])
+
+class Rows(list):
+    def all(self):
+        return list(self)
+
+class RowsConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, statement):
+        return Rows(self.rows)
+
+""" Company ids numbered in name order, so that expected orders read naturally """
+def company(number: int) -> uuid.UUID:
+    return uuid.UUID(int=number)
+
+NAMES = [
+    (1, "en", "Wanted Lab"),
+    (2, "en", "Lab Wanted"),
+    (3, "en", "Swanted"),
+    (4, "en", "Wented Systems"),
+    (5, "en", "Unrelated"),
+    (6, "ko", "원티드랩"),
+    (7, "ko", "원더풀"),
+    (8, "ko", "주식회사 원티드"),
+    (9, "ja", "ワンテッド"),
+    (10, "ja", "わんだふる"),
+    (11, "en", "ＡＢＣ Trading"),
+    (1, "ko", "원티드"),
+]
+
+@pytest.fixture
+def index(monkeypatch) -> NameIndex:
+    @contextmanager
+    def rows_read():
+        yield RowsConnection([NameRow(company(number), language, name) for number, language, name in NAMES]), None
+    monkeypatch.setattr(name_index_module, "consistent_read", rows_read)
+    index = NameIndex()
+    index.build()
+    return index
+
+def ids(*numbers) -> list:
+    return [company(number) for number in numbers]
+
+def test_autocomplete_tiers(index):
+    # Prefix, then word start, then substring, then typo matches
+    assert index.autocomplete("wanted", 10) == ids(1, 2, 3, 4)
+    assert index.autocomplete("wanted", 2) == ids(1, 2)
+    assert index.autocomplete("WANTED", 3) == ids(1, 2, 3)
+
+def test_autocomplete_typos_need_length(index):
+    assert index.autocomplete("wen", 10) == ids(4)
+    # Typo matches are ranked by edits, then name length. "wented" is two edits away
+    assert index.autocomplete("wantd", 10) == ids(3, 2, 1)
+
+def test_autocomplete_word_prefix(index):
+    assert index.autocomplete("lab", 10) == ids(2, 1)
+    assert index.autocomplete("sys", 10) == ids(4)
+
+def test_autocomplete_jamo(index):
+    # A syllable still being typed matches the names it is a prefix of, in jamo order
+    assert index.autocomplete("원", 10) == ids(7, 1, 6, 8)
+    assert index.autocomplete("원ㅌ", 10) == ids(1, 6, 8)
+    assert index.autocomplete("원틷", 10) == ids(1, 6, 8)
+    assert index.autocomplete("원티드", 10) == ids(1, 6, 8)
+    # Then names one typo away, shortest first
+    assert index.autocomplete("원티드랩", 10) == ids(6, 1, 8)
+
+def test_autocomplete_chosung(index):
+    assert index.autocomplete("ㅇㅌㄷ", 10) == ids(1, 6, 8)
+    assert index.autocomplete("ㅇㅌㄷㄹ", 10) == ids(6)
+    assert index.autocomplete("ㅇㄷ", 10) == ids(7)
+    assert index.autocomplete("ㅈㅅ", 10) == ids(8)
+    # Chosung strings are only matched at name and word starts
+    assert index.autocomplete("ㅌㄷ", 10) == []
+
+def test_autocomplete_kana(index):
+    assert index.autocomplete("わんて", 10) == ids(9)
+    assert index.autocomplete("ワンダ", 10) == ids(10)
+    assert index.autocomplete("ﾜﾝﾃ", 10) == ids(9)
+
+def test_autocomplete_width(index):
+    assert index.autocomplete("abc", 10) == ids(11)
+    assert index.autocomplete("ＴＲＡＤ", 10) == ids(11)
+
+def test_autocomplete_empty(index):
+    assert index.autocomplete("   ", 10) == []
+    assert index.autocomplete("zzzz", 10) == []
+
+def test_search(index):
+    assert index.search("ant") == ids(1, 2, 3)
+    assert index.search("ant", limit=2) == ids(1, 2)
+    assert index.search("ant", after=company(1)) == ids(2, 3)
+    assert index.search("티드") == ids(1, 6, 8)
+    # Katakana and hiragana match each other
+    assert index.search("ワン") == ids(9, 10)
+    assert index.search("q") == []
+
+def test_add_and_remove(index):
+    index.add(company(5), "en", "Wanted Again")
+    assert index.autocomplete("wanted", 10) == ids(5, 1, 2, 3, 4)
+    index.remove(company(5), "en")
+    assert index.autocomplete("wanted", 10) == ids(1, 2, 3, 4)
+    assert index.search("unrelated") == []
+
+def test_add_many_matches_add(index, monkeypatch):
+    names = [(company(20 + number), "en", "Wanted %d"%number) for number in range(30)] \
+        + [(company(1), "en", "Renamed"), (company(6), "ko", "원티드 코리아"), (company(40), "ko", "원조")]
+    one_by_one = NameIndex()
+    one_by_one._sorted = dict((form, (list(keys), list(words))) for form, (keys, words) in index._sorted.items())
+    one_by_one._entries = list(index._entries)
+    one_by_one._positions = dict(index._positions)
+    one_by_one._postings = dict((gram, set(posting)) for gram, posting in index._postings.items())
+    for company_id, language, name in names:
+        one_by_one.add(company_id, language, name)
+    index.add_many(names)
+    assert index._sorted == one_by_one._sorted
+    for query in ["wanted", "원", "ㅇㅌ", "renamed", "lab", "1"]:
+        assert index.autocomplete(query, 50) == one_by_one.autocomplete(query, 50), query
+        assert index.search(query) == one_by_one.search(query), query
+
+def test_add_many_keeps_last_name(index):
+    index.add_many([(company(5), "en", "First"), (company(5), "en", "Second")])
+    assert index.search("first") == [] and index.search("second") == ids(5)
+
+def test_reset(index):
+    index.reset()
+    assert not index.ready and index.autocomplete("wanted", 10) == [] and index.search("a") == []
+
+def test_merge_sorted():
+    array = [1, 3, 5, 7]
+    merge_sorted(array, [8, 0, 4, 4])
+    assert array == [0, 1, 3, 4, 4, 5, 7, 8]
+    empty = []
+    merge_sorted(empty, [2, 1])
+    assert empty == [1, 2]
+
+def test_helpers():
+    assert normalize("ＡＢＣ ワン") == "abc わん"
+    assert word_starts("wanted lab-co") == [7, 11]
+    assert substring_distance("wanted", "the wanted lab", 1) == 0
+    assert substring_distance("wantd", "wanted", 1) == 1
+    assert substring_distance("wxyzd", "wanted", 2) == None
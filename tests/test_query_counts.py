@@ -0,0 +1,86 @@
+import pytest
+from sqlalchemy import event, func, select
+from models.models import db, CompanyName, CompanyTags, TagLocalization
+from services import company_service
+from services.tag_cache import tag_cache
+
+"""
+    Checks that the read paths load companies in a fixed number of statements, whatever the
+    number of companies returned
+"""
+
+# Number of companies of the larger result sets, within a single hydration batch
+MANY = 50
+
+""" Runs a call and returns its result along with the number of statements it issued """
+def count_statements(call):
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, "before_cursor_execute", listener)
+    try:
+        result = call()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", listener)
+    return result, len(statements)
+
+"""
+    Runs a call for 1 and for MANY companies with cold caches, asserting that both return as many
+    companies as requested and issue the same number of statements. Returns that number
+"""
+def assert_constant(call):
+    counts = []
+    for size in (1, MANY):
+        tag_cache.clear()
+        companies, count = count_statements(lambda: call(size))
+        if len(companies) < size:
+            pytest.skip("The catalog holds fewer than {} matching companies".format(size))
+        assert len(companies) == size
+        counts.append(count)
+    assert counts[0] == counts[1]
+    return counts[0]
+
+@pytest.fixture(scope="module")
+def company_ids(app):
+    company_ids = [row.company_id for row in db.session.execute(
+        select(CompanyName.company_id).distinct().order_by(CompanyName.company_id).limit(MANY))]
+    if len(company_ids) == 0:
+        pytest.skip("The catalog holds no companies")
+    return company_ids
+
+""" English name of the tag held by the most companies """
+@pytest.fixture(scope="module")
+def tag_name(app):
+    row = db.session.execute(select(TagLocalization.name)
+        .join(CompanyTags, CompanyTags.tag_id == TagLocalization.tag_id)
+        .where(TagLocalization.language == "en")
+        .group_by(TagLocalization.name).order_by(func.count().desc()).limit(1)).first()
+    if row == None:
+        pytest.skip("The catalog holds no tagged companies")
+    return row.name
+
+""" A single character of a company name, contained in the names of many companies """
+@pytest.fixture(scope="module")
+def name_fragment(app):
+    row = db.session.execute(select(CompanyName.name).where(CompanyName.language == "en").limit(1)).first()
+    if row == None:
+        pytest.skip("The catalog holds no company names")
+    return row.name[0]
+
+def test_id_list(company_ids):
+    count = assert_constant(lambda size: [company for company in company_service.get_companies_by_id_list(company_ids[:size]) if company != None])
+    assert count == 1
+
+def test_company_lookup(company_ids):
+    assert count_statements(lambda: company_service.get_company_by_id(str(company_ids[0])))[1] == 1
+
+def test_name_match(name_fragment):
+    assert_constant(lambda size: company_service.get_companies_by_name_match(name_fragment, limit=size))
+
+def test_name_match_with_languages(name_fragment):
+    assert_constant(lambda size: company_service.get_companies_by_name_match(name_fragment, limit=size, languages=["ko", "en"]))
+
+def test_tag(tag_name):
+    assert_constant(lambda size: company_service.get_companies_by_tag(tag_name, limit=size))
+
+def test_tag_query(tag_name):
+    assert_constant(lambda size: company_service.get_companies_by_tag_query('"{}"'.format(tag_name), limit=size)[0])
@@ -0,0 +1,45 @@
+import unicodedata
+from util.search_keys import chosung_key, fold_kana, has_hangul, is_chosung_query, jamo_key
+
+"""
+    Script specific search keys: jamo decomposition, chosung and kana folding
+"""
+
+def test_jamo_key():
+    assert jamo_key("원티드") == "ㅇㅜㅓㄴㅌㅣㄷㅡ"
+    # Compound finals and vowels are split into the jamo they are typed as
+    assert jamo_key("값") == "ㄱㅏㅂㅅ"
+    assert jamo_key("의") == "ㅇㅡㅣ"
+    assert jamo_key("lab 1") == "lab 1"
+
+def test_partial_syllables_are_prefixes():
+    assert jamo_key("원티드").startswith(jamo_key("원틷"))
+    assert jamo_key("값").startswith(jamo_key("갑"))
+
+def test_chosung_key():
+    assert chosung_key("원티드랩") == "ㅇㅌㄷㄹ"
+    assert chosung_key("원티드 Lab") == "ㅇㅌㄷ Lab"
+
+def test_normalized_jamo():
+    # Normalization turns compatibility jamo into conjoining jamo, which map back the same way
+    typed = unicodedata.normalize('NFKC', "ㅇㅌ")
+    assert typed != "ㅇㅌ"
+    assert jamo_key(typed) == "ㅇㅌ" and chosung_key(typed) == "ㅇㅌ"
+
+def test_is_chosung_query():
+    assert is_chosung_query(unicodedata.normalize('NFKC', "ㅇㅌㄷ"))
+    assert is_chosung_query(unicodedata.normalize('NFKC', "ㅇㅌ ㄷㄹ"))
+    assert not is_chosung_query(unicodedata.normalize('NFKC', "ㅏ"))
+    assert not is_chosung_query("원티드")
+    assert not is_chosung_query(unicodedata.normalize('NFKC', "ㅇa"))
+    assert not is_chosung_query("  ")
+
+def test_has_hangul():
+    assert has_hangul("abc 원")
+    assert has_hangul(unicodedata.normalize('NFKC', "ㅇ"))
+    assert not has_hangul("ワンテッド abc")
+
+def test_fold_kana():
+    assert fold_kana("ワンテッド") == "わんてっど"
+    assert fold_kana("わんテッド Lab") == "わんてっど Lab"
+    assert fold_kana("ヴ") == "ゔ"
@@ -0,0 +1,196 @@
+import random
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+import pytest
+from services import tag_index as tag_index_module
+from services.tag_index import DENSE_RATIO, TagIndex, iter_ordinals, popcount, to_bitmap
+from services.tag_query import parse, tag_references
+
+"""
+    Evaluation of tag queries and facet counts by the tag index, checked against the same
+    queries evaluated on Python sets. The index is built from rows provided in place of the
+    database, so that both bitmap and array postings and companies added after the build are
+    covered
+"""
+
+CompanyRow = namedtuple("CompanyRow", ["id"])
+LinkRow = namedtuple("LinkRow", ["company_id", "tag_id"])
+
+class Rows(list):
+    def all(self):
+        return list(self)
+
+""" Connection answering the two statements of TagIndex.build from in-memory rows """
+class RowsConnection:
+    def __init__(self, company_ids, links):
+        self.company_ids = company_ids
+        self.links = links
+
+    def execute(self, statement):
+        if [column.name for column in statement.selected_columns] == ["id"]:
+            return Rows(CompanyRow(id) for id in self.company_ids)
+        return Rows(LinkRow(*link) for link in self.links)
+
+class Catalog:
+    def __init__(self, seed: int, companies=400, tags=8):
+        self.random = random.Random(seed)
+        self.companies = [uuid.UUID(int=self.random.getrandbits(128)) for _ in range(companies)]
+        self.tags = [uuid.UUID(int=self.random.getrandbits(128)) for _ in range(tags)]
+        # Tag i is held by a share of the companies from most to very few, on both sides of DENSE_RATIO
+        shares = [0.5, 0.3, 0.1, 1.0 / DENSE_RATIO, 0.02, 0.01, 0.005, 0.0]
+        self.members = dict((tag_id, set(company for company in self.companies if self.random.random() < share))
+            for tag_id, share in zip(self.tags, shares))
+        # Reference -> tag ids, b matching two tags and missing matching none
+        self.tag_ids = {
+            ("a", None): [self.tags[0]],
+            ("b", None): [self.tags[3], self.tags[5]],
+            ("c", None): [self.tags[1]],
+            ("d", "en"): [self.tags[4]],
+            ("e", None): [self.tags[6]],
+            ("missing", None): [],
+        }
+
+    def links(self) -> list:
+        return [(company, tag_id) for tag_id, members in self.members.items() for company in members]
+
+    """ Companies matching a parsed query, evaluated on sets """
+    def evaluate(self, node: tuple) -> set:
+        if node[0] == "tag":
+            return set().union(*(self.members[tag_id] for tag_id in self.tag_ids[(node[1], node[2])]))
+        if node[0] == "not":
+            return set(self.companies) - self.evaluate(node[1])
+        left, right = self.evaluate(node[1]), self.evaluate(node[2])
+        return left & right if node[0] == "and" else left | right
+
+    def add_company(self, tags=()):
+        company = uuid.UUID(int=self.random.getrandbits(128))
+        self.companies.append(company)
+        for tag_id in tags:
+            self.members[tag_id].add(company)
+        return company
+
+@pytest.fixture
+def build(monkeypatch):
+    def build_index(catalog: Catalog) -> TagIndex:
+        @contextmanager
+        def rows_read():
+            yield RowsConnection(list(catalog.companies), catalog.links()), None
+        monkeypatch.setattr(tag_index_module, "consistent_read", rows_read)
+        index = TagIndex()
+        index.build()
+        return index
+    return build_index
+
+QUERIES = [
+    "a",
+    "b",
+    "missing",
+    "NOT missing",
+    "a AND c",
+    "a c",
+    "a OR b",
+    "a NOT c",
+    "NOT a",
+    "NOT (a OR c)",
+    "en:d OR e",
+    "(a OR b) AND NOT (c OR en:d)",
+    "a AND missing",
+    "b OR NOT a",
+    "NOT NOT e",
+]
+
+""" Checks search and facet_counts on every query against the set evaluation """
+def check(index: TagIndex, catalog: Catalog):
+    for query in QUERIES:
+        node = parse(query)
+        tag_ids = dict((reference, catalog.tag_ids[reference]) for reference in tag_references(node))
+        expected = sorted(catalog.evaluate(node))
+        assert index.search(node, tag_ids) == expected, query
+        for limit, after in [(1, None), (7, None), (10, expected[len(expected) // 2] if expected else None),
+                (1000, catalog.companies[0]), (None, uuid.UUID(int=0)), (5, uuid.UUID(int=(1 << 128) - 1))]:
+            matches = [company for company in expected if after == None or company > after]
+            assert index.search(node, tag_ids, limit=limit, after=after) == matches[:limit], (query, limit, after)
+
+        counts, total = index.facet_counts(node, tag_ids)
+        selection = set(expected)
+        assert total == len(selection), query
+        assert counts == dict((tag_id, len(members & selection)) for tag_id, members in catalog.members.items()
+            if len(members & selection) > 0), query
+
+    counts, total = index.facet_counts()
+    assert total == len(catalog.companies)
+    assert counts == dict((tag_id, len(members)) for tag_id, members in catalog.members.items() if len(members) > 0)
+    assert index.counts(catalog.tags) == dict((tag_id, len(catalog.members[tag_id])) for tag_id in catalog.tags)
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_built_index(build, seed):
+    catalog = Catalog(seed)
+    index = build(catalog)
+    assert index.ready
+    postings = index._postings.values()
+    assert any(isinstance(posting, int) for posting in postings)
+    assert any(not isinstance(posting, int) for posting in postings)
+    check(index, catalog)
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_companies_added_after_build(build, seed):
+    catalog = Catalog(seed)
+    index = build(catalog)
+    # Companies without tags only change queries negating tags
+    index.add_companies([catalog.add_company() for _ in range(5)])
+    # Companies added by links, ordered before and after the built ones
+    for _ in range(20):
+        company = catalog.add_company(catalog.random.sample(catalog.tags[:7], 2))
+        index.apply(added=[(company, tag_id) for tag_id in catalog.tags if company in catalog.members[tag_id]])
+    check(index, catalog)
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_applied_changes(build, seed):
+    catalog = Catalog(seed)
+    index = build(catalog)
+    rng = catalog.random
+    for _ in range(300):
+        company = rng.choice(catalog.companies)
+        tag_id = rng.choice(catalog.tags)
+        if company in catalog.members[tag_id]:
+            catalog.members[tag_id].discard(company)
+            index.apply(removed=[(company, tag_id)])
+        else:
+            catalog.members[tag_id].add(company)
+            index.apply(added=[(company, tag_id)])
+    check(index, catalog)
+
+def test_tags_change_representation(build):
+    catalog = Catalog(3)
+    index = build(catalog)
+    dense, sparse = catalog.tags[0], catalog.tags[6]
+    assert isinstance(index._postings[dense], int) and not isinstance(index._postings[sparse], int)
+    # Emptying the dense tag turns it into an array, filling the sparse one into a bitmap
+    index.apply(removed=[(company, dense) for company in catalog.members[dense]])
+    index.apply(added=[(company, sparse) for company in catalog.companies])
+    catalog.members[dense] = set()
+    catalog.members[sparse] = set(catalog.companies)
+    assert dense not in index._postings and isinstance(index._postings[sparse], int)
+    check(index, catalog)
+
+def test_removing_unknown_links_is_ignored(build):
+    catalog = Catalog(4)
+    index = build(catalog)
+    index.apply(removed=[(uuid.uuid4(), catalog.tags[0]), (catalog.companies[0], uuid.uuid4())])
+    check(index, catalog)
+
+def test_reset():
+    index = TagIndex()
+    index.apply(added=[(uuid.uuid4(), uuid.uuid4())])
+    index.ready = True
+    index.reset()
+    assert not index.ready and index.watermark == None and index.facet_counts() == ({}, 0)
+
+def test_bitmap_helpers():
+    ordinals = [0, 1, 7, 8, 63, 64, 200]
+    bitmap = to_bitmap(ordinals, 256)
+    assert list(iter_ordinals(bitmap)) == ordinals
+    assert list(iter_ordinals(bitmap, 8)) == [8, 63, 64, 200]
+    assert popcount(bitmap) == len(ordinals)
+    assert list(iter_ordinals(0)) == [] and popcount(0) == 0
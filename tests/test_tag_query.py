@@ -0,0 +1,79 @@
+import re
+import pytest
+from services import tag_query
+from services.tag_query import MAX_DEPTH, MAX_TERMS, parse, tag_references
+from util.errors import InvalidRequestError
+
+"""
+    Parsing of boolean tag queries into query trees, and the errors of malformed queries
+"""
+
+def tag(name, language=None):
+    return ("tag", name, language)
+
+@pytest.mark.parametrize("query, expected", [
+    ("a", tag("a")),
+    ("a AND b", ("and", tag("a"), tag("b"))),
+    ("a b", ("and", tag("a"), tag("b"))),
+    ("a OR b", ("or", tag("a"), tag("b"))),
+    ("a and b or c", ("or", ("and", tag("a"), tag("b")), tag("c"))),
+    ("a OR b c", ("or", tag("a"), ("and", tag("b"), tag("c")))),
+    ("a OR b AND c", ("or", tag("a"), ("and", tag("b"), tag("c")))),
+    ("(a OR b) c", ("and", ("or", tag("a"), tag("b")), tag("c"))),
+    ("a NOT b", ("and", tag("a"), ("not", tag("b")))),
+    ("a AND NOT b", ("and", tag("a"), ("not", tag("b")))),
+    ("NOT a b", ("and", ("not", tag("a")), tag("b"))),
+    ("NOT NOT a", ("not", ("not", tag("a")))),
+    ("NOT (a OR b)", ("not", ("or", tag("a"), tag("b")))),
+    ('"tag 1" OR b', ("or", tag("tag 1"), tag("b"))),
+    ('"say \\"hi\\""', tag('say "hi"')),
+    ('"AND"', tag("AND")),
+    ("en:tag_16", tag("tag_16", "en")),
+    ("EN:tag_16", tag("tag_16", "en")),
+    ('ja:"タグ 1"', tag("タグ 1", "ja")),
+    ("zz:tag", tag("zz:tag")),
+    ("  a   (b)  ", ("and", tag("a"), tag("b"))),
+])
+def test_parse(query, expected):
+    assert parse(query) == expected
+
+@pytest.mark.parametrize("query, message", [
+    ("", "at least one tag"),
+    ("   ", "at least one tag"),
+    ("a AND", "ends unexpectedly"),
+    ("NOT", "ends unexpectedly"),
+    ("AND a", "Unexpected 'AND'"),
+    ("a OR OR b", "Unexpected 'OR'"),
+    ("(a OR b", "Missing ')'"),
+    ("a)", "Unexpected ')'"),
+    ("()", "Unexpected ')'"),
+    ('"a', "Unterminated quote"),
+    ('""', "Empty tag name"),
+    ('en:""', "Empty tag name"),
+])
+def test_parse_errors(query, message):
+    with pytest.raises(InvalidRequestError, match=re.escape(message)):
+        parse(query)
+
+def test_term_limit():
+    parse(" OR ".join("t%d"%number for number in range(MAX_TERMS)))
+    with pytest.raises(InvalidRequestError, match="at most %s tags"%MAX_TERMS):
+        parse(" OR ".join("t%d"%number for number in range(MAX_TERMS + 1)))
+
+def test_depth_limit():
+    parse("(" * MAX_DEPTH + "a" + ")" * MAX_DEPTH)
+    parse("NOT " * MAX_DEPTH + "a")
+    with pytest.raises(InvalidRequestError, match="at most %s deep"%MAX_DEPTH):
+        parse("(" * (MAX_DEPTH + 1) + "a" + ")" * (MAX_DEPTH + 1))
+    with pytest.raises(InvalidRequestError, match="at most %s deep"%MAX_DEPTH):
+        parse("NOT " * 3000 + "a")
+
+def test_depth_is_nesting_not_total():
+    parse(" ".join("(t%d)"%number for number in range(MAX_TERMS)))
+
+def test_tag_references():
+    node = parse('a AND (en:b OR NOT a) "c d" en:b')
+    assert tag_references(node) == [("a", None), ("b", "en"), ("c d", None)]
+
+def test_tokenize_keeps_qualified_quotes():
+    assert tag_query.tokenize('ko:"a b"(c)') == ['ko:"a b"', "(", "c", ")"]